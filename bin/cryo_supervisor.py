@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+'''
+Supervisor of the WIB services (wib_server, rogue_server), used by cryo_service.
+
+Each service runs under its own supervisor process which restarts it with
+an exponential backoff when it exits, and rotates its logs
+(/var/log/<name>.log and .err). A service is ready when all of its ports
+accept connections (wib_server: 1234, rogue_server: 9099/9100).
+`start` returns as soon as the services are ready.
+
+    cryo_supervisor.py start [wib_server] [rogue_server] [--timeout 60]
+    cryo_supervisor.py stop|restart|status [NAME ...]
+    cryo_supervisor.py run NAME     (foreground, e.g. for systemd)
+
+The services can be replaced by local stand-ins for testing, e.g.
+
+    services:
+      rogue_server:
+        cmd: [rogue_sim.py, -p, '9099']
+        ports: [9099, 9100]
+      wib_server:
+        cmd: [python3, -m, http.server, '1234']
+        ports: [1234]
+
+    cryo_supervisor.py --config local.yml --rundir /tmp/cryo --logdir /tmp/cryo start
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import argparse
+import subprocess
+
+SERVICES = {
+    'wib_server': dict(
+        cmd=['/usr/bin/wib_server', 'CRYO'],
+        ports=[1234],
+    ),
+    'rogue_server': dict(
+        cmd=['/etc/cryo/python/script/rogue_server', '--type=wib-hw'],
+        ports=[9099, 9100],
+    ),
+}
+
+RUN_DIR = '/var/run/cryo'
+LOG_DIR = '/var/log'
+
+def is_port_open(host, port, timeout=1.):
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def wait_ready(host, ports, timeout=60., interval=0.2):
+    """
+    Wait until all `ports` on `host` accept connections.
+
+    Returns
+    -------
+    ready: bool
+        `False` on timeout
+    """
+
+    t_end = time.time() + timeout
+    while True:
+        if all(is_port_open(host, p) for p in ports):
+            return True
+        if time.time() > t_end:
+            return False
+        time.sleep(interval)
+
+def rotate(path, nkeep=3):
+    """
+    Rotate path -> path.1 -> ... -> path.{nkeep}.
+    The file is copied and truncated, a writer opened in append mode
+    keeps writing to `path`.
+    """
+
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return
+    for i in range(nkeep - 1, 0, -1):
+        if os.path.exists(f'{path}.{i}'):
+            os.replace(f'{path}.{i}', f'{path}.{i+1}')
+    shutil.copyfile(path, f'{path}.1')
+    with open(path, 'r+b') as f:
+        f.truncate(0)
+
+def _read_pid(path):
+    try:
+        with open(path) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError):
+        return None
+
+class Supervisor:
+    """
+    Keep one service running.
+
+    Parameters
+    ----------
+    name: str
+        service name
+    cmd: list(str)
+        command line
+    ports: list(int)
+        readiness probe ports on localhost
+    rundir: str
+        pid and state files
+    logdir: str
+        stdout/stderr logs
+    backoff: float
+        initial restart delay in seconds, doubled for each quick exit
+    backoff_max: float
+        max. restart delay
+    stable: float
+        seconds of uptime to reset the backoff
+    max_log: int
+        max. log size in bytes before rotation
+    """
+
+    def __init__(self, name, cmd, ports, rundir=RUN_DIR, logdir=LOG_DIR,
+                 backoff=1., backoff_max=60., stable=60., max_log=10*1024**2):
+        self.name = name
+        self.cmd = cmd
+        self.ports = ports
+        self.rundir = rundir
+        self.logdir = logdir
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.stable = stable
+        self.max_log = max_log
+
+        self.proc = None
+        self.restarts = 0
+        self._running = True
+
+    @property
+    def logs(self):
+        return [os.path.join(self.logdir, f'{self.name}.{ext}') for ext in ['log', 'err']]
+
+    def _save_state(self, **kwargs):
+        state = dict(name=self.name, supervisor=os.getpid(),
+                     pid=self.proc.pid if self.proc else None,
+                     restarts=self.restarts, ports=self.ports,
+                     time=time.strftime('%Y-%m-%d %H:%M:%S'), **kwargs)
+        tmp = os.path.join(self.rundir, f'{self.name}.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, os.path.join(self.rundir, f'{self.name}.json'))
+
+    def _spawn(self):
+        """
+        Returns
+        -------
+        started: bool
+            `False` if the ports are held by another process or the
+            command cannot be executed
+        """
+
+        self.proc = None
+        busy = [p for p in self.ports if is_port_open('127.0.0.1', p)]
+        if busy:
+            error = f'port(s) {busy} in use by another process'
+            print(f'[{self.name}] {error}, not starting', file=sys.stderr, flush=True)
+            self._save_state(status='conflict', error=error)
+            return False
+
+        for log in self.logs:
+            rotate(log)
+        out, err = [open(log, 'ab') for log in self.logs]
+        print(f'[{self.name}] starting {" ".join(self.cmd)}', flush=True)
+        try:
+            self.proc = subprocess.Popen(self.cmd, stdin=subprocess.DEVNULL,
+                                         stdout=out, stderr=err)
+        except OSError as e:
+            print(f'[{self.name}] cannot start: {e}', file=sys.stderr, flush=True)
+            self._save_state(status='failed', error=str(e))
+            return False
+        finally:
+            out.close()
+            err.close()
+        self._save_state(status='started')
+        return True
+
+    def _stop(self, signum=None, frame=None):
+        self._running = False
+
+    def _terminate(self, grace=5.):
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(grace)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def run(self):
+        os.makedirs(self.rundir, exist_ok=True)
+        os.makedirs(self.logdir, exist_ok=True)
+        pidfile = os.path.join(self.rundir, f'{self.name}.pid')
+        if _read_pid(pidfile) not in [None, os.getpid()]:
+            print(f'[{self.name}] already supervised', file=sys.stderr)
+            return 1
+        with open(pidfile, 'w') as f:
+            f.write(f'{os.getpid()}\n')
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        nquick = 0 # quick exits in a row
+        try:
+            while self._running:
+                t_start = time.time()
+                started = self._spawn()
+                ready = False
+                while started and self._running and self.proc.poll() is None:
+                    if not ready and all(is_port_open('127.0.0.1', p) for p in self.ports):
+                        ready = True
+                        print(f'[{self.name}] ready, pid={self.proc.pid}', flush=True)
+                        self._save_state(status='ready')
+                    if any(os.path.getsize(log) > self.max_log for log in self.logs):
+                        for log in self.logs:
+                            rotate(log)
+                    time.sleep(0.5)
+
+                if not self._running:
+                    break
+
+                # crashed or not started, restart with backoff
+                uptime = time.time() - t_start
+                nquick = 0 if uptime > self.stable else nquick + 1
+                delay = min(self.backoff * 2**max(nquick-1, 0), self.backoff_max)
+                self.restarts += 1
+                if started:
+                    print(f'[{self.name}] exited with {self.proc.returncode} after {uptime:.1f}s,'
+                          f' restart #{self.restarts} in {delay:.1f}s', flush=True)
+                    self._save_state(status='restarting', returncode=self.proc.returncode)
+                else:
+                    print(f'[{self.name}] retry #{self.restarts} in {delay:.1f}s', flush=True)
+                t_end = time.time() + delay
+                while self._running and time.time() < t_end:
+                    time.sleep(0.1)
+        finally:
+            self._terminate()
+            self._save_state(status='stopped')
+            os.unlink(pidfile)
+        return 0
+
+def _read_state(rundir, name):
+    try:
+        with open(os.path.join(rundir, f'{name}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_services(path=None):
+    services = {k: dict(v) for k, v in SERVICES.items()}
+    if path:
+        import yaml
+        with open(path) as f:
+            for name, cfg in yaml.safe_load(f).get('services', {}).items():
+                services.setdefault(name, {}).update(cfg)
+    return services
+
+def status(names, services, rundir):
+    """
+    Returns
+    -------
+    states: dict
+        {name: (supervisor pid, service pid, restarts, ready)}
+    """
+
+    states = {}
+    for name in names:
+        sup = _read_pid(os.path.join(rundir, f'{name}.pid'))
+        state = _read_state(rundir, name)
+        ready = all(is_port_open('127.0.0.1', p) for p in services[name]['ports'])
+        states[name] = (sup, state.get('pid') if sup else None, state.get('restarts', 0), ready)
+    return states
+
+def start(names, services, rundir, logdir, timeout=60., config=None):
+    """
+    Start a supervisor for each service (if not running)
+    and wait until all services are ready.
+
+    Returns
+    -------
+    ready: bool
+    """
+
+    os.makedirs(rundir, exist_ok=True)
+    ready = True
+    supervisors = {}
+    for name in names:
+        pid = _read_pid(os.path.join(rundir, f'{name}.pid'))
+        if pid:
+            print(f'{name} already running')
+            supervisors[name] = pid
+            continue
+
+        # a server not started by us would look ready
+        busy = [p for p in services[name]['ports'] if is_port_open('127.0.0.1', p)]
+        if busy:
+            print(f'{name}: port(s) {busy} in use by an unsupervised process,'
+                  f' stop it first', file=sys.stderr)
+            ready = False
+            continue
+
+        cmd = [sys.executable, os.path.abspath(__file__), 'run', name,
+               '--rundir', rundir, '--logdir', logdir]
+        if config:
+            cmd += ['--config', os.path.abspath(config)]
+        with open(os.path.join(rundir, f'{name}.supervisor.log'), 'ab') as log:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                                    start_new_session=True)
+        supervisors[name] = proc.pid
+        print(f'starting {name}')
+
+    t0 = time.time()
+    for name, pid in supervisors.items():
+        error = None
+        while not all(is_port_open('127.0.0.1', p) for p in services[name]['ports']):
+            # failures reported by this supervisor
+            state = _read_state(rundir, name)
+            if state.get('supervisor') == pid and state.get('status') in ['failed', 'conflict']:
+                error = state.get('error')
+                break
+            if time.time() - t0 > timeout:
+                error = f'not ready after {timeout}s'
+                break
+            time.sleep(0.2)
+
+        if error is None:
+            print(f'{name} ready ({time.time()-t0:.1f}s)')
+        else:
+            print(f'{name} {error}, see {os.path.join(logdir, name)}.err'
+                  f' and {os.path.join(rundir, name)}.supervisor.log', file=sys.stderr)
+            ready = False
+    return ready
+
+def stop(names, rundir, timeout=10.):
+    for name in names:
+        pid = _read_pid(os.path.join(rundir, f'{name}.pid'))
+        if pid is None:
+            continue
+        print(f'stopping {name}, supervisor pid={pid}')
+        os.kill(pid, signal.SIGTERM)
+        t_end = time.time() + timeout
+        while _read_pid(os.path.join(rundir, f'{name}.pid')) and time.time() < t_end:
+            time.sleep(0.1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Supervisor of the WIB services')
+    parser.add_argument('action', choices=['start', 'stop', 'restart', 'status', 'run'])
+    parser.add_argument('names', nargs='*', help='services, default: all')
+    parser.add_argument('--config', help='yml file overriding the services')
+    parser.add_argument('--rundir', default=RUN_DIR, help=f'default={RUN_DIR}')
+    parser.add_argument('--logdir', default=LOG_DIR, help=f'default={LOG_DIR}')
+    parser.add_argument('--timeout', type=float, default=60.,
+                        help='seconds to wait for the services to be ready, default=60')
+    args = parser.parse_args()
+
+    services = load_services(args.config)
+    names = args.names or list(services)
+    for name in names:
+        if name not in services:
+            print(f'unknown service {name}', file=sys.stderr)
+            sys.exit(1)
+
+    if args.action == 'run':
+        if len(names) != 1:
+            print('run takes one service', file=sys.stderr)
+            sys.exit(1)
+        cfg = services[names[0]]
+        sup = Supervisor(names[0], cfg['cmd'], cfg['ports'], args.rundir, args.logdir,
+                         **{k: v for k, v in cfg.items() if k not in ['cmd', 'ports']})
+        sys.exit(sup.run())
+
+    if args.action in ['stop', 'restart']:
+        stop(names, args.rundir)
+
+    if args.action in ['start', 'restart']:
+        ready = start(names, services, args.rundir, args.logdir, args.timeout, args.config)
+        sys.exit(0 if ready else 1)
+
+    if args.action == 'status':
+        for name, (sup, pid, restarts, ready) in status(names, services, args.rundir).items():
+            if sup is None:
+                print(f'{name} not running')
+            else:
+                print(f'{name} running, pid={pid}, restarts={restarts},'
+                      f' {"ready" if ready else "not ready"}')
+
+if __name__ == '__main__':
+    main()
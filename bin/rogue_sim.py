@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for the rogue server on a WIB (`rogue_server --type=wib-hw`).
+
+Serves the `cryoAsicGen1.WibFembCryo` variables and commands used by
+wib_cryo.py over the same zmq interface as `pyrogue.interfaces.ZmqServer`,
+so the real `SimpleClient` can connect to it:
+    port    PUB (variable updates, unused)
+    port+1  REP, pickled requests
+    port+2  REP, string (json) requests
+
+Scriptable latency, rx lock delay and failure injection allow the
+control path (e.g. `wib_cryo.py init`) to be tested and timed offline:
+
+    rogue_sim.py -p 9099 --lock-delay 2 --scenario flaky.yml &
+    WIB_CRYO_TIME_SCALE=0.05 wib_cryo.py -w localhost:9099 init --femb 0 1
+
+Example scenario file (all keys optional):
+
+    latency: 0.005          # seconds per request
+    lock_delay: 2           # seconds until rx lanes are locked
+    lock_prob: 1.0          # probability that a lock attempt succeeds
+    fail_rate: 0.0          # probability of any request to fail
+    fembs:
+      1: {lock_prob: 0.3, bad_lanes: 0x2}
+    fail:
+      - {path: CryoAsic3.WriteColData, prob: 1.0}
+'''
+
+import os
+import re
+import sys
+import time
+import json
+import pickle
+import random
+import argparse
+import threading
+import yaml
+import zmq
+
+ROOT = 'cryoAsicGen1'
+PREFIX = f'{ROOT}.WibFembCryo'
+RO_VARIABLES = [f'{PREFIX}.AppFpgaRegisters.Version']
+
+def _flatten(tree, prefix=''):
+    """
+    Flatten a nested yml dict to {'a.b.c': value}
+    """
+
+    output = {}
+    for key, val in tree.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(val, dict):
+            output.update(_flatten(val, path))
+        else:
+            output[path] = val
+    return output
+
+def _default_tree():
+    tree = {}
+
+    for name in ['enable', 'CLKOUT3HighTime', 'CLKOUT3LowTime']:
+        tree[f'{PREFIX}.MMCM7Registers.{name}'] = 0 if 'Time' in name else False
+
+    app = f'{PREFIX}.AppFpgaRegisters'
+    for name in ['enable', 'SR0Polarity', 'SampClkEn']:
+        tree[f'{app}.{name}'] = False
+    for i in range(4):
+        tree[f'{app}.GlblRstPolarity{i}'] = True
+
+    for i in range(4):
+        dec = f'{PREFIX}.SspGtDecoderReg{i}'
+        tree[f'{dec}.enable'] = False
+        tree[f'{dec}.gtRstVector'] = 0
+        tree[f'{dec}.LaneBitOrder'] = 0
+        tree[f'{dec}.Locked'] = 0
+
+    for i in range(8):
+        asic = f'{PREFIX}.CryoAsic{i}'
+        tree[f'{asic}.enable'] = False
+        tree[f'{asic}.encoder_mode_dft'] = 0
+        tree[f'{asic}.RowCounter'] = 0
+
+    tree[f'{PREFIX}.TriggerRegisters.enable'] = False
+    tree[f'{PREFIX}.TriggerRegisters.RunTriggerEnable'] = False
+    return tree
+
+class SimError(Exception):
+    pass
+
+class SimWib:
+    """
+    Simulated variable tree and rx lock state of a WIB.
+
+    Parameters
+    ----------
+    yml_dir: str
+        local directory for the files in /etc/cryo/yml
+    scenario: dict
+        latency, lock and failure settings (see module doc)
+    """
+
+    def __init__(self, yml_dir, scenario={}):
+        self.yml_dir = yml_dir
+        self.latency = scenario.get('latency', 0.)
+        self.lock_delay = scenario.get('lock_delay', 2.)
+        self.fail_rate = scenario.get('fail_rate', 0.)
+        self.fail = [(re.compile(x['path']), x.get('prob', 1.))
+                     for x in scenario.get('fail', [])]
+
+        lock_prob = scenario.get('lock_prob', 1.)
+        fembs = scenario.get('fembs', {})
+        self.femb_cfg = [
+            {'lock_prob': lock_prob, 'bad_lanes': 0, **fembs.get(i, {})}
+            for i in range(4)
+        ]
+
+        self.tree = _default_tree()
+        self.configured = [False] * 4   # yml loaded since last reset
+        self.sr0_edge = [False] * 4     # SR0 toggled since clock enabled
+        self.t_ready = [None] * 4       # lock condition met since
+        self.will_lock = [False] * 4
+        self.commands = []
+        self.nreq = 0
+        self._lock = threading.Lock()
+
+    # Variables
+    # ---------
+
+    def _path(self, path):
+        if path == 'root' or path.startswith('root.'):
+            path = ROOT + path[4:]
+        return path
+
+    def get(self, path):
+        path = self._path(path)
+        m = re.fullmatch(rf'{PREFIX}\.SspGtDecoderReg(\d)\.Locked', path)
+        if m:
+            return self._locked(int(m.group(1)))
+
+        if path not in self.tree:
+            raise SimError(f'{path} not found')
+        return self.tree[path]
+
+    def set(self, path, value):
+        path = self._path(path)
+        if path not in self.tree and not path.startswith(ROOT):
+            raise SimError(f'{path} not found')
+        if path.endswith('.Locked'):
+            raise SimError(f'{path} is read-only')
+
+        old = self.tree.get(path)
+        self.tree[path] = value
+        self._update(path, old, value)
+
+    def getYaml(self, path, readFirst=False, modes=['RW', 'RO', 'WO'], **kwargs):
+        """
+        Variables under `path` as yaml, same layout as pyrogue Node.getYaml
+        """
+
+        path = self._path(path)
+        name = path.split('.')[-1]
+        tree = {}
+        for var in self.tree:
+            if not var.startswith(path + '.'):
+                continue
+            mode = 'RO' if var in RO_VARIABLES or var.endswith('.Locked') else 'RW'
+            if mode not in modes:
+                continue
+
+            node = tree
+            keys = var[len(path)+1:].split('.')
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = self.get(var)
+
+        if len(tree) == 0 and path not in [ROOT, PREFIX]:
+            raise SimError(f'{path} not found')
+        return yaml.safe_dump({name: tree}, sort_keys=False)
+
+    def getDisp(self, path):
+        val = self.get(path)
+        if isinstance(val, int) and not isinstance(val, bool):
+            return hex(val)
+        return str(val)
+
+    # Commands
+    # --------
+
+    def call(self, path, arg=None):
+        path = self._path(path)
+        name = path.split('.')[-1]
+        self.commands.append((path, arg))
+
+        if path == f'{ROOT}.LoadConfig':
+            self._load_config(arg)
+        elif path == f'{ROOT}.CountReset' or path == f'{ROOT}.ReadAll':
+            pass
+        elif name in ['WriteColData', 'WritePixelData']:
+            pass
+        elif name == 'RowCounter':
+            # command with argument, used by config_asic_ch
+            self.tree[path] = arg
+        else:
+            raise SimError(f'{path} not found')
+
+    def _load_config(self, fpath):
+        rel = os.path.relpath(fpath, '/etc/cryo/yml') \
+                if fpath.startswith('/etc/cryo/yml') else fpath
+        local = os.path.join(self.yml_dir, rel)
+        if not os.path.isfile(local):
+            raise SimError(f'{fpath} not found')
+
+        with open(local) as f:
+            values = _flatten(yaml.safe_load(f))
+        for path, val in values.items():
+            self.set(path, val)
+
+        for m in re.finditer(r'CryoAsic(\d)', ' '.join(values)):
+            self.configured[int(m.group(1)) // 2] = True
+        self._refresh()
+
+    # Lock model
+    # ----------
+
+    def _update(self, path, old, new):
+        app = f'{PREFIX}.AppFpgaRegisters'
+
+        m = re.fullmatch(rf'{app}\.GlblRstPolarity(\d)', path)
+        if m and not new:
+            # asic in reset, needs a new config
+            self.configured[int(m.group(1))] = False
+
+        if path == f'{app}.SampClkEn' and not new:
+            self.sr0_edge = [False] * 4
+
+        if path == f'{app}.SR0Polarity' and new and not old \
+                and self.tree[f'{app}.SampClkEn']:
+            self.sr0_edge = [True] * 4
+
+        self._refresh()
+
+    def _refresh(self):
+        for i in range(4):
+            ready = self._ready(i)
+            if ready and self.t_ready[i] is None:
+                self.t_ready[i] = time.time()
+                self.will_lock[i] = random.random() < self.femb_cfg[i]['lock_prob']
+            elif not ready:
+                self.t_ready[i] = None
+
+    def _ready(self, i):
+        app = f'{PREFIX}.AppFpgaRegisters'
+        dec = f'{PREFIX}.SspGtDecoderReg{i}'
+        return (self.tree[f'{app}.SampClkEn']
+                and self.tree[f'{app}.GlblRstPolarity{i}']
+                and self.tree[f'{dec}.enable']
+                and self.tree[f'{dec}.gtRstVector'] == 0
+                and self.configured[i]
+                and self.sr0_edge[i])
+
+    def _locked(self, i):
+        t = self.t_ready[i]
+        if t is None or time.time() - t < self.lock_delay:
+            return 0
+        if not self.will_lock[i]:
+            return random.choice([0x0, 0x1, 0x3, 0x7])
+        return 0xf & ~self.femb_cfg[i]['bad_lanes']
+
+    # Requests
+    # --------
+
+    def request(self, path, attr, args=(), kwargs={}):
+        with self._lock:
+            self.nreq += 1
+            if self.latency > 0:
+                time.sleep(self.latency)
+
+            if random.random() < self.fail_rate:
+                raise SimError(f'Injected failure: {attr} {path}')
+            for pattern, prob in self.fail:
+                if pattern.search(path) and random.random() < prob:
+                    raise SimError(f'Injected failure: {attr} {path}')
+
+            if attr == 'get' or attr == 'value':
+                return self.get(path)
+            if attr == 'getDisp' or attr == 'valueDisp':
+                return self.getDisp(path)
+            if attr == 'set' or attr == 'setDisp':
+                return self.set(path, *args, **kwargs)
+            if attr == 'getYaml':
+                return self.getYaml(path, *args, **kwargs)
+            if attr == 'call' or attr == '__call__':
+                return self.call(path, *args, **kwargs)
+            raise SimError(f'Unsupported attribute {attr} for {path}')
+
+def _handle_pickle(sim, data):
+    try:
+        d = pickle.loads(data)
+        resp = sim.request(d['path'], d['attr'],
+                           d.get('args', ()), d.get('kwargs', {}))
+    except Exception as e:
+        resp = e
+    return pickle.dumps(resp)
+
+def _handle_string(sim, data):
+    try:
+        d = json.loads(data)
+        resp = sim.request(d['path'], d['attr'],
+                           d.get('args', ()), d.get('kwargs', {}))
+    except Exception as e:
+        resp = f'{type(e).__name__}: {e}'
+    return json.dumps(resp).encode()
+
+def serve(sim, port, addr='*', stop=None):
+    """
+    Serve `sim` on zmq ports `port`, `port+1` and `port+2`
+    until `stop` (threading.Event) is set.
+    """
+
+    ctx = zmq.Context()
+    pub = ctx.socket(zmq.PUB)
+    pub.bind(f'tcp://{addr}:{port}')
+    rep = ctx.socket(zmq.REP)
+    rep.bind(f'tcp://{addr}:{port+1}')
+    rep_str = ctx.socket(zmq.REP)
+    rep_str.bind(f'tcp://{addr}:{port+2}')
+
+    poller = zmq.Poller()
+    poller.register(rep, zmq.POLLIN)
+    poller.register(rep_str, zmq.POLLIN)
+
+    try:
+        while stop is None or not stop.is_set():
+            for sock, __ in poller.poll(100):
+                data = sock.recv()
+                if sock is rep:
+                    sock.send(_handle_pickle(sim, data))
+                else:
+                    sock.send(_handle_string(sim, data))
+    finally:
+        for sock in [pub, rep, rep_str]:
+            sock.close(linger=0)
+        ctx.term()
+
+def start(port=9099, yml_dir=None, scenario={}):
+    """
+    Start a simulated server in a background thread.
+
+    Returns
+    -------
+    sim: SimWib
+    stop: threading.Event
+        set to stop the server
+    """
+
+    if yml_dir is None:
+        yml_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../yml')
+
+    sim = SimWib(yml_dir, scenario)
+    stop = threading.Event()
+    t = threading.Thread(target=serve, args=(sim, port, '127.0.0.1', stop), daemon=True)
+    t.start()
+    return sim, stop
+
+def main():
+    default_yml = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../yml')
+
+    parser = argparse.ArgumentParser(description='Simulated rogue server for WIB-CRYO')
+    parser.add_argument('-p', '--port', type=int, default=9099)
+    parser.add_argument('--addr', default='*', help='bind address, default=*')
+    parser.add_argument('--yml-dir', default=default_yml,
+                        help='local copy of /etc/cryo/yml')
+    parser.add_argument('--scenario', help='yml file of latency/lock/failure settings')
+    parser.add_argument('--latency', type=float, help='seconds per request')
+    parser.add_argument('--lock-delay', type=float, help='seconds to lock rx lanes')
+    parser.add_argument('--lock-prob', type=float, help='probability to lock')
+    parser.add_argument('--fail-rate', type=float, help='probability of failed request')
+    args = parser.parse_args()
+
+    scenario = {}
+    if args.scenario:
+        with open(args.scenario) as f:
+            scenario = yaml.safe_load(f) or {}
+    for key in ['latency', 'lock_delay', 'lock_prob', 'fail_rate']:
+        val = getattr(args, key)
+        if val is not None:
+            scenario[key] = val
+
+    sim = SimWib(os.path.realpath(args.yml_dir), scenario)
+    print(f'rogue_sim listening on port {args.port}-{args.port+2}')
+    t0 = time.time()
+    try:
+        serve(sim, args.port, args.addr)
+    except KeyboardInterrupt:
+        pass
+
+    dt = time.time() - t0
+    print(f'{sim.nreq} requests, {len(sim.commands)} commands in {dt:.1f}s')
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
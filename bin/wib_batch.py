@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+'''
+Parallel and resumable processing of datasets taken by wib_daq.py
+(used by wib_plot2).
+
+Datasets (folders of npz files) are discovered under the given directories,
+e.g. a round "SN03/Cold/T2", a condition "SN03/Cold" or a whole "SN03" tree,
+and processed in a process pool. Each round is saved to
+`{YYYY-MM-DD}_WIB_FEMB_SN03_T2_Cold`. An existing output folder of the same
+round is reused and datasets with unchanged inputs are skipped.
+
+With `--report`, one self-contained html report is written per round
+instead (see wib_report.py).
+
+Example:
+    wib_batch.py /home/wib/data/SN03 -j 8
+    wib_batch.py /home/wib/data/SN03 --report
+'''
+
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+import traceback
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import wib_prof
+
+MARKER_DIR = '.done'
+
+def round_title(path):
+    """
+    Title from the round folder, e.g. .../SN03/Cold/T2 -> WIB_FEMB_SN03_T2_Cold
+    (same as wib_plot2), the folder name if there are less than 3 levels
+    """
+
+    parts = [p for p in os.path.realpath(path).split(os.sep) if p]
+    if len(parts) < 3:
+        return os.path.basename(os.path.realpath(path)) or 'WIB_FEMB'
+    return f'WIB_FEMB_{parts[-3]}_{parts[-1]}_{parts[-2]}'
+
+def discover(paths):
+    """
+    Find datasets (folders of event_*.npz) under `paths`.
+
+    Returns
+    -------
+    rounds: dict
+        {round folder: [dataset folders]}
+    """
+
+    rounds = {}
+    for path in paths:
+        for dirpath, dirnames, filenames in os.walk(os.path.realpath(path)):
+            dirnames.sort()
+            # events written by wib_daq.py, not e.g. <run>_pulse_avg.npz
+            if not any(f.startswith('event_') and f.endswith('.npz') for f in filenames):
+                continue
+            rounds.setdefault(os.path.dirname(dirpath), []).append(dirpath)
+    return rounds
+
+def fingerprint(path, **options):
+    """
+    Hash of the input files (name, size, mtime) and processing options.
+    """
+
+    h = hashlib.sha1()
+    for fpath in sorted(glob(os.path.join(path, 'event_*.npz'))):
+        st = os.stat(fpath)
+        h.update(f'{os.path.basename(fpath)} {st.st_size} {st.st_mtime_ns}\n'.encode())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+def _marker(outdir, path):
+    return os.path.join(outdir, MARKER_DIR, f'{os.path.basename(path)}.json')
+
+def is_done(outdir, path, fp):
+    try:
+        with open(_marker(outdir, path)) as f:
+            return json.load(f)['fingerprint'] == fp
+    except (OSError, ValueError, KeyError):
+        return False
+
+def _output_dir(root, title):
+    # reuse an earlier output folder of the same round to resume
+    existing = sorted(glob(os.path.join(root, f'????-??-??_{title}')))
+    if existing:
+        return existing[-1]
+    return os.path.join(root, f'{time.strftime("%Y-%m-%d")}_{title}')
+
+def run_dataset(path, title, cold, outdir, golden, lines, fp):
+    """
+    Make the default plots of one dataset (worker process).
+    stdout/stderr go to `<outdir>/.done/<dataset>.log`.
+    """
+
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    name = os.path.basename(path)
+    log = os.path.join(outdir, MARKER_DIR, f'{name}.log')
+
+    t0 = time.time()
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(log, 'w') as f:
+        sys.stdout = sys.stderr = f
+        try:
+            import wib_plot
+            with wib_prof.profile(f'wib_plot_{name}'):
+                wib_plot.process(path, title, wib_plot.plots_for(name), cold=cold,
+                                 outdir=outdir, golden=golden, lines=lines,
+                                 fs=1e6/0.512)
+        except BaseException as e:
+            # wib_plot exits on bad input, keep the worker alive
+            traceback.print_exc()
+            raise RuntimeError(f'{type(e).__name__}: {e}') from None
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    with open(_marker(outdir, path), 'w') as f:
+        json.dump(dict(input=path, fingerprint=fp,
+                       time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                       elapsed=time.time()-t0), f)
+    return time.time() - t0
+
+def main():
+    parser = argparse.ArgumentParser(description='Make plots for datasets taken by wib_daq.py')
+    parser.add_argument('input', nargs='+',
+                        help='round, condition or SN folder(s)')
+    parser.add_argument('-t', '--title', help='title of a single round,'
+                        ' default: from the folder structure')
+    parser.add_argument('-o', '--outdir', default='.',
+                        help='where the output folders are created, default: .')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes, default: number of cpus')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='reprocess datasets which are done')
+    parser.add_argument('--report', action='store_true',
+                        help='one interactive html report per round instead of png plots')
+    parser.add_argument('--profile', action='store_true',
+                        help='write a profile per dataset (see wib_prof.py)')
+    args = parser.parse_args()
+    wib_prof.start('wib_batch', args.profile)
+
+    import wib_plot
+    golden = os.environ.get('WIB_GOLDEN')
+    lines = os.environ.get('WIB_LINES')
+    rounds = discover(args.input)
+    if len(rounds) == 0:
+        print(f'No dataset found in {" ".join(args.input)}', file=sys.stderr)
+        sys.exit(1)
+    if args.title and len(rounds) > 1:
+        print('--title only works for a single round', file=sys.stderr)
+        sys.exit(1)
+
+    if args.report:
+        from wib_report import make_report
+        passed = True
+        for rnd in rounds:
+            title = args.title or round_title(rnd)
+            output = os.path.join(args.outdir, f'{time.strftime("%Y-%m-%d")}_{title}.html')
+            passed &= make_report(rnd, output, title, args.workers, golden=golden)
+        sys.exit(0 if passed else 1)
+
+    jobs = []
+    nskip = 0
+    for rnd, datasets in rounds.items():
+        title = args.title or round_title(rnd)
+        cold = 'cold' in rnd.lower()
+        outdir = _output_dir(args.outdir, title)
+        os.makedirs(os.path.join(outdir, MARKER_DIR), exist_ok=True)
+        print(f'{rnd} -> {outdir} ({"Cold" if cold else "Room"})')
+
+        for path in datasets:
+            if len(wib_plot.plots_for(os.path.basename(path))) == 0:
+                print(f'  {os.path.basename(path)}: unknown ASIC setting (skip processing)')
+                continue
+            # lines only when set, keep the fingerprints of earlier runs
+            options = dict(cold=cold, title=title, golden=golden)
+            if lines:
+                options['lines'] = lines
+            fp = fingerprint(path, **options)
+            if not args.force and is_done(outdir, path, fp):
+                nskip += 1
+                continue
+            jobs.append((path, title, cold, outdir, golden, lines, fp))
+
+    print(f'Processing {len(jobs)} dataset(s), {nskip} unchanged,'
+          f' {args.workers} worker(s)')
+
+    failed = []
+    t0 = time.time()
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = {pool.submit(run_dataset, *job): job for job in jobs}
+        for fut in as_completed(futures):
+            path, __, __, outdir, __, __, __ = futures[fut]
+            try:
+                dt = fut.result()
+                print(f'  done {path} ({dt:.1f}s)')
+            except Exception as e:
+                log = os.path.join(outdir, MARKER_DIR, f'{os.path.basename(path)}.log')
+                failed.append((path, e, log))
+                print(f'  FAILED {path}: {e}')
+
+    print(f'DONE in {time.time()-t0:.1f}s')
+    if failed:
+        print(f'{len(failed)} dataset(s) failed:')
+        for path, e, log in failed:
+            print(f'  {path}: {e} (log: {log})')
+        sys.exit(1)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
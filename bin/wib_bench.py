@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the DAQ and analysis hot paths on synthetic data.
+
+Each stage runs in a forked process to measure its wall time, peak RSS and
+throughput. Results are stored as json and can be compared between versions.
+
+Example:
+    wib_bench.py run -o before.json --events 10 --fembs 4
+    (update code)
+    wib_bench.py run -o after.json --events 10 --fembs 4
+    wib_bench.py compare before.json after.json --threshold 0.1
+
+    # memory of reading and analyzing a large run
+    wib_bench.py run --events 100 --fembs 4 --stage read analysis
+'''
+
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import importlib
+import tempfile
+import subprocess
+import multiprocessing as mp
+import numpy as np
+
+from wib_sim import FakeWIB
+
+class _Preloaded:
+    """
+    WIB-like source returning pre-generated events (no generation cost).
+    """
+
+    def __init__(self, events):
+        self._events = events
+        self._i = 0
+
+    def acquire_data(self, **kwargs):
+        ev = self._events[self._i % len(self._events)]
+        self._i += 1
+        return ev
+
+def _rss_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+def _reset_peak_rss():
+    # reset VmHWM to the current RSS (linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def make_dataset(outdir, nevents, nfembs, nsamples, seed=0):
+    """
+    Generate a synthetic dataset of `nevents` in `outdir` with
+    `nfembs` active FEMBs (the others are zero).
+
+    Returns
+    -------
+    events: list of (ts, data)
+    """
+
+    wib = FakeWIB(nsamples=nsamples, jitter=0, seed=seed)
+    events = []
+    for i in range(nevents):
+        ts, data = wib.acquire_data()
+        data[nfembs:] = 0
+        events.append((ts, data))
+        np.savez_compressed(os.path.join(outdir, f'event_{i:05}'),
+                            timestamps=ts, data=data)
+    return events
+
+# Stages
+# ------
+# Each stage takes the context dict and returns the number of bytes processed.
+
+def stage_daq_write(ctx):
+    from wib_daq import record
+    outdir = tempfile.mkdtemp(dir=ctx['tmpdir'])
+    record(_Preloaded(ctx['events']), outdir, len(ctx['events']))
+    return ctx['nbytes']
+
+def stage_read(ctx):
+    from wib_plot import _read
+    _read(ctx['datadir'])
+    return ctx['nbytes']
+
+def stage_mean_psd(ctx):
+    from wib_plot import mean_psd
+    adcs = ctx['adcs']
+    for femb in range(ctx['nfembs']):
+        for ch in range(128):
+            mean_psd(adcs[:, femb, ch], fs=1e6/0.512)
+    return adcs[:, :ctx['nfembs']].nbytes
+
+def stage_plot_mcorr(ctx):
+    import matplotlib.pyplot as plt
+    from wib_plot import plot_mcorr
+    adcs = ctx['adcs']
+    for femb in range(ctx['nfembs']):
+        for asic in [0,1]:
+            plot_mcorr(adcs[:, femb, 64*asic:64*(asic+1)], num=1)
+    plt.close('all')
+    return adcs[:, :ctx['nfembs']].nbytes
+
+def stage_save_stats(ctx):
+    from wib_plot import save_stats
+    adcs = ctx['adcs']
+    for femb in range(ctx['nfembs']):
+        for asic in [0,1]:
+            out = os.path.join(ctx['tmpdir'], f'stats_FEMB{femb}_ASIC{asic}')
+            save_stats(adcs[:, femb, 64*asic:64*(asic+1)], out)
+    return adcs[:, :ctx['nfembs']].nbytes
+
+def stage_plot_psd(ctx):
+    import matplotlib.pyplot as plt
+    from wib_plot import plot, plot_psd
+    adcs = ctx['adcs']
+    output = os.path.join(ctx['tmpdir'], 'psd_FEMB{}_ASIC{}')
+    plot(adcs, list(range(ctx['nfembs'])), 'FEMB{}_ASIC{}', output, plot_psd)
+    plt.close('all')
+    return adcs[:, :ctx['nfembs']].nbytes
+
+def stage_analysis(ctx):
+    # read + noise analysis of a run from disk, as in wib_plot.process
+    from wib_plot import _read, mean_psd, save_stats
+    adcs = _read(ctx['datadir'])
+    for femb in range(ctx['nfembs']):
+        for asic in [0,1]:
+            data = adcs[:, femb, 64*asic:64*(asic+1)]
+            out = os.path.join(ctx['tmpdir'], f'stats_FEMB{femb}_ASIC{asic}')
+            save_stats(data, out)
+            for ch in range(64):
+                mean_psd(data[:, ch], fs=1e6/0.512)
+    return ctx['nbytes']
+
+def stage_dash_process(ctx):
+    from wib_dash import _process
+    for ts, data in ctx['events']:
+        _process(ts, data)
+    return ctx['nbytes']
+
+def stage_dash_draw(ctx):
+    import wib_dash
+    ts, data = ctx['events'][0]
+    bundle = wib_dash._process(ts, data)
+    for femb in range(ctx['nfembs']):
+        wib_dash._draw_pixel(bundle, femb)
+        wib_dash._draw_mean_std(bundle, femb)
+        wib_dash._draw_psd(bundle, femb, 0)
+        wib_dash._draw_wfm(bundle, femb, 0)
+        wib_dash._draw_delta_adcs(bundle, femb, 0)
+        wib_dash._draw_timestamp(bundle, femb)
+        wib_dash._draw_delta_timestamp(bundle, femb)
+    return data.nbytes
+
+# stage -> (function, modules imported before timing)
+STAGES = {
+    'daq_write': (stage_daq_write, ['wib_daq']),
+    'read': (stage_read, ['wib_plot']),
+    'mean_psd': (stage_mean_psd, ['wib_plot']),
+    'plot_mcorr': (stage_plot_mcorr, ['wib_plot']),
+    'save_stats': (stage_save_stats, ['wib_plot']),
+    'plot_psd': (stage_plot_psd, ['wib_plot']),
+    'analysis': (stage_analysis, ['wib_plot']),
+    'dash_process': (stage_dash_process, ['wib_dash']),
+    'dash_draw': (stage_dash_draw, ['wib_dash']),
+}
+
+def _run_stage(name, ctx, conn):
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    devnull = open(os.devnull, 'w')
+    sys.stdout = devnull
+    sys.stderr = devnull
+
+    func, modules = STAGES[name]
+    try:
+        for mod in modules:
+            importlib.import_module(mod)
+
+        _reset_peak_rss()
+        rss0 = _rss_kb('VmRSS')
+        t0 = time.perf_counter()
+        nbytes = func(ctx)
+        dt = time.perf_counter() - t0
+        peak = _rss_kb('VmHWM') - rss0
+        conn.send(dict(time=dt, nbytes=nbytes, peak_rss_mb=peak/1024.))
+    except ImportError as e:
+        conn.send(dict(skipped=f'{e}'))
+    except Exception as e:
+        conn.send(dict(error=f'{type(e).__name__}: {e}'))
+
+def run_stage(name, ctx, repeat=1):
+    """
+    Run a stage `repeat` times in forked processes.
+    Report the fastest run.
+    """
+
+    mpctx = mp.get_context('fork')
+    best = None
+    for i in range(repeat):
+        recv, send = mpctx.Pipe(duplex=False)
+        p = mpctx.Process(target=_run_stage, args=(name, ctx, send))
+        p.start()
+        res = recv.recv() if recv.poll(None) else dict(error='no result')
+        p.join()
+
+        if 'time' not in res:
+            return res
+        if best is None or res['time'] < best['time']:
+            best = res
+
+    nevents = len(ctx['events'])
+    best['mb_per_s'] = best['nbytes'] / best['time'] / 1e6
+    best['events_per_s'] = nevents / best['time']
+    return best
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def cmd_run(args):
+    stages = args.stage or list(STAGES)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datadir = os.path.join(tmpdir, 'data')
+        os.makedirs(datadir)
+        print(f'generating {args.events} events x {args.fembs} FEMBs'
+              f' x {args.samples} samples')
+        events = make_dataset(datadir, args.events, args.fembs, args.samples)
+
+        ctx = dict(
+            tmpdir=tmpdir,
+            datadir=datadir,
+            events=events,
+            adcs=np.array([data for ts, data in events]),
+            nfembs=args.fembs,
+            nbytes=sum(data.nbytes for ts, data in events),
+        )
+
+        results = {}
+        for name in stages:
+            res = run_stage(name, ctx, args.repeat)
+            results[name] = res
+            _print_stage(name, res)
+
+    output = dict(
+        meta=dict(
+            commit=_git_commit(),
+            time=time.strftime('%Y-%m-%d %H:%M:%S'),
+            host=platform.node(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            events=args.events,
+            fembs=args.fembs,
+            samples=args.samples,
+            repeat=args.repeat,
+        ),
+        stages=results,
+    )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'results saved to {args.output}')
+
+def _print_stage(name, res):
+    if 'time' in res:
+        print(f'{name:<14} {res["time"]:9.3f}s {res["peak_rss_mb"]:9.1f}MB'
+              f' {res["mb_per_s"]:9.1f}MB/s {res["events_per_s"]:9.2f}ev/s')
+    else:
+        status = res.get('skipped') or res.get('error')
+        print(f'{name:<14} {status}')
+
+def cmd_compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print(f'base: {base["meta"]["commit"]} ({base["meta"]["time"]})')
+    print(f'new:  {new["meta"]["commit"]} ({new["meta"]["time"]})')
+    print(f'{"stage":<14} {"base[s]":>9} {"new[s]":>9} {"ratio":>7}'
+          f' {"base[MB]":>9} {"new[MB]":>9}')
+
+    regressions = []
+    for name, b in base['stages'].items():
+        n = new['stages'].get(name)
+        if n is None or 'time' not in b or 'time' not in n:
+            continue
+
+        ratio = n['time'] / b['time']
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'SLOWER'
+            regressions.append(name)
+        elif n['peak_rss_mb'] > b['peak_rss_mb'] * (1 + args.threshold) + 1:
+            flag = 'MEMORY'
+            regressions.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = 'faster'
+
+        print(f'{name:<14} {b["time"]:9.3f} {n["time"]:9.3f} {ratio:7.2f}'
+              f' {b["peak_rss_mb"]:9.1f} {n["peak_rss_mb"]:9.1f} {flag}')
+
+    if regressions:
+        print(f'Regression (> {args.threshold:.0%}) in: {", ".join(regressions)}')
+        sys.exit(1)
+    sys.exit(0)
+
+def main():
+    parser = argparse.ArgumentParser(description='WIB Cryo Benchmarks')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('run', help='run benchmarks')
+    p.add_argument('-o', '--output', help='output json file')
+    p.add_argument('--events', type=int, default=4)
+    p.add_argument('--fembs', type=int, default=1, choices=range(1,5))
+    p.add_argument('--samples', type=int, default=2162)
+    p.add_argument('--repeat', type=int, default=1)
+    p.add_argument('--stage', nargs='+', choices=list(STAGES),
+                   help='stage(s) to run, default: all')
+    p.set_defaults(func=cmd_run)
+
+    p = subparsers.add_parser('compare', help='compare two results')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='relative regression threshold, default=0.1')
+    p.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        sys.exit(1)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+'''
+Noise regression check against golden per-channel references.
+
+Per-channel mean, std and band-integrated noise (rms in frequency bands)
+of a run are compared with golden references in one vectorized pass over
+all 512 channels. References are stored by SN, condition and ASIC setting:
+    <golden>/SN03/Cold/0x390.csv
+
+Example:
+    wib_check.py make-golden -i /home/wib/data/SN03/Cold/T1/WIB_0x390 -g ~/golden
+    wib_check.py check -i /home/wib/data/SN03/Cold/T2/WIB_0x390 -g ~/golden
+'''
+
+import os
+import re
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+from wib_plot import _read
+
+FS = 1e6/0.512
+
+# frequency bands [kHz] for the band-integrated noise
+BANDS = [(0, 10), (10, 100), (100, 500), (500, 1000)]
+
+# tolerance of each statistic (relative, absolute) used as the minimum sigma
+TOLERANCE = {
+    'mean' : (0., 10.),
+    'std' : (0.1, 0.2),
+    'rms' : (0.15, 0.1),
+}
+
+def _band_name(band):
+    return f'rms_{band[0]}_{band[1]}k'
+
+def stat_names(bands=BANDS):
+    return ['mean', 'std'] + [_band_name(b) for b in bands]
+
+def channel_stats(adcs, fs=FS, bands=BANDS):
+    """
+    Per-channel statistics of all channels at once.
+
+    Parameters
+    ----------
+    adcs: (N, 4, 128, n) array
+        events from `wib_plot._read`
+    fs: float
+        sampling frequency
+    bands: list of (lo, hi)
+        frequency bands in kHz
+
+    Returns
+    -------
+    stats: (512, M) float array
+        mean, std and the rms in each band for every channel
+        (channel = femb * 128 + ch)
+    """
+
+    nevents, nfembs, nchs, n = adcs.shape
+    adcs = adcs.reshape(nevents, nfembs*nchs, n)
+
+    mean = adcs.mean(axis=-1, dtype=np.float64)
+    wfms = adcs.astype(np.float32)
+    wfms -= mean[..., None].astype(np.float32)
+
+    # band power from the one-sided periodogram, in ADC^2
+    power = np.abs(np.fft.rfft(wfms, axis=-1))**2
+    power = power.mean(axis=0) * (2. / n**2)
+    freq = np.fft.rfftfreq(n, 1./fs) / 1e3
+
+    stats = [mean.mean(axis=0), wfms.std(axis=-1).mean(axis=0)]
+    for lo, hi in bands:
+        mask = (freq > lo) & (freq <= hi)
+        stats.append(np.sqrt(power[:, mask].sum(axis=-1)))
+
+    return np.stack(stats, axis=-1)
+
+def _parse_key(path):
+    """
+    (SN, condition, setting) from a dataset path,
+    e.g. .../SN03/Cold/T2/WIB_0x390 -> ('SN03', 'Cold', '0x390')
+    """
+
+    path = os.path.realpath(path)
+    parts = path.split(os.sep)
+    sn = next((p for p in parts if re.fullmatch(r'SN\d+', p)), None)
+    cond = next((p for p in parts if p in ['Room', 'Cold']), None)
+    setting = re.search(r'0x[0-9a-fA-F]{3}', os.path.basename(path))
+    return sn, cond, setting.group(0).lower() if setting else None
+
+def golden_path(golden, sn, cond, setting):
+    return os.path.join(golden, sn, cond, f'{setting}.csv')
+
+def to_frame(stats, names):
+    nchs = len(stats)
+    df = pd.DataFrame(stats, columns=names)
+    df.insert(0, 'femb', np.arange(nchs) // 128)
+    df.insert(1, 'ch', np.arange(nchs) % 128)
+    return df
+
+def make_golden(inputs, output, fs=FS, do_align=True):
+    """
+    Golden reference from one or more good runs: the mean of each statistic
+    and its spread between runs (`<stat>_sigma`, 0 for a single run).
+    """
+
+    names = stat_names()
+    runs = np.array([channel_stats(_read(path, do_align), fs) for path in inputs])
+    ref = to_frame(runs.mean(axis=0), names)
+    sigma = runs.std(axis=0, ddof=1) if len(runs) > 1 else np.zeros_like(runs[0])
+    for i, name in enumerate(names):
+        ref[f'{name}_sigma'] = sigma[:, i]
+    ref['nruns'] = len(runs)
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    ref.to_csv(output, index=False, float_format='%.4f')
+    print(f'Golden reference ({len(runs)} run(s)) saved to {output}')
+    return ref
+
+def reference_fembs(ref):
+    """
+    FEMBs with data in a golden reference (all 512 channels are saved).
+    """
+
+    std = ref.groupby('femb')['std'].max()
+    return std.index[std > 0].to_numpy()
+
+def compare(stats, ref, zmax=5., active=None):
+    """
+    Compare per-channel statistics with a golden reference.
+
+    Parameters
+    ----------
+    stats: (512, M) array
+        from `channel_stats`
+    ref: pandas.DataFrame
+        golden reference from `make_golden`
+    zmax: float
+        flag channels with any |z| > zmax
+    active: (4, ) bool array, optional
+        FEMBs to compare, default: the FEMBs with data in the reference
+        (`reference_fembs`), a FEMB without data in `stats` fails
+
+    Returns
+    -------
+    channels: pandas.DataFrame
+        z-scores of each channel and the `flagged` column
+    lanes: pandas.DataFrame
+        pass/fail per FEMB and lane (32 channels)
+    """
+
+    names = stat_names()
+    ref_val = ref[names].to_numpy()
+    ref_sigma = ref[[f'{name}_sigma' for name in names]].to_numpy()
+
+    rel = np.array([TOLERANCE[name.split('_')[0]][0] for name in names])
+    floor = np.array([TOLERANCE[name.split('_')[0]][1] for name in names])
+    sigma = np.maximum(ref_sigma, np.maximum(rel * np.abs(ref_val), floor))
+    z = (stats - ref_val) / sigma
+
+    channels = to_frame(z, [f'z_{name}' for name in names])
+    channels['flagged'] = np.any(np.abs(z) > zmax, axis=-1)
+    channels['worst'] = np.array(names)[np.argmax(np.abs(z), axis=-1)]
+    channels['max_z'] = z[np.arange(len(z)), np.argmax(np.abs(z), axis=-1)]
+
+    fembs = reference_fembs(ref) if active is None else np.where(active)[0]
+    channels = channels[channels['femb'].isin(fembs)]
+
+    lanes = channels.assign(lane=channels['ch'] // 32).groupby(['femb', 'lane']).agg(
+        nflagged=('flagged', 'sum'),
+        max_abs_z=('max_z', lambda x: np.abs(x).max()),
+    ).reset_index()
+    lanes['result'] = np.where(lanes['nflagged'] > 0, 'FAIL', 'PASS')
+
+    return channels, lanes
+
+def check(input, golden, data=None, zmax=5., fs=FS, output=None, key=None):
+    """
+    Check a run against its golden reference and print a pass/fail table.
+
+    Parameters
+    ----------
+    input: str
+        dataset path (used for the SN/condition/setting lookup)
+    golden: str
+        directory of golden references
+    data: (N, 4, 128, n) array, optional
+        events already read from `input`
+    zmax: float
+        z-score threshold
+    fs: float
+        sampling frequency
+    output: str, optional
+        csv file for the per-channel z-scores
+    key: tuple, optional
+        (SN, condition, setting), default: parsed from `input`
+
+    Returns
+    -------
+    passed: bool or None
+        None if there is no golden reference
+    """
+
+    sn, cond, setting = key or _parse_key(input)
+    if None in (sn, cond, setting):
+        print(f'Cannot determine SN/condition/setting from {input}', file=sys.stderr)
+        return None
+
+    ref_path = golden_path(golden, sn, cond, setting)
+    if not os.path.exists(ref_path):
+        print(f'No golden reference {ref_path}, skip check')
+        return None
+
+    if data is None:
+        data = _read(input)
+
+    # FEMBs of the reference, a FEMB without data is the worst regression
+    ref = pd.read_csv(ref_path)
+    stats = channel_stats(data, fs)
+    channels, lanes = compare(stats, ref, zmax)
+
+    passed = bool(np.all(lanes['result'] == 'PASS'))
+    print(f'Noise check {sn}/{cond}/{setting} vs {ref_path} (|z| > {zmax:g})')
+    active = np.any(data, axis=(0,2,3))
+    for femb in reference_fembs(ref):
+        if not active[femb]:
+            print(f'FEMB{femb}: no data')
+    print(lanes.to_string(index=False, float_format='%.1f'))
+
+    flagged = channels[channels['flagged']]
+    if len(flagged) > 0:
+        print(f'Flagged channels ({len(flagged)}):')
+        print(flagged[['femb', 'ch', 'worst', 'max_z']].to_string(
+            index=False, float_format='%.1f'))
+    print('PASS' if passed else 'FAIL')
+
+    if output is not None:
+        channels.to_csv(output, index=False, float_format='%.2f')
+
+    return passed
+
+def main():
+    parser = argparse.ArgumentParser(description='WIB noise regression check')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('make-golden', help='make golden reference from good run(s)')
+    p.add_argument('-i', '--input', nargs='+', required=True)
+    p.set_defaults(cmd='make-golden')
+
+    p = subparsers.add_parser('check', help='check a run against the golden reference')
+    p.add_argument('-i', '--input', nargs=1, required=True)
+    p.add_argument('-o', '--output', help='csv file for per-channel z-scores')
+    p.add_argument('--zmax', type=float, default=5.,
+                   help='z-score threshold, default=5')
+    p.set_defaults(cmd='check')
+
+    for p in subparsers.choices.values():
+        p.add_argument('-g', '--golden', required=True,
+                       help='directory of golden references')
+        p.add_argument('--fs', type=float, default=FS)
+        p.add_argument('--sn', help='SN, default: from input path')
+        p.add_argument('--cond', choices=['Room', 'Cold'],
+                       help='condition, default: from input path')
+        p.add_argument('--setting', help='ASIC setting, default: from input path')
+
+    args = parser.parse_args()
+    if not hasattr(args, 'cmd'):
+        parser.print_help()
+        sys.exit(1)
+
+    sn, cond, setting = _parse_key(args.input[0])
+    key = (args.sn or sn, args.cond or cond, args.setting or setting)
+
+    if args.cmd == 'make-golden':
+        if None in key:
+            print(f'Cannot determine SN/condition/setting from {args.input[0]}',
+                  file=sys.stderr)
+            sys.exit(1)
+        make_golden(args.input, golden_path(args.golden, *key), args.fs)
+        sys.exit(0)
+
+    passed = check(args.input[0], args.golden, zmax=args.zmax, fs=args.fs,
+                   output=args.output, key=key)
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,13 @@ History
 
 DATE       WHO WHAT
 ---------- --- ---------------------------------------------------------
+2026-10-19 agt sweep finds noise lines w/ $WIB_LINES (v0.1.9)
+2026-10-18 agt Fix load_fw, start_server waits for cryo_service (v0.1.8)
+2026-10-18 agt Added init_femb, per-FEMB lock and retry (v0.1.7)
+2026-10-18 agt sweep runs noise check w/ $WIB_GOLDEN (v0.1.6)
+2026-10-18 agt Added snapshot/diff/restore (v0.1.5)
+2026-10-18 agt Added sweep (v0.1.4)
+2026-10-18 agt $WIB_CRYO_TIME_SCALE for offline tests w/ rogue_sim.py (v0.1.3)
 2021-07-08 kvt set gtRstVector (v0.1.2)
 2021-07-06 kvt reset_asic during init (v0.1.1)
 2021-07-05 kvt Added disable_lane (v0.1.0)
@@ -16,22 +23,32 @@ DATE       WHO WHAT
 
 import os
 import sys
+import gzip
+import json
 import subprocess
 import time
 import argparse
 import inspect
 import itertools
-import numpy as np
-from multiprocessing import Process
+import yaml
+from multiprocessing import Process, Array
 
 from pyrogue.interfaces import SimpleClient
 
+import wib_prof
+
+# scale all waits, e.g. WIB_CRYO_TIME_SCALE=0.01 for a simulated server
+TIME_SCALE = float(os.getenv('WIB_CRYO_TIME_SCALE', '1'))
+
+def _sleep(seconds):
+    time.sleep(seconds * TIME_SCALE)
+
 def version(**kwargs):
     print( '''
 =================================
 = wib_cryo.py: WIB-CRYO scripts =
 =                               =
-=           v0.1.2              =
+=           v0.1.9              =
 =        Patrick Tsang          =
 =   kvtsang@slac.stanford.edu   =
 =                               =
@@ -49,6 +66,17 @@ Usage:
         Use room temperature setting by default.
         Example: {PROG} init --femb 0 1 2 3 --cold
 
+    {PROG} init_femb --femb FEMBS [--cold]
+        Same as init, but track the rx lock of each FEMB. Failing FEMBs are
+        retried with toggling SR0, then resetting and reloading the FEMB.
+        Report the FEMBs initialized instead of aborting the good ones.
+        Exit code: 0 all locked, 2 some FEMBs failed, 1 all failed.
+        Example: {PROG} init_femb --femb 0 1 2 3 --cold
+
+    {PROG} start_server
+        Start wib_server and rogue_server on the WIB (cryo_service start),
+        wait until the rogue server is ready.
+
     {PROG} reset_asic/reset --femb FEMBS 
         Reset asic by toggling GlblRstPolarity
         Disable SampClkEn and SR0Polarity after reset
@@ -75,6 +103,26 @@ Usage:
     {PROG} disable_ramp --femb FEMBS
         Disable ramp mode. Use in conjuction with "enable_ramp" command.
 
+    {PROG} sweep --femb FEMBS --asic ASICS --val VALUES [--grid PATH=V1,V2 ..]
+                 -n NEVENTS -o OUTDIR [--buf BUF] [--workers N] [--cold]
+        For each ASIC setting (and/or register grid point): configure,
+        acquire NEVENTS to OUTDIR/WIB_<setting> and analyze in the background
+        while the next point is configured and acquired.
+        Plots are saved to {{YYYY-MM-DD}}_<title> as wib_plot2 does.
+        Example: {PROG} sweep --femb 1 --val 0x390 0x391 0x394 0x395 \\
+                 -n 10 -o ~/data/SN03/Cold/T2 --cold
+
+    {PROG} snapshot [--path PATH] [-o OUTPUT]
+        Read all variables under PATH (default: cryoAsicGen1.WibFembCryo)
+        in bulk and save them with a timestamp and the WIB address.
+
+    {PROG} diff FILE [FILE] [--ro]
+        Compare two snapshots (or a snapshot and a yml file).
+        With one FILE, compare it to the current state of the WIB.
+
+    {PROG} restore FILE
+        Write back a snapshot, only the registers that differ.
+
     {PROG} help
         Show help (this text).
 
@@ -136,6 +184,7 @@ def rogue_getDisp(addr, port, var_list):
             ret = client.getDisp(var)
             print(f'[{addr}:{port}] get {var} -> {ret}')
 
+@wib_prof.timed()
 def rogue_set(addr, port, pars, pause=0.5):
     """
     Set values to a list of rogue variables
@@ -155,8 +204,9 @@ def rogue_set(addr, port, pars, pause=0.5):
             disp_val = hex(val) if isinstance(val, int) else val
             print(f'[{addr}:{port}] set {path} <- {disp_val}')
             client.set(path, val)
-            if pause > 0: time.sleep(pause)
+            if pause > 0: _sleep(pause)
 
+@wib_prof.timed()
 def rogue_exec(addr, port, cmds, pause=0.5):
     """
     Set values to a list of rogue variables
@@ -176,10 +226,10 @@ def rogue_exec(addr, port, cmds, pause=0.5):
             disp_val = hex(val) if isinstance(val, int) else val
             print(f'[{addr}:{port}] exe {cmd} {disp_val}')
             client.exec(cmd, val)
-            if pause > 0: time.sleep(pause)
+            if pause > 0: _sleep(pause)
 
 def ssh_cmd(addr, cmd):
-    os.system(f'ssh root@{addr} \'{cmd}\'')
+    return os.system(f'ssh root@{addr} \'{cmd}\'')
 
 def config_pll(addr, port):
     print(f'[{addr}:{port}] Configuring PLL')
@@ -199,13 +249,27 @@ def get_mmcm7_status(addr, port):
     rogue_getDisp(addr, port, variables)
 
 def load_fw(addr):
-    print(f'Loading remote wib_top.bit at {addr}'
-           ' && echo "wib_top.bit" > /sys/class/fpga_manager/fpga0/firmware')
-    _ssh_cmd(addr, cmd)
+    print(f'Loading remote wib_top.bit at {addr}')
+    cmd = 'echo "wib_top.bit" > /sys/class/fpga_manager/fpga0/firmware'
+    if ssh_cmd(addr, cmd) != 0:
+        print(f'[{addr}] Failed to load wib_top.bit', file=sys.stderr)
+        sys.exit(1)
+
+def start_server(addr, port):
+    """
+    Start wib_server and rogue_server on the WIB (cryo_service), returns
+    once the rogue server accepts connections from this host.
+    """
 
-def start_server(addr):
+    from cryo_supervisor import wait_ready
     print(f'starting rogue server at {addr}')
-    ssh_cmd(addr, './start_cryo_server')
+    if ssh_cmd(addr, 'cryo_service start') != 0:
+        print(f'[{addr}] Failed to start the servers', file=sys.stderr)
+        sys.exit(1)
+    if not wait_ready(addr, [port, port+1], timeout=60*TIME_SCALE):
+        print(f'[{addr}:{port}] rogue server not reachable', file=sys.stderr)
+        sys.exit(1)
+    print(f'[{addr}:{port}] rogue server ready')
 
 def load_yml(addr, port, yml_file):
     """
@@ -252,9 +316,10 @@ def load_default_yml(addr, port, femb, cold):
         files.append(f'wib_cryo_config_ASIC_ExtClk_{cond}_asic{2*i+1}.yml')
     load_yml(addr, port, files)
 
-def is_rx_locked(addr, port, femb, timeout, min_locked_cnt=10):
+@wib_prof.timed()
+def rx_lock_status(addr, port, femb, timeout, min_locked_cnt=10):
     """
-    Check whether all lanes are locked. Get status every second.
+    Check the lanes of each FEMB. Get status every second.
     Required stable locked for multiple consecutive check.
 
     Parameters
@@ -269,10 +334,19 @@ def is_rx_locked(addr, port, femb, timeout, min_locked_cnt=10):
         timeout in seconds
     min_locked_cnt: int
         min good locked in a row
+
+    Returns
+    -------
+    locked: dict
+        {femb: True if all lanes are locked}
     """
 
     fembs = [femb] if isinstance(femb, int) else femb
 
+    # counters for consecutive locked state in a row, shared with _check.
+    # No lock: only _check writes, and it may be terminated at any time
+    cnts = Array('i', 4, lock=False)
+
     def _check(addr, port):
 
         pars = []
@@ -284,12 +358,11 @@ def is_rx_locked(addr, port, femb, timeout, min_locked_cnt=10):
             pars.append((f'{path}.gtRstVector', 0))
         rogue_set(addr, port, pars)
 
-        cnts = np.array([0, 0, 0, 0]) # counters for consecutive locked state in a row
         with SimpleClient(addr, port) as client:
             #for i in fembs:
             #    client.set(f'cryoAsicGen1.WibFembCryo.SspGtDecoderReg{i}.enable', True)
 
-            while cnts[fembs].min() < min_locked_cnt:
+            while min(cnts[i] for i in fembs) < min_locked_cnt:
                 for i in fembs:
                     ret = client.get(f'cryoAsicGen1.WibFembCryo.SspGtDecoderReg{i}.Locked')
 
@@ -297,13 +370,20 @@ def is_rx_locked(addr, port, femb, timeout, min_locked_cnt=10):
                         cnts[i] += 1
                     else:
                         cnts[i] = 0
-                time.sleep(1)
+                _sleep(1)
 
     p = Process(target=_check, args=(addr, port))
     p.start()
-    p.join(timeout=timeout)
+    p.join(timeout=timeout*TIME_SCALE)
     p.terminate()
-    return p.exitcode == 0
+    return {i: cnts[i] >= min_locked_cnt for i in fembs}
+
+def is_rx_locked(addr, port, femb, timeout, min_locked_cnt=10):
+    """
+    Check whether all lanes are locked (see `rx_lock_status`).
+    """
+
+    return all(rx_lock_status(addr, port, femb, timeout, min_locked_cnt).values())
 
 def reset_asic(addr, port, femb):
     fembs = [femb] if isinstance(femb, int) else femb
@@ -344,9 +424,16 @@ def toggle_sr0(addr, port):
         pars.append((path, True))
 
     rogue_set(addr, port, pars[:2])
-    time.sleep(10)
+    _sleep(10)
     rogue_set(addr, port, pars[:2])
 
+def _start_clk(addr, port):
+    clk(addr, port, True)
+    sr0(addr, port, True)
+    _sleep(5)
+    sr0(addr, port, False)
+    count_reset(addr, port)
+
 def enable_clk(addr, port, femb):
     RETRIES = 2
     TIMEOUT = 30
@@ -360,12 +447,7 @@ def enable_clk(addr, port, femb):
             print(f'[{addr}] Enabling clock, retry #{i}')
             clk(addr, port, False)
 
-        clk(addr, port, True)
-        sr0(addr, port, True)
-        time.sleep(5)
-        sr0(addr, port, False)
-        count_reset(addr, port)
-
+        _start_clk(addr, port)
         success = is_rx_locked(addr, port, fembs, timeout=TIMEOUT)
         i += 1
 
@@ -438,15 +520,131 @@ def init(addr, port, femb, cold):
     config_pll(addr, port)
     reset_asic(addr, port, femb)
     print('Wait for 30s ...')
-    time.sleep(30)
+    _sleep(30)
     load_default_yml(addr, port, femb, cold)
     print("Wait for 30s ...")
-    time.sleep(30)
+    _sleep(30)
     enable_clk(addr, port, femb)
     toggle_sr0(addr, port)
-    time.sleep(10)
+    _sleep(10)
     print(f'[{addr}:{port}] WIB-CRYO initialzed, is_cold={cold}')
 
+def _reset_femb(addr, port, femb, cold):
+    """
+    Reset and reload the ASICs of the given FEMB(s) only.
+    SampClkEn and SR0Polarity are shared by all FEMBs and cleared
+    by the reset and the yml, the clock has to be enabled again afterward.
+    """
+
+    fembs = [femb] if isinstance(femb, int) else femb
+
+    reset_asic(addr, port, fembs)
+    print('Wait for 30s ...')
+    _sleep(30)
+    load_default_yml(addr, port, fembs, cold)
+    print("Wait for 30s ...")
+    _sleep(30)
+
+def init_femb(addr, port, femb, cold):
+    """
+    Initialize FEMBs and track the rx lock of each FEMB.
+
+    The FEMBs failing to lock are retried with escalating actions:
+    toggle SR0, then reset and reload the failing FEMB(s). The clock is
+    shared, the good FEMBs are not reset but checked again after each
+    clock restart. Exit with 2 (1) if some (all) FEMBs failed.
+
+    Parameters
+    ----------
+    addr: str
+        WIB IP address
+    port: int
+        rogue port
+    femb: int or list(int)
+        FEMB number(s)
+    cold: bool
+        Use cold settings if True. Otherwise use room settings
+
+    Returns
+    -------
+    locked: dict
+        {femb: True if locked}
+    """
+
+    RETRIES = 2 # per action
+    TIMEOUT = 30
+    ACTIONS = ['toggle_sr0', 'reset_asic']
+    fembs = [femb] if isinstance(femb, int) else femb
+    if len(fembs) == 0:
+        print('init_femb: no FEMB given (--femb)', file=sys.stderr)
+        sys.exit(1)
+
+    config_pll(addr, port)
+    reset_asic(addr, port, fembs)
+    print('Wait for 30s ...')
+    _sleep(30)
+
+    # load each FEMB on its own, a bad one does not stop the others
+    locked = {i: False for i in fembs}
+    history = {i: [] for i in fembs}
+    active = []
+    for i in fembs:
+        try:
+            load_default_yml(addr, port, i, cold)
+            active.append(i)
+        except Exception as e:
+            print(f'[{addr}:{port}] FEMB{i}: failed to load yml, {e}', file=sys.stderr)
+            history[i].append('load_yml failed')
+    print("Wait for 30s ...")
+    _sleep(30)
+
+    print(f'[{addr}:{port}] Enabling clock')
+    if active:
+        _start_clk(addr, port)
+        locked.update(rx_lock_status(addr, port, active, timeout=TIMEOUT))
+
+    for action, n in itertools.product(ACTIONS, range(RETRIES)):
+        failing = [i for i in active if not locked[i]]
+        if len(failing) == 0:
+            break
+
+        print(f'[{addr}:{port}] FEMB {failing} not locked, {action} #{n+1}')
+        for i in failing:
+            history[i].append(action)
+
+        if action == 'toggle_sr0':
+            toggle_sr0(addr, port)
+            locked.update(rx_lock_status(addr, port, failing, timeout=TIMEOUT))
+        else:
+            _reset_femb(addr, port, failing, cold)
+            _start_clk(addr, port)
+            locked.update(rx_lock_status(addr, port, active, timeout=TIMEOUT))
+
+    if any(locked.values()):
+        toggle_sr0(addr, port)
+        _sleep(10)
+        # SR0 is shared, make sure the good FEMBs survived the retries
+        good = [i for i in active if locked[i]]
+        locked.update(rx_lock_status(addr, port, good, timeout=TIMEOUT))
+
+    print(f'[{addr}:{port}] init_femb summary, is_cold={cold}')
+    for i in fembs:
+        status = 'OK' if locked[i] else 'FAILED'
+        actions = ', '.join(history[i]) or '-'
+        print(f'    FEMB{i}: {status:<6} retries: {actions}')
+
+    nlocked = sum(locked.values())
+    if nlocked == len(fembs):
+        print(f'[{addr}:{port}] WIB-CRYO initialzed, is_cold={cold}')
+    elif nlocked > 0:
+        good = [i for i in fembs if locked[i]]
+        print(f'[{addr}:{port}] WIB-CRYO partially initialzed, FEMB {good}', file=sys.stderr)
+        sys.exit(2)
+    else:
+        print(f'[{addr}:{port}] Failed to lock rxLink', file=sys.stderr)
+        sys.exit(1)
+    return locked
+
 def count_reset(addr, port):
     cmd = ('root.CountReset', None)
     rogue_exec(addr, port, [cmd])
@@ -471,6 +669,361 @@ def disable_lane(addr, port, femb, lane, val):
     print(f'rx_mask: {hex(rx_mask)} for FEMB{femb}')
     print('you may need to modify rx_mask to include other FEMB(s)')
 
+SNAPSHOT_PATH = 'cryoAsicGen1.WibFembCryo'
+
+def _flatten(tree, prefix=''):
+    """
+    Flatten a nested dict to {'a.b.c': value}
+    """
+
+    output = {}
+    for key, val in tree.items():
+        path = f'{prefix}.{key}' if prefix else str(key)
+        if isinstance(val, dict):
+            output.update(_flatten(val, path))
+        else:
+            output[path] = val
+    return output
+
+def _get_yaml(client, path, **kwargs):
+    """
+    Node.getYaml(**kwargs) of `path` on the server.
+
+    SimpleClient has no public call for node methods (exec only runs
+    Commands with one argument), use the private _remoteAttr which sends
+    any attribute request. Needs rogue >= v4.0 (SimpleClient over zmq).
+    """
+
+    return client._remoteAttr(path, 'getYaml', **kwargs)
+
+def read_tree(client, path, modes=['RW']):
+    """
+    Bulk read of all variables under `path` in one request.
+
+    Parameters
+    ----------
+    client: SimpleClient
+        connected rogue client
+    path: str
+        rogue path of a device, e.g. cryoAsicGen1.WibFembCryo
+    modes: list of str
+        variable modes to read, 'RW', 'RO' and/or 'WO'
+
+    Returns
+    -------
+    values: dict
+        {full path: value}
+    """
+
+    text = _get_yaml(client, path, readFirst=True, modes=modes)
+    tree = yaml.safe_load(text) or {}
+    parent = path.rsplit('.', 1)[0] if '.' in path else ''
+    return _flatten(tree, parent)
+
+def _load_state(fpath):
+    """
+    Load a snapshot (json.gz) or a yml config file.
+    yml files have read-write variables only.
+    """
+
+    if fpath.endswith('.yml') or fpath.endswith('.yaml'):
+        with open(fpath) as f:
+            rw = _flatten(yaml.safe_load(f))
+        return dict(wib=None, time=None, path=None, rw=rw, ro={}, is_yml=True)
+
+    with gzip.open(fpath, 'rt') as f:
+        state = json.load(f)
+    state['is_yml'] = False
+    return state
+
+def _take_snapshot(addr, port, path):
+    with SimpleClient(addr, port) as client:
+        rw = read_tree(client, path, ['RW'])
+        ro = read_tree(client, path, ['RO'])
+
+    return dict(
+        wib=f'{addr}:{port}',
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        path=path,
+        rw=rw,
+        ro=ro,
+    )
+
+def _diff(a, b, keys=None):
+    """
+    Returns
+    -------
+    diff: list of (path, value in a, value in b)
+        `None` for missing values
+    """
+
+    if keys is None:
+        keys = list(a) + [k for k in b if k not in a]
+    return [(k, a.get(k), b.get(k)) for k in keys if a.get(k) != b.get(k)]
+
+def snapshot(addr, port, path, output):
+    """
+    Save all variables under `path` to a compressed json file.
+
+    Parameters
+    ----------
+    addr: str
+        WIB IP address
+    port: int
+        rogue port
+    path: str
+        rogue path of the subtree
+    output: str
+        output file, default: snapshot_{addr}_{YYYYmmdd-HHMMSS}.json.gz
+    """
+
+    t0 = time.time()
+    state = _take_snapshot(addr, port, path)
+
+    if output is None:
+        output = f'snapshot_{addr}_{time.strftime("%Y%m%d-%H%M%S")}.json.gz'
+    with gzip.open(output, 'wt') as f:
+        json.dump(state, f)
+
+    dt = time.time() - t0
+    print(f'[{addr}:{port}] {len(state["rw"])} RW + {len(state["ro"])} RO variables'
+          f' from {path} saved to {output} ({dt:.2f}s)')
+
+def diff(addr, port, files, ro):
+    """
+    Compare two snapshots or yml files, or one of them to the current
+    state of the WIB. Only the variables in a yml file are compared.
+
+    Parameters
+    ----------
+    addr: str
+        WIB IP address (if only one file is given)
+    port: int
+        rogue port
+    files: list of str
+        one or two snapshot/yml files
+    ro: bool
+        also compare read-only variables
+    """
+
+    if len(files) > 2:
+        print('diff: at most two files', file=sys.stderr)
+        sys.exit(1)
+
+    states = [_load_state(f) for f in files]
+    names = list(files)
+    if len(states) == 1:
+        path = states[0]['path'] or SNAPSHOT_PATH
+        states.append(_take_snapshot(addr, port, path))
+        names.append(f'{addr}:{port}')
+
+    a, b = states
+    if a.get('is_yml') or b.get('is_yml'):
+        # compare variables of the yml file under the snapshot path only
+        yml, snap = (a, b) if a.get('is_yml') else (b, a)
+        path = snap['path'] or SNAPSHOT_PATH
+        keys = [k for k in yml['rw'] if k.startswith(path + '.')]
+        values = {**snap['ro'], **snap['rw']}
+        va, vb = (yml['rw'], values) if yml is a else (values, yml['rw'])
+        output = _diff(va, vb, keys)
+    else:
+        output = _diff(a['rw'], b['rw'])
+        if ro:
+            output += _diff(a['ro'], b['ro'])
+
+    print(f'--- {names[0]} {a["time"] or ""}')
+    print(f'+++ {names[1]} {b["time"] or ""}')
+    for path, val_a, val_b in output:
+        print(f'{path}: {val_a} -> {val_b}')
+    print(f'{len(output)} difference(s)')
+
+def restore(addr, port, snap):
+    """
+    Restore a snapshot. Read the current state in bulk and
+    only write the read-write variables that differ.
+
+    Parameters
+    ----------
+    addr: str
+        WIB IP address
+    port: int
+        rogue port
+    snap: str
+        snapshot (json.gz) or yml file
+    """
+
+    state = _load_state(snap)
+    path = state['path'] or SNAPSHOT_PATH
+
+    t0 = time.time()
+    with SimpleClient(addr, port) as client:
+        current = read_tree(client, path, ['RW'])
+        keys = [k for k in state['rw'] if k in current]
+        output = _diff(state['rw'], current, keys)
+
+        for var, val, __ in output:
+            print(f'[{addr}:{port}] set {var} <- {val}')
+            if isinstance(val, str):
+                client.setDisp(var, val)
+            else:
+                client.set(var, val)
+
+    dt = time.time() - t0
+    print(f'[{addr}:{port}] restored {len(output)} of {len(keys)} variables'
+          f' from {snap} ({dt:.2f}s)')
+
+def _parse_value(x):
+    """
+    Parse a register value from command line: int, bool or str.
+    """
+
+    try:
+        return int(x, 0)
+    except ValueError:
+        pass
+
+    if x.lower() in ['true', 'false']:
+        return x.lower() == 'true'
+    return x
+
+def _sweep_points(vals, grid):
+    """
+    List of sweep points from ASIC settings and register grids.
+
+    Parameters
+    ----------
+    vals: list of int
+        values for WriteColData
+    grid: list of str
+        'PATH=V1,V2,...', path relative to cryoAsicGen1.WibFembCryo
+
+    Returns
+    -------
+    points: list of (name, val, pars)
+        output folder name, WriteColData value (or `None`),
+        list of (path, value) to set
+    """
+
+    axes = []
+    for item in grid:
+        path, values = item.split('=')
+        if not path.startswith('cryoAsicGen1'):
+            path = f'cryoAsicGen1.WibFembCryo.{path}'
+        axes.append([(path, _parse_value(v)) for v in values.split(',')])
+
+    points = []
+    for val, *pars in itertools.product(vals or [None], *axes):
+        tags = [] if val is None else [hex(val)]
+        for path, v in pars:
+            disp_v = hex(v) if isinstance(v, int) else v
+            tags.append(f'{path.split(".")[-1]}-{disp_v}')
+        points.append(('_'.join(['WIB'] + tags), val, pars))
+    return points
+
+def _sweep_title(outdir):
+    # same as wib_plot2, e.g. SN03/Cold/T2 -> WIB_FEMB_SN03_T2_Cold
+    from wib_batch import round_title
+    return round_title(outdir)
+
+def _sweep_analyze(path, title, cold, plotdir):
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    import wib_plot
+
+    funcs = wib_plot.plots_for(os.path.basename(path))
+    if len(funcs) == 0:
+        funcs = [wib_plot.plot_psd, wib_plot.plot_mcorr, wib_plot.plot_std]
+    wib_plot.process(path, title, funcs, cold=cold, outdir=plotdir,
+                     golden=os.environ.get('WIB_GOLDEN'),
+                     lines=os.environ.get('WIB_LINES'), fs=1e6/0.512)
+
+def sweep(addr, port, femb, asic, vals, grid, nevents, outdir, buf, workers, cold):
+    """
+    Configure, acquire and analyze a list of settings in one process.
+    The analysis of point k runs in a process pool while point k+1 is
+    configured and acquired.
+
+    Parameters
+    ----------
+    addr: str
+        WIB IP address
+    port: int
+        rogue port
+    femb, asic: list of int
+        FEMBs/ASICs for WriteColData
+    vals: list of int
+        ASIC settings for WriteColData, e.g. [0x390, 0x391]
+    grid: list of str
+        register grids 'PATH=V1,V2,...'
+    nevents: int
+        number of events per point
+    outdir: str
+        output directory, data saved in OUTDIR/WIB_<setting>
+    buf: int
+        read only one buffer (0 or 1), both if `None`
+    workers: int
+        number of analysis processes
+    cold: bool
+        cold condition (for plot titles)
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    from wib_daq import record, get_daq_kwargs
+    from wib import WIB
+
+    points = _sweep_points(vals, grid)
+    if len(points) == 0 or (len(grid) == 0 and not _get_asic_from(femb, asic)):
+        print('sweep: nothing to do, check --femb/--asic/--val/--grid', file=sys.stderr)
+        sys.exit(1)
+
+    outdir = os.path.expanduser(outdir)
+    os.makedirs(outdir, exist_ok=True)
+    title = _sweep_title(outdir)
+    plotdir = f'{time.strftime("%Y-%m-%d")}_{title}'
+    os.makedirs(plotdir, exist_ok=True)
+
+    wib = WIB(addr)
+    daq_kwargs = get_daq_kwargs(buf)
+
+    t0 = time.time()
+    t_daq = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for name, val, pars in points:
+            path = os.path.join(outdir, name)
+            if os.path.exists(path):
+                print(f'sweep: {path} already exist, skipped')
+                continue
+
+            print(f'[{addr}:{port}] sweep point {name}')
+            t1 = time.time()
+            if val is not None:
+                config_asic(addr, port, femb, asic, val)
+            if pars:
+                rogue_set(addr, port, pars)
+
+            os.makedirs(path)
+            if not record(wib, path, nevents, **daq_kwargs):
+                failed.append(name)
+                break
+            t_daq += time.time() - t1
+
+            futures.append((name, pool.submit(_sweep_analyze, path, title, cold, plotdir)))
+
+        for name, future in futures:
+            try:
+                future.result()
+            except BaseException as e:
+                print(f'sweep: analysis of {name} failed ({e})', file=sys.stderr)
+                failed.append(name)
+
+    dt = time.time() - t0
+    print(f'sweep: {len(points)} points in {dt:.1f}s'
+          f' (configure + acquire {t_daq:.1f}s), plots in {plotdir}')
+    if failed:
+        print(f'sweep: failed {failed}', file=sys.stderr)
+        sys.exit(1)
+
 def _bind(parser, func, **kwargs):
     """
     Bind parser to a function.
@@ -519,6 +1072,37 @@ def _bind(parser, func, **kwargs):
         elif arg == 'val':
             p.add_argument('--val', type=lambda x: int(x,0),
                     required=True, help='value to set')
+        elif arg == 'vals':
+            p.add_argument('--val', dest='vals', metavar='VAL', type=lambda x: int(x,0),
+                    default=[], nargs='+', help='value(s) to sweep')
+        elif arg == 'grid':
+            p.add_argument('--grid', default=[], nargs='+', metavar='PATH=V1,V2',
+                    help='register grid(s), path relative to cryoAsicGen1.WibFembCryo')
+        elif arg == 'nevents':
+            p.add_argument('-n', '--nevents', type=int, default=10,
+                    help='number of events, default=10')
+        elif arg == 'outdir':
+            p.add_argument('-o', '--outdir', required=True,
+                    help='output directory')
+        elif arg == 'buf':
+            p.add_argument('--buf', type=int, choices=[0,1],
+                    help='read only 1 buffer, default=0,1')
+        elif arg == 'workers':
+            p.add_argument('--workers', type=int, default=2,
+                    help='number of analysis processes, default=2')
+        elif arg == 'path':
+            p.add_argument('--path', default=SNAPSHOT_PATH,
+                    help=f'rogue path, default={SNAPSHOT_PATH}')
+        elif arg == 'output':
+            p.add_argument('-o', '--output', help='output file')
+        elif arg == 'snap':
+            p.add_argument('snap', help='snapshot (json.gz) or yml file')
+        elif arg == 'files':
+            p.add_argument('files', nargs='+', metavar='FILE',
+                    help='snapshot (json.gz) or yml file(s)')
+        elif arg == 'ro':
+            p.add_argument('--ro', action='store_true',
+                    help='include read-only variables')
         elif arg == 'yml_file':
             p.add_argument('-f', '--yml_file', nargs='+',
                     help='YML file path relative to /etc/wib/yml on the WIB')
@@ -566,10 +1150,12 @@ def main():
     parser = argparse.ArgumentParser(description='WIB Cryo')
     parser.add_argument('-w', dest='wib', metavar='ip:<port>',
                         help='wib ip address')
+    parser.add_argument('--profile', action='store_true',
+                        help='write profile and timers (see wib_prof.py)')
     subparsers = parser.add_subparsers()
 
     _bind(subparsers, load_default_yml, aliases=['load'])
-    _bind(subparsers, load_yml, aliases=['load'])
+    _bind(subparsers, load_yml)
     _bind(subparsers, clk)
     _bind(subparsers, toggle_clk)
     _bind(subparsers, sr0)
@@ -583,8 +1169,14 @@ def main():
     _bind(subparsers, enable_trigger)
     _bind(subparsers, disable_trigger)
     _bind(subparsers, init)
+    _bind(subparsers, init_femb)
     _bind(subparsers, count_reset)
+    _bind(subparsers, start_server)
     _bind(subparsers, disable_lane)
+    _bind(subparsers, sweep)
+    _bind(subparsers, snapshot)
+    _bind(subparsers, diff)
+    _bind(subparsers, restore)
     _bind(subparsers, version)
     _bind(subparsers, usage, aliases=['help'])
 
@@ -593,9 +1185,11 @@ def main():
     if args.func is None:
         args.func = usage
 
+    wib_prof.start('wib_cryo', args.profile)
     kwargs = vars(args).copy()
     kwargs.pop('wib')
     kwargs.pop('func')
+    kwargs.pop('profile')
     kwargs['addr'] = addr
     kwargs['port'] = port
 
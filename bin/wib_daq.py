@@ -6,28 +6,333 @@ import sys
 import numpy as np
 from pathlib import Path
 
-from wib_cryo import get_addr_port
-from wib import WIB
+import wib_prof
 
 import argparse
 parser = argparse.ArgumentParser(description='WIB Cryo DAQ')
 parser.add_argument('-w', dest='wib', metavar='ip', help='wib ip address')
 parser.add_argument('-o', '--outdir', metavar='output_directory', help='store data')
-parser.add_argument('-n', '--nevents', metavar='num_of_events', 
+parser.add_argument('-n', '--nevents', metavar='num_of_events',
                     type=int, default=10,
                     help='(optinal) default=10')
 parser.add_argument('--buf', metavar='BUFFER',
                     type=int, choices=[0,1],
                     help='(optional) read only 1 buffer. default=0,1')
+parser.add_argument('--fake', action='store_true',
+                    help='(optional) use simulated data instead of a WIB')
+parser.add_argument('--replay', metavar='DIRECTORY',
+                    help='(optional) replay recorded events instead of a WIB')
+parser.add_argument('--rate', type=float,
+                    help='(optional) target rate in Hz for --fake/--replay')
+parser.add_argument('--qc', choices=['off', 'tag', 'drop'], default='off',
+                    help='(optional) quality check of each event: tag bad events'
+                         ' (saved with quality flags) or drop them. default=off')
+parser.add_argument('--qc-stop', metavar='N', type=int,
+                    help='(optional) stop after N bad events in a row, 0 to never stop'
+                         ' (not with --qc drop). default=0, 20 with --qc drop')
+parser.add_argument('--max-stuck', type=int, default=4,
+                    help='(optional) max. stuck channels per event, default=4')
+parser.add_argument('--max-saturated', type=int, default=4,
+                    help='(optional) max. saturated (0/4095) channels per event, default=4')
+parser.add_argument('--max-drift', type=float, default=30.,
+                    help='(optional) max. pedestal drift [ADC] of a FEMB'
+                         ' w.r.t. the first event, default=30')
+parser.add_argument('--profile', action='store_true',
+                    help='(optional) write profile and timers (see wib_prof.py)')
+parser.add_argument('--shm', metavar='NAME', nargs='?', const='wib_live',
+                    help='(optional) publish the recent events to a shared-memory ring'
+                         ' for wib_dash.py (see wib_shm.py). default name=wib_live')
+parser.add_argument('--trigger', action='store_true',
+                    help='(optional) arm the trigger and average the pulses'
+                         ' (<outdir>_pulse_avg.npz, see wib_pulse.py), raw events are not saved')
+parser.add_argument('--pulse-period', metavar='SAMPLES', type=int,
+                    help='(optional) pulser period for --trigger, estimated if not given')
+parser.add_argument('--save-raw', action='store_true',
+                    help='(optional) also save the raw events with --trigger')
 
-if __name__ == '__main__':
+# quality flags (bit mask saved as `quality` in the npz)
+QC_DEAD = 0x1       # FEMB active in the first event without data
+QC_STUCK = 0x2      # too many channels with a constant value
+QC_SATURATED = 0x4  # too many channels with 0 or 4095 samples
+QC_TIMESTAMP = 0x8  # timestamp gaps, duplicates or missing timestamps
+QC_DRIFT = 0x10     # pedestal drift w.r.t. the first event
+QC_NAMES = {QC_DEAD: 'dead', QC_STUCK: 'stuck', QC_SATURATED: 'saturated',
+            QC_TIMESTAMP: 'timestamp', QC_DRIFT: 'drift'}
+
+class QualityGate:
+    """
+    Per-event data quality check, vectorized to keep up with the acquisition.
+
+    The first event with data is the reference for the active FEMBs,
+    the timestamp step and the pedestals.
+
+    Parameters
+    ----------
+    max_stuck: int
+        max. number of stuck channels (constant value)
+    max_saturated: int
+        max. number of saturated channels
+    max_drift: float
+        max. pedestal drift [ADC], median of the channels of a FEMB
+    sat_frac: float
+        fraction of 0 or 4095 samples for a saturated channel
+    """
+
+    def __init__(self, max_stuck=4, max_saturated=4, max_drift=30., sat_frac=0.01):
+        self.max_stuck = max_stuck
+        self.max_saturated = max_saturated
+        self.max_drift = max_drift
+        self.sat_frac = sat_frac
+
+        self.active = None
+        self.step = None
+        self.ped = None
+
+        self.nevents = 0
+        self.nbad = 0
+        self.counts = {flag: 0 for flag in QC_NAMES}
+
+    def check(self, ts, data):
+        """
+        Check one event.
+
+        Parameters
+        ----------
+        ts: (2, n) array
+            timestamps of buf0 and buf1
+        data: (4, 128, n) array
+            ADC samples
+
+        Returns
+        -------
+        flags: int
+            bit mask of QC_* (0 for a good event)
+        info: dict
+            number of stuck/saturated channels, timestamp errors,
+            max. pedestal drift and active FEMBs
+        """
+
+        data = np.asarray(data)
+        ts = np.asarray(ts).astype(np.int64)
+        n = data.shape[-1]
+
+        is_active = np.any(data, axis=(1,2))
+        lo = data.min(axis=-1)
+        hi = data.max(axis=-1)
+        nsat = np.count_nonzero((data == 0) | (data == 4095), axis=-1)
+        mean = data.mean(axis=-1, dtype=np.float32)
+
+        if self.active is None and is_active.any():
+            self.active = is_active
+            self.ped = mean
+            self.step = [int(np.median(np.diff(t))) if n > 1 else 0 for t in ts]
+        active = self.active if self.active is not None else is_active
+
+        info = dict(
+            fembs=np.where(is_active)[0].tolist(),
+            stuck=int(np.count_nonzero((lo == hi)[active & is_active])),
+            saturated=int(np.count_nonzero((nsat > self.sat_frac * n)[active & is_active])),
+            ts_errors=0,
+            drift=0.,
+        )
+
+        # buf0 <-> FEMB0-1, buf1 <-> FEMB2-3
+        for b in range(2):
+            if not active[2*b:2*b+2].any():
+                continue
+            dt = np.diff(ts[b])
+            if not np.any(ts[b]):
+                info['ts_errors'] += n
+            elif self.step[b] > 0:
+                info['ts_errors'] += int(np.count_nonzero(dt != self.step[b]))
+
+        if self.ped is not None and (active & is_active).any():
+            drift = np.median((mean - self.ped)[active & is_active], axis=-1)
+            info['drift'] = float(np.abs(drift).max())
+
+        flags = 0
+        if (active & ~is_active).any():
+            flags |= QC_DEAD
+        if info['stuck'] > self.max_stuck:
+            flags |= QC_STUCK
+        if info['saturated'] > self.max_saturated:
+            flags |= QC_SATURATED
+        if info['ts_errors'] > 0:
+            flags |= QC_TIMESTAMP
+        if info['drift'] > self.max_drift:
+            flags |= QC_DRIFT
+
+        self.nevents += 1
+        if flags:
+            self.nbad += 1
+            for flag in self.counts:
+                if flags & flag:
+                    self.counts[flag] += 1
+        return flags, info
+
+    def summary(self):
+        counts = ', '.join(f'{QC_NAMES[k]} {v}' for k, v in self.counts.items())
+        return (f'{self.nevents} events, {self.nevents-self.nbad} good,'
+                f' {self.nbad} bad ({counts})')
+
+def _flag_names(flags):
+    return '|'.join(name for flag, name in QC_NAMES.items() if flags & flag)
+
+def get_daq_kwargs(buf=None):
+    """
+    Keyword arguments of `acquire_data` to read one or both buffers.
+
+    Parameters
+    ----------
+    buf: int, optional
+        buffer number (0 or 1), read both if `None`
+    """
+
+    daq_kwargs = {}
+    if buf == 0:
+        daq_kwargs['buf1'] = False
+    elif buf == 1:
+        daq_kwargs['buf0'] = False
+    return daq_kwargs
+
+def record(wib, outpath, nevents, gate=None, mode='tag', stop_after=0,
+           interval=2., shm=None, pulse=None, save=True, **daq_kwargs):
+    """
+    Take snapshots from spy buffer and save each event to
+    `outpath/event_{i:05}.npz`
+
+    With a quality `gate`, bad events are saved with their `quality` flags
+    (`mode='tag'`) or not saved (`mode='drop'`, acquire until `nevents`
+    good events). The run stops after `stop_after` bad events in a row.
+    With `shm`, every event is also published to a shared-memory ring
+    (removed at the end of the run).
+    With `pulse`, the good events are folded into the pulse average.
+
+    Parameters
+    ----------
+    wib: WIB or a simulated source (see wib_sim.py)
+        data source with `acquire_data`
+    outpath: str
+        output directory (must exist)
+    nevents: int
+        number of events
+    gate: QualityGate, optional
+        per-event quality check, no check if `None`
+    mode: str
+        'tag' or 'drop' bad events
+    stop_after: int
+        max. bad events in a row, 0 for no limit (only with `mode='tag'`,
+        a source giving only bad events would never end in drop mode)
+    interval: float
+        seconds between quality summaries
+    shm: str, optional
+        name of the shared-memory ring (see wib_shm.py)
+    pulse: wib_pulse.PulseAverager, optional
+        pulse-synchronous average
+    save: bool
+        save the events, `False` to keep only the pulse average
+    daq_kwargs: dict
+        keyword arguments for `acquire_data`
+
+    Returns
+    -------
+    success: bool
+    """
+
+    if gate is not None and mode == 'drop' and stop_after <= 0:
+        raise ValueError('drop mode needs stop_after > 0')
+
+    i = 0
+    nbad_row = 0
+    ring = None
+    t_print = time.time()
+    try:
+        while i < nevents:
+            outfile = os.path.join(outpath, f'event_{i:05}')
+            try:
+                with wib_prof.timer('acquire_data'):
+                    ts, data = wib.acquire_data(**daq_kwargs)
+            except:
+                print('Fail to get data from spy buffer')
+                return False
+
+            # 12-bit ADC samples are stored as uint16
+            data = np.asarray(data, dtype=np.uint16)
+            with wib_prof.timer('quality'):
+                flags, info = (0, None) if gate is None else gate.check(ts, data)
+
+            if shm is not None:
+                if ring is None:
+                    # sized from the first event, spy buffer length varies slightly
+                    from wib_shm import ShmWriter
+                    ring = ShmWriter(shm, nsamples=data.shape[-1] + 64)
+                ring.publish(ts, data, flags)
+
+            if flags:
+                nbad_row += 1
+                print(f'[qc] event {gate.nevents-1}: {_flag_names(flags)} {info}')
+            else:
+                nbad_row = 0
+                if pulse is not None:
+                    with wib_prof.timer('pulse'):
+                        pulse.add(ts, data)
+
+            if not flags or mode == 'tag':
+                if save:
+                    quality = {} if gate is None else dict(quality=flags)
+                    with wib_prof.timer('savez_compressed'):
+                        np.savez_compressed(outfile, timestamps=ts, data=data, **quality)
+                i += 1
+
+            if time.time() - t_print > interval:
+                if gate is not None:
+                    print(f'[qc] {gate.summary()}', flush=True)
+                if pulse is not None:
+                    print(f'[pulse] {pulse.nevents} events, {pulse.npulses} pulses', flush=True)
+                t_print = time.time()
+
+            if stop_after > 0 and nbad_row >= stop_after:
+                print(f'[qc] {nbad_row} bad events in a row, stop')
+                print(f'[qc] {gate.summary()}')
+                return False
+    finally:
+        # readers reopen a new ring, don't leave this one in /dev/shm
+        if ring is not None:
+            ring.close(unlink=True)
+
+    if gate is not None:
+        print(f'[qc] {gate.summary()}')
+    return True
+
+def main():
     args = parser.parse_args()
-    addr, __ = get_addr_port(args.wib)
-    
+    wib_prof.start('wib_daq', args.profile)
+
+    if args.qc_stop is None:
+        args.qc_stop = 20 if args.qc == 'drop' else 0
+    elif args.qc == 'drop' and args.qc_stop <= 0:
+        print('--qc drop needs --qc-stop > 0', file=sys.stderr)
+        sys.exit(1)
+
+    if args.fake:
+        from wib_sim import FakeWIB
+        addr = 'FakeWIB'
+        # pulser on (ASIC setting 0x391) for --trigger
+        wib = FakeWIB(rate=args.rate, setting=0x391 if args.trigger else None)
+    elif args.replay:
+        from wib_sim import ReplayWIB
+        addr = args.replay
+        wib = ReplayWIB(args.replay, cadence=args.rate is None, rate=args.rate)
+    else:
+        from wib_cryo import get_addr_port
+        from wib import WIB
+        addr, port = get_addr_port(args.wib)
+        wib = None
+
     if args.outdir is None:
         now = int(time.time())
         args.outdir = f'wib_spy_buffer-{now}'
-    
+
     outpath = Path(args.outdir).expanduser()
     if os.path.isdir(outpath):
         print(f'ERROR: {outpath} already exsist')
@@ -37,25 +342,44 @@ if __name__ == '__main__':
     print(f'acquring {args.nevents} events from {addr}')
     print(f'saving output to {outpath}')
 
-    wib = WIB(addr)
+    if wib is None:
+        wib = WIB(addr)
 
-    daq_kwargs = {}
-    if args.buf == 0:
-        daq_kwargs['buf1'] = False
-    elif args.buf == 1:
-        daq_kwargs['buf0'] = False
+    daq_kwargs = get_daq_kwargs(args.buf)
+    gate = None
+    if args.qc != 'off':
+        gate = QualityGate(args.max_stuck, args.max_saturated, args.max_drift)
+
+    pulse = None
+    if args.trigger:
+        from wib_pulse import PulseAverager
+        pulse = PulseAverager(args.pulse_period)
+        if args.fake or args.replay:
+            print('no trigger to arm for a simulated source')
+        else:
+            from wib_cryo import enable_trigger
+            enable_trigger(addr, port)
+
+    try:
+        success = record(wib, outpath, args.nevents, gate=gate, mode=args.qc,
+                         stop_after=args.qc_stop, shm=args.shm, pulse=pulse,
+                         save=pulse is None or args.save_raw, **daq_kwargs)
+    finally:
+        if args.trigger and not (args.fake or args.replay):
+            from wib_cryo import disable_trigger
+            disable_trigger(addr, port)
 
-    for i in range(args.nevents):
-        outfile = os.path.join(outpath, f'event_{i:05}')
-        try:
-            ts, data = wib.acquire_data(**daq_kwargs)
-        except:
-            print('Fail to get data from spy buffer')
-            sys.exit(1)
+    if pulse is not None:
+        # next to the run, the events directory holds only events
+        output = f'{outpath}_pulse_avg.npz'
+        if pulse.save(output):
+            print(f'[pulse] {pulse.nevents} events, {pulse.npulses} pulses saved to {output}')
 
-        np.savez_compressed(outfile,
-                            timestamps=ts,
-                            data=data)
+    if not success:
+        sys.exit(1)
 
     print(f'DONE')
     sys.exit(0)
+
+if __name__ == '__main__':
+    main()
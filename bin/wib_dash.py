@@ -11,37 +11,570 @@ import dash_bootstrap_components as dbc
 from dash_bootstrap_templates import load_figure_template
 
 
-from flask_caching import Cache
-
 import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
+import os
+import sys
 import time
+import uuid
+import threading
+from collections import deque
 from scipy.signal import periodogram
+from scipy import fft as sp_fft
 import argparse
 
-class FakeWIB:
+from wib_sim import FakeWIB, ReplayWIB
+from wib_shm import ShmWIB
+from wib_store import BundleStore, OwnerLock, wib_id, read_json, write_json, update_json
+import wib_prof
+
+class AcqWorker(threading.Thread):
+    """
+    Background acquisition from one WIB connection.
+
+    Keep capturing spy buffer snapshots at `rate` (in Hz) while live,
+    or one at a time on `request()`. Recent events are kept in a small ring.
+
+    Parameters
+    ----------
+    factory: callable
+        return a WIB-like object with `acquire_data(**kwargs)`,
+        called once in the worker thread
+    daq_kwargs: dict
+        keyword arguments for `acquire_data`, e.g. buf0/buf1
+    rate: float
+        target acquisition rate in live mode
+    nkeep: int
+        number of recent events to keep
+    post: callable, optional
+        post-processing `post(ts, data)` run in the worker thread,
+        its output is kept instead of the raw `(ts, data)`
+    """
+
+    def __init__(self, factory, daq_kwargs=None, rate=1., nkeep=8, post=None):
+        super().__init__(daemon=True)
+        self.rate = rate
+        self.error = None
+        self._factory = factory
+        self._kwargs = dict(daq_kwargs or {})
+        self._post = post
+        self._events = deque(maxlen=nkeep)
+        self._t_acq = deque(maxlen=16)
+        self._seq = 0
+        self._live = False
+        self._pending = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._halt = threading.Event()
+
+    def run(self):
+        try:
+            wib = self._factory()
+        except Exception as e:
+            self.error = f'cannot connect ({e})'
+            return
+
+        t_next = time.time()
+        while not self._halt.is_set():
+            if not (self._live or self._pending):
+                self._wake.wait(0.5)
+                self._wake.clear()
+                t_next = time.time()
+                continue
+
+            # throttle live mode to the requested rate
+            if not self._pending:
+                dt = t_next - time.time()
+                if dt > 0:
+                    self._wake.wait(dt)
+                    self._wake.clear()
+                    continue
+
+            self._pending = False
+            t_next = time.time() + 1. / max(self.rate, 1e-3)
+            try:
+                with wib_prof.timer('acquire_data'):
+                    ts, data = wib.acquire_data(**self._kwargs)
+            except Exception as e:
+                self.error = f'spy buffer ({e})' if str(e) else 'spy buffer'
+                continue
+
+            self.error = None
+            now = time.time()
+            output = (ts, data) if self._post is None else self._post(ts, data)
+            with self._lock:
+                self._seq += 1
+                self._events.append((self._seq, now, output))
+                self._t_acq.append(now)
+
+    @property
+    def live(self):
+        return self._live
+
+    @live.setter
+    def live(self, flag):
+        self._live = bool(flag)
+        self._wake.set()
+
+    def request(self):
+        """Request a single acquisition (non-blocking)."""
+        self._pending = True
+        self._wake.set()
+
+    def stop(self):
+        self._halt.set()
+        self._wake.set()
+
+    def latest(self):
+        """
+        Returns
+        -------
+        (seq, time, output) of the latest event, or `None` if no event yet
+        """
+        with self._lock:
+            return self._events[-1] if self._events else None
+
+    def acq_rate(self):
+        """Measured acquisition rate in Hz over the recent captures."""
+        with self._lock:
+            t = list(self._t_acq)
+        if len(t) < 2:
+            return 0.
+
+        period = (t[-1] - t[0]) / (len(t) - 1)
+        if time.time() - t[-1] > 2 * period + 1:
+            return 0.
+        return 1. / period
+
+# Sources and store, shared by the server processes (see wib_store.py):
+# each WIB source is acquired by the process holding its lock, the bundles
+# go to the store and any process serves them.
+IDLE = 30.          # stop acquiring after seconds without a watching session
+_store = None
+_manager = None
+_sources = {}       # wib id -> _Source owned by this process
+_init_lock = threading.Lock()
+
+def _factory(wib_type, wib_src):
+    if wib_type in ['WIB', 'Replay'] and not wib_src:
+        return None
+    if wib_type == 'WIB':
+        from wib import WIB
+        return lambda: WIB(wib_src)
+    if wib_type == 'FakeWIB':
+        return FakeWIB
+    if wib_type == 'Replay':
+        return lambda: ReplayWIB(wib_src, cadence=False)
+    if wib_type == 'Live':
+        # events published by a running wib_daq.py, no access to the WIB
+        return lambda: ShmWIB(wib_src or None)
+    return None
+
+class _Source:
+    """
+    Acquisition from one WIB source in the process owning it.
+
+    Requests from any process are read from `control.json`, the latest
+    bundle and the running averages are written to the store, the
+    worker state to `status.json`.
+    """
+
+    def __init__(self, store, wid, key, lock):
+        wib_type, wib_src, buf = key
+        self.store = store
+        self.wid = wid
+        self.lock = lock
+        self.acc = Accumulator()
+
+        kwargs = {}
+        if buf == 'buf0':
+            kwargs['buf1'] = False
+        elif buf == 'buf1':
+            kwargs['buf0'] = False
+        self.worker = AcqWorker(_factory(wib_type, wib_src), kwargs, post=self._post)
+
+        # apply requests made just before this process took over
+        self._request = self._reset = time.time() - 5
+        self._mtime = None
+        self._avg_count = 0
+
+    def _post(self, ts, data):
+        bundle = _process(ts, data)
+        self.acc.add(bundle)
+        with wib_prof.timer('store'):
+            self.store.put(f'{self.wid}/latest', bundle)
+
+    def start(self):
+        self.worker.start()
+        return self
+
+    def stop(self):
+        self.worker.stop()
+        self.lock.release()
+
+    def sync(self, average):
+        """
+        Apply the new requests, write the averages if watched and the status.
+        """
+
+        path = self.store.path(self.wid, 'control.json')
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            control = read_json(path, {})
+            if control.get('rate'):
+                self.worker.rate = float(control['rate'])
+            self.worker.live = control.get('live', False)
+            self.acc.nmax = int(control.get('avg_n') or 0)
+            if control.get('reset', 0) > self._reset:
+                self._reset = control['reset']
+                self.acc.reset()
+            if control.get('request', 0) > self._request:
+                self._request = control['request']
+                self.worker.request()
+
+        count = self.acc.count
+        if average and count != self._avg_count:
+            avg = self.acc.bundle()
+            if avg is not None:
+                with wib_prof.timer('store'):
+                    self.store.put(f'{self.wid}/avg', avg)
+            self._avg_count = count
+
+        event = self.worker.latest()
+        write_json(self.store.path(self.wid, 'status.json'), dict(
+            pid=os.getpid(),
+            seq=event[0] if event else 0,
+            time=event[1] if event else None,
+            error=self.worker.error,
+            acq_rate=self.worker.acq_rate(),
+            avg_count=count,
+            avg_nevents=self.acc.nevents,
+            avg_seq=self._avg_count if average else None,
+        ))
+
+class _Manager(threading.Thread):
+    """
+    Take over the watched WIB sources without owner, keep the owned ones
+    in sync and evict the store.
+    """
+
+    def __init__(self, store, interval=0.2, evict_interval=5.):
+        super().__init__(daemon=True)
+        self.store = store
+        self.interval = interval
+        self.evict_interval = evict_interval
+        self._locks = {}
+
+    def _cycle(self):
+        leases = self.store.sessions(IDLE).values()
+        watched = {}
+        for lease in leases:
+            watched[lease['wib']] = watched.get(lease['wib'], False) or lease.get('average', False)
+
+        for wid in list(_sources):
+            if wid not in watched:
+                print(f'[dash] {wid} not watched, stop', flush=True)
+                _sources.pop(wid).stop()
+
+        for wid, average in watched.items():
+            src = _sources.get(wid)
+            if src is None:
+                key = read_json(self.store.path(wid, 'key.json'))
+                if key is None or _factory(key[0], key[1]) is None:
+                    continue
+                lock = self._locks.setdefault(wid, OwnerLock(self.store.path(wid, 'owner.lock')))
+                if not lock.acquire():
+                    continue
+                print(f'[dash] acquiring {wid} {key}, pid={os.getpid()}', flush=True)
+                src = _sources[wid] = _Source(self.store, wid, key, lock).start()
+            src.sync(average)
+
+    def run(self):
+        t_evict = 0
+        while True:
+            try:
+                self._cycle()
+                if time.time() - t_evict > self.evict_interval:
+                    self.store.evict()
+                    t_evict = time.time()
+            except Exception as e:
+                print(f'[dash] {e}', file=sys.stderr, flush=True)
+            time.sleep(self.interval)
+
+def _get_store():
+    """
+    Store of this process, the manager is started on first use
+    (after the server forked its workers).
+    """
+
+    global _store, _manager
+    with _init_lock:
+        if _manager is None or _manager.pid != os.getpid():
+            _sources.clear()
+            _store = BundleStore(
+                max_bytes=int(float(os.environ.get('WIB_DASH_STORE_MB', 1024)) * 1024**2),
+                max_age=float(os.environ.get('WIB_DASH_STORE_AGE', 600)))
+            _manager = _Manager(_store)
+            _manager.pid = os.getpid()
+            _manager.start()
+    return _store
+
+def _wib_key(wib_type, wib_src, buf):
+    return [wib_type, wib_src or '', buf]
+
+def _control(key, session, average, create=True, **kwargs):
+    """
+    Send a request to the process acquiring from the WIB source.
+
+    Returns
+    -------
+    sent: bool
+        `False` if the source does not exist and `create` is `False`
+    """
+
+    store = _get_store()
+    wid = wib_id(key)
+    if not os.path.exists(store.path(wid, 'key.json')):
+        if not create:
+            return False
+        os.makedirs(store.path(wid), exist_ok=True)
+        write_json(store.path(wid, 'key.json'), key)
+    update_json(store.path(wid, 'control.json'), **kwargs)
+    store.touch_session(session, wid, average=average)
+    return True
+
+def _hist(x):
+    """
+    Histograms with unit bin size along the last axis, in one pass.
+
+    Parameters
+    ----------
+    x: (..., n) int array
+
+    Returns
+    -------
+    lo: (...) int array
+        value of the first bin
+    counts: (..., m) int32 array
+        counts for values lo, lo+1, ..., lo+m-1
+    """
+
+    lo = x.min(axis=-1)
+    x0 = (x - lo[..., None]).reshape(-1, x.shape[-1])
+    width = int(x0.max()) + 1
+    offsets = np.arange(len(x0))[:, None] * width
+    counts = np.bincount((x0 + offsets).ravel(), minlength=len(x0) * width)
+    return lo, counts.reshape(x.shape[:-1] + (width,)).astype(np.int32)
+
+@wib_prof.timed()
+def _process(ts, data, fs=2e6):
+    """
+    Post-processing of one acquisition.
+    Compute all products needed by the views in one vectorized pass.
+
+    Parameters
+    ----------
+    ts: (2, n) array
+        timestamps for buf0 and buf1
+    data: (4, 128, n) array
+        ADC samples
+    fs: float
+        sampling frequency for PSD
+
+    Returns
+    -------
+    bundle: dict
+        raw data and the derived per-channel products
+    """
+
+    data = np.asarray(data, dtype=np.uint16)
+    ts = np.asarray(ts).astype(np.int64)
+    adcs = data.astype(np.float32)
+
+    mean = adcs.mean(axis=-1)
+    std = adcs.std(axis=-1)
+
+    adcs -= mean[..., None] # sub. pedestal
+    freq, pxx = periodogram(adcs, fs=fs, axis=-1)
+    with np.errstate(divide='ignore'):
+        psd = (10 * np.log10(pxx[..., 1:])).astype(np.float32)
+
+    delta = np.fmod(np.diff(data.astype(np.int16), axis=-1), 4096)
+    dt = np.diff(ts, axis=-1)
+
+    return dict(
+        data=data,
+        ts=ts,
+        mean=mean,
+        std=std,
+        freq=freq[1:] * 1e-3,
+        psd=psd,
+        delta=delta,
+        dt=dt,
+        hist_adcs=_hist(data),
+        hist_delta=_hist(delta),
+        hist_dt=_hist(dt),
+    )
+
+class Accumulator:
+    """
+    Running averages over the last `nmax` (or all) acquisitions, updated
+    incrementally.
+
+    Mean and std combine the samples of all events (sums of x and x^2),
+    the PSD is averaged on a fixed length and the ADC and delta ADC
+    histograms are summed in fixed bins. With `nmax`, the contribution of
+    each event in the window is kept and subtracted once the event falls
+    out (at most MAX_WINDOW events, about 2 MB each). Changing `nmax`
+    restarts the averages. No event is kept if `nmax` is 0 (all events).
+
+    Parameters
+    ----------
+    nmax: int
+        number of events in the window, 0 for all
+    fs: float
+        sampling frequency for PSD
+    nfft: int
+        max. number of samples for PSD
+    """
+
+    MAX_WINDOW = 100
+
+    def __init__(self, nmax=0, fs=2e6, nfft=2048):
+        self.fs = fs
+        self._nfft = nfft
+        self._nmax = min(max(int(nmax), 0), self.MAX_WINDOW)
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def nmax(self):
+        return self._nmax
+
+    @nmax.setter
+    def nmax(self, value):
+        value = min(max(int(value), 0), self.MAX_WINDOW)
+        if value != self._nmax:
+            self._nmax = value
+            self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0      # events added since reset
+            self.nfft = None
+            self._window = deque()
+            self._n = 0
+            self._sum = np.zeros((4, 128))
+            self._sum2 = np.zeros((4, 128))
+            self._npsd = 0
+            self._pxx = None
+            self._freq = None
+            self._hist_adcs = np.zeros((4, 128, 4096), dtype=np.float32)
+            self._hist_delta = np.zeros((4, 128, 2*4096-1), dtype=np.float32)
+
+    @property
+    def nevents(self):
+        """Number of events in the averages."""
+        return len(self._window) if self._nmax > 0 else self.count
+
     @staticmethod
-    def _generator(n):
-        data = np.random.normal(2048, 5, size=(4,128,n)).astype(int)
-        data[data<0] = 0
-        data[data>4095] = 4095
-        return data
-
-    def __init__(self, generator=None):
-        if generator is None:
-            generator = FakeWIB._generator
-        self._generate = generator
-        
-    def acquire_data(self):
-        n = 2162
-        t = np.zeros((2,n))
-        adcs = self._generator(n)
-        time.sleep(3)
-        return t, adcs
-
-def _draw_pixel(data, femb):
-    adcs = data[femb]
+    def _add_hist(acc, hist, offset, sign=1):
+        lo, counts = hist
+        width = counts.shape[-1]
+        idx = (lo.astype(np.int64) - offset).reshape(-1, 1) + np.arange(width)
+        rows = np.arange(idx.shape[0])[:, None]
+        acc.reshape(-1, acc.shape[-1])[rows, idx] += sign * counts.reshape(-1, width)
+
+    def _apply(self, event, sign):
+        n, s1, s2, pxx, hist_adcs, hist_delta = event
+        self._n += sign * n
+        self._sum += sign * s1
+        self._sum2 += sign * s2
+        if pxx is not None:
+            self._pxx += sign * pxx
+            self._npsd += sign
+        self._add_hist(self._hist_adcs, hist_adcs, 0, sign)
+        self._add_hist(self._hist_delta, hist_delta, -4095, sign)
+
+    def add(self, bundle):
+        """
+        Add one event (output of `_process`).
+        """
+
+        data = bundle['data']
+        n = data.shape[-1]
+
+        # PSD on the same length for all events,
+        # spy buffer length varies slightly
+        if self.nfft is None:
+            self.nfft = min(n, self._nfft)
+        pxx = None
+        if n >= self.nfft:
+            # one-sided periodogram, float32 rfft
+            x = data[..., :self.nfft].astype(np.float32)
+            x -= x.mean(axis=-1, keepdims=True)
+            spec = sp_fft.rfft(x, axis=-1)
+            pxx = spec.real**2 + spec.imag**2
+            pxx *= 2. / (self.fs * self.nfft)
+            pxx[..., 0] /= 2
+            if self.nfft % 2 == 0:
+                pxx[..., -1] /= 2
+            freq = sp_fft.rfftfreq(self.nfft, 1. / self.fs)
+
+        # sums of x and x^2 of the n samples
+        mean = bundle['mean'].astype(np.float64)
+        std = bundle['std'].astype(np.float64)
+        event = (n, mean * n, (std**2 + mean**2) * n, pxx,
+                 bundle['hist_adcs'], bundle['hist_delta'])
+
+        with self._lock:
+            if pxx is not None and self._pxx is None:
+                self._pxx = np.zeros(pxx.shape)
+                self._freq = freq
+            self._apply(event, 1)
+            self.count += 1
+
+            if self._nmax > 0:
+                self._window.append(event)
+                while len(self._window) > self._nmax:
+                    self._apply(self._window.popleft(), -1)
+
+    def bundle(self):
+        """
+        Averaged products with the same keys as `_process`
+        (mean, std, freq, psd, hist_adcs, hist_delta), or `None`
+        before the first event.
+        """
+
+        with self._lock:
+            if self.count == 0:
+                return None
+            mean = self._sum / self._n
+            var = np.maximum(self._sum2 / self._n - mean**2, 0)
+            output = dict(
+                mean=mean.astype(np.float32),
+                std=np.sqrt(var).astype(np.float32),
+                hist_adcs=(np.zeros((4, 128), dtype=int), self._hist_adcs.copy()),
+                hist_delta=(np.full((4, 128), -4095), self._hist_delta.copy()),
+            )
+            if self._npsd > 0:
+                with np.errstate(divide='ignore'):
+                    output['psd'] = (10 * np.log10(np.maximum(self._pxx[..., 1:], 0) / self._npsd)
+                                     ).astype(np.float32)
+                output['freq'] = self._freq[1:] * 1e-3
+        return output
+
+def _bar(hist, idx):
+    lo, counts = hist
+    y = counts[idx]
+    nz = np.flatnonzero(y)
+    i0, i1 = (nz[0], nz[-1] + 1) if len(nz) else (0, 0)
+    return go.Bar(x=lo[idx] + np.arange(i0, i1), y=y[i0:i1])
+
+def _draw_pixel(bundle, femb):
+    adcs = bundle['data'][femb]
     fig = px.imshow(adcs,
                     labels=dict(x='Sample', y='Channel'),
                     aspect='square',
@@ -55,10 +588,9 @@ def _draw_pixel(data, femb):
     )
     return fig
 
-def _draw_mean_std(data, femb):
-    adcs = data[femb]
-    avg = adcs.mean(axis=-1)
-    std = adcs.std(axis=-1)
+def _draw_mean_std(bundle, femb):
+    avg = bundle['mean'][femb]
+    std = bundle['std'][femb]
     
     #fig = go.Figure(layout=dict(height=480, width=480))
     fig = go.Figure()
@@ -85,15 +617,8 @@ def _draw_mean_std(data, femb):
     )
     return fig
 
-def _draw_hist_adcs(data, femb, ch):
-    adcs = data[femb, ch]
-
-    fig = go.Figure(
-        go.Histogram(
-            x=adcs,
-            xbins=dict(size=1),
-        ),
-    )
+def _draw_hist_adcs(bundle, femb, ch):
+    fig = go.Figure(_bar(bundle['hist_adcs'], (femb, ch)))
     #fig.update_layout(width=360, height=360)
     fig.update_layout(
         height=320,
@@ -101,19 +626,12 @@ def _draw_hist_adcs(data, femb, ch):
         title=f'FEMB{femb} Ch{ch:02} ADC',
         xaxis_title='ADC',
         yaxis_title='Counts',
+        bargap=0,
         showlegend=False)
     return fig
 
-def _draw_hist_ts(ts, femb):
-    t = ts[femb//2]
-    dt = np.diff(t)
-
-    fig = go.Figure(
-        go.Histogram(
-            x=dt,
-            xbins=dict(size=1),
-        ),
-    )
+def _draw_hist_ts(bundle, femb):
+    fig = go.Figure(_bar(bundle['hist_dt'], femb//2))
     #fig.update_layout(width=360, height=360)
     fig.update_layout(
         height=320,
@@ -121,20 +639,13 @@ def _draw_hist_ts(ts, femb):
         title=f'Buffer {femb//2}',
         xaxis_title='Delta Timestamp',
         yaxis_title='Counts',
+        bargap=0,
         showlegend=False)
     fig.update_yaxes(type="log")
     return fig
 
-def _draw_hist_delta_adcs(data, femb, ch):
-    adcs = data[femb, ch]
-    diff = np.fmod(np.diff(adcs.astype(int)), 4096)
-
-    fig = go.Figure(
-        go.Histogram(
-            x=diff,
-            xbins=dict(size=1),
-        ),
-    )
+def _draw_hist_delta_adcs(bundle, femb, ch):
+    fig = go.Figure(_bar(bundle['hist_delta'], (femb, ch)))
     #fig.update_layout(width=360, height=360)
     fig.update_layout(
         height=320,
@@ -142,11 +653,12 @@ def _draw_hist_delta_adcs(data, femb, ch):
         title=f'FEMB{femb} Ch{ch:02} Delta ADC',
         xaxis_title='Delta ADC',
         yaxis_title='Counts',
+        bargap=0,
         showlegend=False)
     return fig
   
-def _draw_wfm(data, femb, ch):
-    wfm = data[femb, ch]
+def _draw_wfm(bundle, femb, ch):
+    wfm = bundle['data'][femb, ch]
     fig = px.line(wfm)
     fig.update_layout(
         height=320,
@@ -156,12 +668,11 @@ def _draw_wfm(data, femb, ch):
         showlegend=False
     )
 
-    hist = _draw_hist_adcs(data, femb, ch)
+    hist = _draw_hist_adcs(bundle, femb, ch)
     return fig, hist
 
-def _draw_delta_adcs(data, femb, ch):
-    adcs = data[femb, ch]
-    diff = np.fmod(np.diff(adcs.astype(int)), 4096)
+def _draw_delta_adcs(bundle, femb, ch):
+    diff = bundle['delta'][femb, ch]
 
     fig = px.line(diff)
     fig.update_layout(
@@ -172,18 +683,11 @@ def _draw_delta_adcs(data, femb, ch):
         showlegend=False
     )
 
-    hist = _draw_hist_delta_adcs(data, femb, ch)
+    hist = _draw_hist_delta_adcs(bundle, femb, ch)
     return fig, hist
 
-def _draw_psd(data, femb, ch):
-    wfm = data[femb, ch].astype(float).copy()
-    wfm -= wfm.mean() #sub. pedestal
-    
-    freq, pxx = periodogram(wfm, fs=2e6)
-    freq *= 1e-3
-    pxx_dB = 10 * np.log10(pxx)
-    
-    fig = px.line(x=freq[1:], y=pxx_dB[1:])
+def _draw_psd(bundle, femb, ch):
+    fig = px.line(x=bundle['freq'], y=bundle['psd'][femb, ch])
     fig.update_layout(
         height=320,
         title=f'FEMB{femb} Ch{ch:02}',
@@ -192,14 +696,14 @@ def _draw_psd(data, femb, ch):
         showlegend=False
     )
 
-    hist = _draw_hist_adcs(data, femb, ch)
+    hist = _draw_hist_adcs(bundle, femb, ch)
     return fig, hist
 
-def _draw_timestamp(ts, femb):
+def _draw_timestamp(bundle, femb):
     femb = int(femb) 
     buf_idx = femb//2
     
-    t = ts[buf_idx] 
+    t = bundle['ts'][buf_idx] 
     fig = px.line(t & 0xfffff)
     fig.update_layout(
         height=320,
@@ -208,15 +712,15 @@ def _draw_timestamp(ts, femb):
         yaxis_title=f'Timestamp & 0xFFFFF',
         showlegend=False
     )
-    hist = _draw_hist_ts(ts, femb)
+    hist = _draw_hist_ts(bundle, femb)
     return fig, hist
 
-def _draw_delta_timestamp(ts, femb):
+def _draw_delta_timestamp(bundle, femb):
     femb = int(femb) 
     buf_idx = femb//2
-    t = ts[buf_idx]
+    t = bundle['ts'][buf_idx]
     
-    fig = px.line(np.diff(t))
+    fig = px.line(bundle['dt'][buf_idx])
     fig.update_layout(
         height=320,
         title=f'Buffer {buf_idx},  t0: {hex(t[0])}',
@@ -225,7 +729,7 @@ def _draw_delta_timestamp(ts, femb):
         showlegend=False
     )
 
-    hist = _draw_hist_ts(ts, femb)
+    hist = _draw_hist_ts(bundle, femb)
     return fig, hist
 
 def _make_options(items):
@@ -238,137 +742,242 @@ load_figure_template("flatly")
 #app = JupyterDash(__name__, external_stylesheets=[dbc.themes.FLATLY])
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.FLATLY])
 
-app.layout = html.Div([
-    html.H1("WIB-CRYO"),
-    
-    dbc.InputGroup(
-        [
-            dbc.Select(
-                id='wib_type',
-                options=[{'label':k, 'value':k} for k in ['WIB', 'FakeWIB']],
-                value='WIB',
-            ),
-            dbc.Input(id='wib_src', type='text'),
-        ]
-    ),
+def _layout():
+    # one session per page load
+    return html.Div([
+        html.H1("WIB-CRYO"),
     
-    dbc.InputGroup(
-        [
-            dbc.Select(
-                id='femb',
-                options=[{'label': f'FEMB {i}', 'value': i} for i in range(4)],
-                value='0',
-            ),
-            dbc.Select(
-                id='channel',
-                options=[{'label':f'Ch {i:03}', 'value':i} for i in range(128)],
-                value='0',
-            ),
-            dbc.Select(
-                id='buffer',
-                options=_make_options(['buf0 + buf1', 'buf0', 'buf1']),
-                value='buf0 + buf1',
-            ),
-            dbc.Input(id='status', value=-1, disabled=True),
-            dbc.Button('Acquire', id='acquire', color='secondary'),
-        ]
-    ),
-
-    html.Hr(),
+        dbc.InputGroup(
+            [
+                dbc.Select(
+                    id='wib_type',
+                    options=[{'label':k, 'value':k} for k in ['WIB', 'FakeWIB', 'Replay', 'Live']],
+                    value='WIB',
+                ),
+                dbc.Input(id='wib_src', type='text'),
+            ]
+        ),
     
-    dbc.Row(
-        [
-            dbc.Col(dcc.Graph(id='pixel'), width=5),
-            dbc.Col(dcc.Graph(id='mean_std'), width=7),
-        ],
-        no_gutters=True,
-    ),
+        dbc.InputGroup(
+            [
+                dbc.Select(
+                    id='femb',
+                    options=[{'label': f'FEMB {i}', 'value': i} for i in range(4)],
+                    value='0',
+                ),
+                dbc.Select(
+                    id='channel',
+                    options=[{'label':f'Ch {i:03}', 'value':i} for i in range(128)],
+                    value='0',
+                ),
+                dbc.Select(
+                    id='buffer',
+                    options=_make_options(['buf0 + buf1', 'buf0', 'buf1']),
+                    value='buf0 + buf1',
+                ),
+                dbc.Input(id='status', value=-1, disabled=True),
+                dbc.Button('Acquire', id='acquire', color='secondary'),
+            ]
+        ),
 
+        dbc.InputGroup(
+            [
+                dbc.Button('Live', id='live', color='secondary', outline=True),
+                dbc.Input(id='rate', type='number', value=1, min=0.1, step=0.1,
+                          placeholder='Rate [Hz]'),
+                dbc.Input(id='acq_rate', value='0.00 Hz', disabled=True),
+            ]
+        ),
+
+        dbc.InputGroup(
+            [
+                dbc.Button('Average', id='average', color='secondary', outline=True),
+                dbc.Input(id='avg_n', type='number', value=0, min=0,
+                          max=Accumulator.MAX_WINDOW, step=1,
+                          placeholder='last N events (0: all)'),
+                dbc.Input(id='avg_count', value='0 events', disabled=True),
+                dbc.Button('Reset', id='avg_reset', color='secondary'),
+            ]
+        ),
+
+        dcc.Interval(id='refresh', interval=500),
+
+        html.Hr(),
     
-    html.Hr(),
-    
-    dbc.RadioItems(id='fig_ch_type', 
-                   options=_make_options(['PSD', 'Waveform', 'Delta ADC', 'Timestamp', 'Delta Timestamp']),
-                   value='PSD',
-                   inline=True,
-                  ),
-
-    dbc.Row(
-        [
-            dbc.Col(dcc.Graph(id='fig_ch'), width=7),
-            dbc.Col(dcc.Graph(id='hist_adcs'), width=5),
-        ],
-        no_gutters=True,
-    ),
+        dbc.Row(
+            [
+                dbc.Col(dcc.Graph(id='pixel'), width=5),
+                dbc.Col(dcc.Graph(id='mean_std'), width=7),
+            ],
+            no_gutters=True,
+        ),
 
     
-    dcc.Store(id='timestamp')
-])
+        html.Hr(),
+    
+        dbc.RadioItems(id='fig_ch_type', 
+                       options=_make_options(['PSD', 'Waveform', 'Delta ADC', 'Timestamp', 'Delta Timestamp']),
+                       value='PSD',
+                       inline=True,
+                      ),
 
+        dbc.Row(
+            [
+                dbc.Col(dcc.Graph(id='fig_ch'), width=7),
+                dbc.Col(dcc.Graph(id='hist_adcs'), width=5),
+            ],
+            no_gutters=True,
+        ),
 
-# In[6]:
+    
+        dcc.Store(id='timestamp'),
+        dcc.Store(id='session', data=uuid.uuid4().hex),
+    ])
 
+app.layout = _layout
+server = app.server  # WSGI entry point, e.g. gunicorn wib_dash:server
 
-cache = Cache(
-    app.server,
-    config={
-        'CACHE_TYPE': 'SimpleCache',
-        'CACHE_DEFAULT_TIMEOUT': 300
-    }
-)
 
 @app.callback(
     Output('timestamp', 'data'),
     Output('status', 'value'),
+    Output('acq_rate', 'value'),
+    Output('avg_count', 'value'),
     Input('acquire', 'n_clicks_timestamp'),
+    Input('refresh', 'n_intervals'),
     State('wib_type', 'value'),
     State('wib_src', 'value'),
     State('buffer', 'value'),
-    State('timestamp', 'data')
+    State('timestamp', 'data'),
+    State('session', 'data'),
+    State('average', 'outline'),
 )
-def _on_acquire(timestamp, wib_type, wib_src, buf, last_update):
-    if timestamp is None:
+@wib_prof.profiled
+def _on_acquire(timestamp, n_intervals, wib_type, wib_src, buf, last_update,
+                session, avg_off):
+    ctx = dash.callback_context
+    trig_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
+
+    key = _wib_key(wib_type, wib_src, buf)
+    if trig_id == 'acquire':
+        if timestamp is None or _factory(wib_type, wib_src) is None:
+            raise PreventUpdate
+        _control(key, session, not avg_off, request=time.time())
+        return last_update, 'acquiring ...', dash.no_update, dash.no_update
+
+    # periodic refresh from the status of the acquiring process
+    store = _get_store()
+    wid = wib_id(key)
+    if not os.path.exists(store.path(wid, 'key.json')):
         raise PreventUpdate
-    
+    store.touch_session(session, wid, average=not avg_off)
+
+    status = read_json(store.path(wid, 'status.json'))
+    if status is None:
+        raise PreventUpdate
+
+    acq_rate = f'{status["acq_rate"]:.2f} Hz'
+    avg_count = f'{status.get("avg_nevents", status["avg_count"])} events'
+    if status['error'] is not None:
+        return last_update, f'ERROR: {status["error"]}', acq_rate, avg_count
+
+    t_acq = status['time']
+    if t_acq is None:
+        return last_update, dash.no_update, acq_rate, avg_count
+
+    update = dict(wib=wid, time=int(t_acq * 1000), avg=status['avg_seq'])
+    if update == last_update:
+        return dash.no_update, dash.no_update, acq_rate, avg_count
+
+    status = f'#{status["seq"]} {time.strftime("%H:%M:%S", time.localtime(t_acq))}'
+    return update, status, acq_rate, avg_count
+
+@app.callback(
+    Output('live', 'children'),
+    Output('live', 'outline'),
+    Input('live', 'n_clicks'),
+    Input('rate', 'value'),
+    State('wib_type', 'value'),
+    State('wib_src', 'value'),
+    State('buffer', 'value'),
+    State('session', 'data'),
+    State('average', 'outline'),
+)
+@wib_prof.profiled
+def _on_live(n_clicks, rate, wib_type, wib_src, buf, session, avg_off):
+    ctx = dash.callback_context
+    trig_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
+
+    live = bool(n_clicks) and n_clicks % 2 == 1
+    if _factory(wib_type, wib_src) is None:
+        return 'Live', True
+
+    # other sessions may watch the same source, only a click changes the mode
+    kwargs = dict(live=live) if trig_id == 'live' else {}
+    if rate:
+        kwargs['rate'] = float(rate)
+    if not _control(_wib_key(wib_type, wib_src, buf), session, not avg_off,
+                    create=live, **kwargs):
+        return 'Live', True
+    return ('Pause', False) if live else ('Live', True)
+
+@app.callback(
+    Output('average', 'outline'),
+    Input('average', 'n_clicks'),
+    Input('avg_n', 'value'),
+    Input('avg_reset', 'n_clicks'),
+    State('wib_type', 'value'),
+    State('wib_src', 'value'),
+    State('buffer', 'value'),
+    State('session', 'data'),
+)
+@wib_prof.profiled
+def _on_average(n_clicks, avg_n, reset, wib_type, wib_src, buf, session):
+    ctx = dash.callback_context
+    trig_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
+
+    average = bool(n_clicks) and n_clicks % 2 == 1
     kwargs = {}
-    if wib_type == 'WIB':
-        from wib import WIB
-        wib = WIB(wib_src)
-        if buf == 'buf0':
-            kwargs['buf1'] = False
-        elif buf == 'buf1':
-            kwargs['buf0'] = False
-    elif wib_type == 'FakeWIB':
-        wib = FakeWIB()
-    else:
+    if trig_id == 'avg_reset':
+        kwargs['reset'] = time.time()
+    if avg_n is not None and avg_n >= 0:
+        kwargs['avg_n'] = int(avg_n)
+    _control(_wib_key(wib_type, wib_src, buf), session, average, create=False, **kwargs)
+    return not average
+
+def _get_bundle(timestamp, average):
+    """
+    Latest event of the WIB source, with the running averages if `average`.
+    """
+
+    store = _get_store()
+    bundle = store.get(f'{timestamp["wib"]}/latest')
+    if bundle is None:
         raise PreventUpdate
-        
-    try:
-        ts, data = wib.acquire_data(**kwargs)
-    except:
-        return last_update, 'ERROR: spy buffer'
 
-    cache.clear()
-    cache.set('data', data)
-    cache.set('ts', ts)
-    return timestamp, timestamp
+    avg = store.get(f'{timestamp["wib"]}/avg') if average else None
+    if avg is not None:
+        bundle = {**bundle, **avg}
+    return bundle
 
 @app.callback(
     Output('pixel', 'figure'),
     Output('mean_std', 'figure'),
     Input('timestamp', 'data'),
     Input('femb', 'value'),
+    Input('average', 'outline'),
 )
-def _update_figs_femb(timestamp, femb):
+@wib_prof.profiled
+def _update_figs_femb(timestamp, femb, avg_off):
     if timestamp is None:
         raise PreventUpdate
         
     femb = int(femb)
-    data = cache.get('data')
+    bundle = _get_bundle(timestamp, not avg_off)
     
     output = (
-        _draw_pixel(data, femb),
-        _draw_mean_std(data, femb),
+        _draw_pixel(bundle, femb),
+        _draw_mean_std(bundle, femb),
     )
     
     return output
@@ -379,40 +988,39 @@ def _update_figs_femb(timestamp, femb):
     Input('timestamp', 'data'),
     Input('femb', 'value'),
     Input('channel', 'value'),
-    Input('fig_ch_type', 'value')
+    Input('fig_ch_type', 'value'),
+    Input('average', 'outline'),
 )
-def _update_fig_ch(timestamp, femb, ch, fig_type):
+@wib_prof.profiled
+def _update_fig_ch(timestamp, femb, ch, fig_type, avg_off):
     if timestamp is None:
         raise PreventUpdate
         
     femb = int(femb)
     ch = int(ch)
+    bundle = _get_bundle(timestamp, not avg_off)
     
     if fig_type == 'PSD':
-        data = cache.get('data')
-        return _draw_psd(data, femb, ch)
+        return _draw_psd(bundle, femb, ch)
     
     if fig_type == 'Waveform':
-        data = cache.get('data')
-        return _draw_wfm(data, femb, ch)
+        return _draw_wfm(bundle, femb, ch)
 
     if fig_type == 'Delta ADC':
-        data = cache.get('data')
-        return _draw_delta_adcs(data, femb, ch)
+        return _draw_delta_adcs(bundle, femb, ch)
 
     if fig_type == 'Timestamp':
-        ts = cache.get('ts')
-        return _draw_timestamp(ts, femb)
+        return _draw_timestamp(bundle, femb)
 
     if fig_type == 'Delta Timestamp':
-        ts = cache.get('ts')
-        return _draw_delta_timestamp(ts, femb)
+        return _draw_delta_timestamp(bundle, femb)
 
 @app.callback(
     Output('channel', 'value'),
     Input('pixel', 'clickData'),
     Input('mean_std', 'clickData'),
 )
+@wib_prof.profiled
 def _select_ch(clk_pixel, clk_mean_std):
     ctx = dash.callback_context
     if not ctx.triggered:
@@ -434,15 +1042,54 @@ def _select_ch(clk_pixel, clk_mean_std):
     Output('wib_src', 'value'),
     Input('wib_type', 'value'),
 )
+@wib_prof.profiled
 def _set_wib_type(wib_type):
     if wib_type == 'WIB':
         return 'Enter WIB IP Address', False, None
+    if wib_type == 'Replay':
+        return 'Enter directory of recorded events', False, None
+    if wib_type == 'Live':
+        return 'Ring of a running wib_daq.py --shm (default: wib_live)', False, None
     return '', True, None
 
 parser = argparse.ArgumentParser(description='WIB-CRYO dash app')
 parser.add_argument('-p', dest='port', default=8050)
+parser.add_argument('--host', default='127.0.0.1', help='default=127.0.0.1')
+parser.add_argument('--profile', action='store_true',
+                    help='profile the callbacks and acquisition (see wib_prof.py)')
+parser.add_argument('--workers', type=int, default=0,
+                    help='serve with gunicorn and N worker processes'
+                         ' (default: development server)')
+parser.add_argument('--store', help='shared store directory, default=$WIB_DASH_STORE'
+                                    ' or /dev/shm/wib_dash')
+parser.add_argument('--store-size', type=float, help='max. store size in MB, default=1024')
+parser.add_argument('--store-age', type=float,
+                    help='seconds before an entry not updated is removed, default=600')
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    app.run_server(debug=True, port=args.port)
+
+    # inherited by the worker processes
+    for env, value in [('WIB_DASH_STORE', args.store),
+                       ('WIB_DASH_STORE_MB', args.store_size),
+                       ('WIB_DASH_STORE_AGE', args.store_age)]:
+        if value is not None:
+            os.environ[env] = str(value)
+
+    if args.workers > 0:
+        if args.profile:
+            # each worker profiles its callbacks
+            os.environ['WIB_PROFILE'] = '1'
+        cmd = ['gunicorn', '-w', str(args.workers), '--threads', '4',
+               '-b', f'{args.host}:{args.port}',
+               '--chdir', os.path.dirname(os.path.abspath(__file__)),
+               'wib_dash:server']
+        try:
+            os.execvp(cmd[0], cmd)
+        except FileNotFoundError:
+            print('gunicorn not found (pip install gunicorn)', file=sys.stderr)
+            sys.exit(1)
+
+    wib_prof.start('wib_dash', args.profile)
+    app.run_server(debug=True, host=args.host, port=args.port)
     #app.run_server(mode='jupyterlab')
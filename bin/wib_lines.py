@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+'''
+Noise line finder on the averaged PSDs of all channels, with a history
+across runs.
+
+The PSD of each channel (averaged over the events) is compared with its
+running median along frequency, local maxima above the baseline by more
+than `--prominence` dB are peaks. With few events, the threshold is raised
+so that pure noise gives no peak (see `noise_threshold`). Peaks in neighbouring frequency bins are
+grouped across channels into lines: frequency, prominence, affected
+channels, ASICs and FEMBs. A line is coherent when the channels of an ASIC
+pick it up in phase (coherence = |sum of spectra|^2 / (64 x sum of powers),
+1/64 for independent channels, 1 for a common line).
+
+The lines of each run can be added to a history (csv), to see which lines
+appear or disappear between runs, e.g. after a power supply change or
+Room -> Cold.
+
+Example:
+    wib_lines.py find -i /home/wib/data/SN03/Cold/T2/WIB_0x390 -H ~/lines.csv
+    wib_lines.py history -H ~/lines.csv --sn SN03 --setting 0x390
+'''
+
+import os
+import sys
+import fcntl
+import argparse
+import numpy as np
+import pandas as pd
+from glob import glob
+from scipy import ndimage
+
+from wib_plot import _read
+from wib_check import FS, _parse_key
+
+COLUMNS = ['freq_khz', 'prominence_db', 'max_prominence_db', 'nchannels',
+           'coherence', 'coherent', 'fembs', 'asics']
+RUN_COLUMNS = ['run', 'sn', 'cond', 'setting', 'time', 'label']
+
+def spectra(adcs, fs=FS):
+    """
+    Averaged PSD of each channel and the coherence of each ASIC,
+    one event at a time.
+
+    Parameters
+    ----------
+    adcs: (N, 4, 128, n) array
+        events from `wib_plot._read`
+    fs: float
+        sampling frequency
+
+    Returns
+    -------
+    freq: (M, ) array
+        frequency [Hz]
+    pxx: (512, M) array
+        PSD [ADC^2/Hz] (channel = femb * 128 + ch)
+    coherence: (8, M) array
+        coherence of the 64 channels of each ASIC (asic = femb * 2 + asic)
+    """
+
+    nevents, nfembs, nchs, n = adcs.shape
+    window = np.hanning(n).astype(np.float32)
+    scale = 2. / (fs * (window**2).sum())
+
+    pxx = np.zeros((nfembs*nchs, n//2+1))
+    coh_num = np.zeros((nfembs*2, n//2+1))
+    for adc in adcs:
+        wfms = adc.reshape(nfembs*nchs, n).astype(np.float32)
+        wfms -= wfms.mean(axis=-1, keepdims=True)
+        spec = np.fft.rfft(wfms * window, axis=-1)
+        power = spec.real**2 + spec.imag**2
+        pxx += power
+        common = spec.reshape(nfembs*2, nchs//2, -1).sum(axis=1)
+        coh_num += common.real**2 + common.imag**2
+
+    power = pxx.reshape(nfembs*2, nchs//2, -1).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coherence = np.nan_to_num(coh_num / (nchs//2 * power))
+
+    pxx *= scale / nevents
+    return np.fft.rfftfreq(n, 1./fs), pxx, coherence
+
+def noise_threshold(nevents, ntests, width=31, false_peaks=0.001):
+    """
+    Height [dB] above the running median which pure noise exceeds about
+    `false_peaks` times in `ntests` bins.
+
+    A periodogram bin of Gaussian noise averaged over `nevents` events is
+    gamma distributed (shape `nevents`), a single event is exponential:
+    6 dB above the median is passed by 6% of the bins. The running median
+    of `width` bins is itself random (order statistic, F(median) is
+    Beta((width+1)/2, (width+1)/2)) and integrated over.
+    """
+
+    from scipy import stats, special, optimize
+
+    g = stats.gamma(max(int(nevents), 1))
+    p = false_peaks / max(ntests, 1)
+
+    h = (width + 1) / 2
+    x, w = special.roots_jacobi(64, h - 1, h - 1)
+    median = g.ppf((1 + x) / 2)
+    w = w / w.sum()
+
+    # log P(bin > t x median) - log p
+    def excess(log_t):
+        with np.errstate(divide='ignore'):
+            return np.log((w * g.sf(np.exp(log_t) * median)).sum()) - np.log(p)
+
+    return 10 * np.log10(np.exp(optimize.brentq(excess, 0., 10.)))
+
+def find_peaks(freq, pxx, prominence=6., width=31, fmin=5e3, active=None,
+               nevents=1, false_peaks=0.001):
+    """
+    Peaks of all channels at once.
+
+    The min. height is `prominence` or the noise threshold of the PSD
+    averaged over `nevents` (see `noise_threshold`), whichever is larger.
+
+    Parameters
+    ----------
+    freq: (M, ) array
+        frequency [Hz]
+    pxx: (C, M) array
+        PSD of each channel
+    prominence: float
+        min. height above the running median [dB]
+    width: int
+        running median window in frequency bins
+    fmin: float
+        ignore frequencies below `fmin` [Hz] (1/f noise)
+    active: (C, ) bool array, optional
+        channels to search, default: channels with power
+    nevents: int
+        number of events averaged in `pxx`
+    false_peaks: float
+        expected number of peaks from pure noise
+
+    Returns
+    -------
+    peaks: (C, M) bool array
+    height: (C, M) array
+        height above the running median [dB]
+    """
+
+    with np.errstate(divide='ignore'):
+        db = 10 * np.log10(pxx)
+    db[~np.isfinite(db)] = -100.
+
+    if active is None:
+        active = np.any(pxx > 0, axis=-1)
+
+    # mirrored at the ends, the Nyquist bin is lower (one real value)
+    baseline = ndimage.median_filter(db, size=(1, width), mode='reflect')
+    height = db - baseline
+
+    ntests = np.count_nonzero(active) * np.count_nonzero(freq[:-1] >= fmin)
+    threshold = max(prominence, noise_threshold(nevents, ntests, width, false_peaks))
+
+    peaks = np.zeros(db.shape, dtype=bool)
+    peaks[:, 1:-1] = (db[:, 1:-1] > db[:, :-2]) & (db[:, 1:-1] >= db[:, 2:])
+    peaks &= height > threshold
+    peaks[:, freq < fmin] = False
+    peaks[:, -1] = False
+    peaks[~active] = False
+    return peaks, height
+
+def group_lines(freq, peaks, height, coherence, min_coherence=0.5):
+    """
+    Group the peaks in neighbouring bins across channels into lines.
+
+    Returns
+    -------
+    lines: pandas.DataFrame
+        one row per line (COLUMNS)
+    channels: pandas.DataFrame
+        freq_khz, femb, ch, prominence_db of each affected channel
+    """
+
+    nchannels = peaks.sum(axis=0)
+    bins = np.flatnonzero(nchannels)
+    if len(bins) == 0:
+        return pd.DataFrame(columns=COLUMNS), pd.DataFrame(
+            columns=['freq_khz', 'femb', 'ch', 'prominence_db'])
+
+    # consecutive bins with peaks make one line
+    splits = np.flatnonzero(np.diff(bins) > 1) + 1
+    rows = []
+    details = []
+    for group in np.split(bins, splits):
+        h = np.where(peaks[:, group], height[:, group], 0.)
+        chs = np.flatnonzero(h.any(axis=-1))
+        prom = h[chs].max(axis=-1)
+        weights = h.sum(axis=0)
+        f = float((freq[group] * weights).sum() / weights.sum())
+
+        asics = np.unique(chs // 64)
+        coh = float(coherence[np.ix_(asics, group)].max())
+        rows.append(dict(
+            freq_khz=f * 1e-3,
+            prominence_db=float(np.median(prom)),
+            max_prominence_db=float(prom.max()),
+            nchannels=len(chs),
+            coherence=coh,
+            coherent=coh > min_coherence,
+            fembs=' '.join(str(x) for x in np.unique(chs // 128)),
+            asics=' '.join(f'F{a//2}A{a%2}' for a in asics),
+        ))
+        details.append(pd.DataFrame(dict(freq_khz=f * 1e-3, femb=chs // 128,
+                                         ch=chs % 128, prominence_db=prom)))
+
+    lines = pd.DataFrame(rows, columns=COLUMNS)
+    return lines, pd.concat(details, ignore_index=True)
+
+def find_lines(adcs, fs=FS, prominence=6., width=31, fmin=5e3, min_coherence=0.5):
+    """
+    Noise lines of a run (see `spectra`, `find_peaks` and `group_lines`).
+
+    Returns
+    -------
+    lines: pandas.DataFrame
+    channels: pandas.DataFrame
+    """
+
+    freq, pxx, coherence = spectra(adcs, fs)
+    active = np.repeat(np.any(adcs, axis=(0,2,3)), adcs.shape[2])
+    peaks, height = find_peaks(freq, pxx, prominence, width, fmin, active,
+                               nevents=len(adcs))
+    return group_lines(freq, peaks, height, coherence, min_coherence)
+
+def _run_time(path):
+    files = [path] if os.path.isfile(path) else glob(os.path.join(path, '*.npz'))
+    if len(files) == 0:
+        return ''
+    t = min(os.path.getmtime(f) for f in files)
+    return pd.Timestamp(t, unit='s').strftime('%Y-%m-%d %H:%M:%S')
+
+def add_history(history, input, lines, key=None, label=''):
+    """
+    Add (or replace) the lines of a run in the history csv.
+    A run without line is kept as a row without frequency.
+    """
+
+    sn, cond, setting = key or _parse_key(input)
+    run = dict(run=os.path.realpath(input), sn=sn, cond=cond, setting=setting,
+               time=_run_time(input), label=label or '')
+    rows = lines.assign(**run) if len(lines) > 0 else pd.DataFrame([run])
+    rows = rows.reindex(columns=RUN_COLUMNS + COLUMNS)
+
+    os.makedirs(os.path.dirname(os.path.abspath(history)), exist_ok=True)
+    # several wib_plot2 workers may update the history
+    with open(f'{history}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(history):
+            old = pd.read_csv(history, dtype={'label': str})
+            rows = pd.concat([old[old['run'] != run['run']], rows], ignore_index=True)
+        rows.to_csv(f'{history}.tmp', index=False, float_format='%.3f')
+        os.replace(f'{history}.tmp', history)
+    print(f'{len(lines)} line(s) of {input} added to {history}')
+
+def _cluster(freqs, tol):
+    """Cluster id of each frequency (gap > tol starts a new cluster)."""
+    order = np.argsort(freqs)
+    ids = np.empty(len(freqs), dtype=int)
+    ids[order] = np.concatenate([[0], np.cumsum(np.diff(freqs[order]) > tol)])
+    return ids
+
+def history_table(history, sn=None, cond=None, setting=None, tol=2.):
+    """
+    Lines of the runs in time order.
+
+    Parameters
+    ----------
+    history: str
+        history csv
+    sn, cond, setting: str, optional
+        select the runs
+    tol: float
+        max. frequency difference [kHz] for the same line in different runs
+
+    Returns
+    -------
+    table: pandas.DataFrame
+        prominence [dB] of each line (rows, in kHz) in each run (columns)
+    changes: list of str
+        lines appearing / disappearing w.r.t. the previous run
+    """
+
+    df = pd.read_csv(history, dtype={'label': str})
+    for col, value in [('sn', sn), ('cond', cond), ('setting', setting)]:
+        if value is not None:
+            df = df[df[col] == value]
+    if len(df) == 0:
+        return pd.DataFrame(), []
+
+    runs = df.drop_duplicates('run').sort_values('time')
+    names = {}
+    for run, row in zip(runs['run'], runs.itertuples()):
+        name = os.path.join(*run.split(os.sep)[-3:])
+        if isinstance(row.label, str) and row.label:
+            name += f' ({row.label})'
+        names[run] = name
+
+    lines = df.dropna(subset=['freq_khz']).copy()
+    if len(lines) == 0:
+        return pd.DataFrame(columns=list(names.values())), []
+    lines['line'] = _cluster(lines['freq_khz'].to_numpy(), tol)
+    freq = lines.groupby('line')['freq_khz'].median()
+
+    table = lines.pivot_table(index='line', columns='run', values='prominence_db',
+                              aggfunc='max')
+    table = table.reindex(columns=list(names))
+    table.index = [f'{f:.1f}' for f in freq.loc[table.index]]
+    table.index.name = 'freq_khz'
+
+    changes = []
+    for prev, run in zip(list(names)[:-1], list(names)[1:]):
+        new = table.index[table[run].notna() & table[prev].isna()]
+        gone = table.index[table[run].isna() & table[prev].notna()]
+        if len(new) or len(gone):
+            msg = f'{names[run]} vs {names[prev]}:'
+            if len(new):
+                msg += ' new ' + ', '.join(f'{f} kHz (+{table.loc[f, run]:.0f} dB)' for f in new)
+            if len(gone):
+                msg += ' gone ' + ', '.join(f'{f} kHz' for f in gone)
+            changes.append(msg)
+
+    table.columns = [names[run] for run in table.columns]
+    return table, changes
+
+def main():
+    parser = argparse.ArgumentParser(description='WIB noise lines')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('find', help='find the noise lines of a run')
+    p.add_argument('-i', '--input', required=True)
+    p.add_argument('-o', '--output', help='csv file for the lines')
+    p.add_argument('--channels', help='csv file for the affected channels of each line')
+    p.add_argument('-H', '--history', default=os.environ.get('WIB_LINES'),
+                   help='add the lines to a history csv (default: $WIB_LINES)')
+    p.add_argument('--label', help='label of the run in the history, e.g. "new PS"')
+    p.add_argument('--fs', type=float, default=FS)
+    p.add_argument('--prominence', type=float, default=6.,
+                   help='min. peak height above the median PSD [dB], raised to the'
+                        ' noise threshold with few events. default=6')
+    p.add_argument('--width', type=int, default=31,
+                   help='running median window in frequency bins, default=31')
+    p.add_argument('--fmin', type=float, default=5.,
+                   help='min. frequency [kHz], default=5')
+    p.add_argument('--no-align', action='store_true',
+                   help='do not align buffers using timestamps')
+    p.add_argument('--sn', help='SN, default: from input path')
+    p.add_argument('--cond', choices=['Room', 'Cold'],
+                   help='condition, default: from input path')
+    p.add_argument('--setting', help='ASIC setting, default: from input path')
+    p.set_defaults(cmd='find')
+
+    p = subparsers.add_parser('history', help='lines of the runs in the history')
+    p.add_argument('-H', '--history', default=os.environ.get('WIB_LINES'),
+                   help='history csv (default: $WIB_LINES)')
+    p.add_argument('--sn')
+    p.add_argument('--cond', choices=['Room', 'Cold'])
+    p.add_argument('--setting')
+    p.add_argument('--tol', type=float, default=2.,
+                   help='max. frequency difference [kHz] of the same line, default=2')
+    p.set_defaults(cmd='history')
+
+    args = parser.parse_args()
+    if not hasattr(args, 'cmd'):
+        parser.print_help()
+        sys.exit(1)
+
+    if args.cmd == 'history':
+        if args.history is None or not os.path.exists(args.history):
+            print(f'No history {args.history}', file=sys.stderr)
+            sys.exit(1)
+        table, changes = history_table(args.history, args.sn, args.cond,
+                                       args.setting, args.tol)
+        print(table.to_string(float_format='%.1f', na_rep='-'))
+        for msg in changes:
+            print(msg)
+        sys.exit(0)
+
+    data = _read(args.input, do_align=not args.no_align)
+    lines, channels = find_lines(data, args.fs, args.prominence, args.width,
+                                 args.fmin * 1e3)
+    print(lines.to_string(index=False, float_format='%.1f'))
+
+    if args.output:
+        lines.to_csv(args.output, index=False, float_format='%.3f')
+    if args.channels:
+        channels.to_csv(args.channels, index=False, float_format='%.3f')
+    if args.history:
+        sn, cond, setting = _parse_key(args.input)
+        key = (args.sn or sn, args.cond or cond, args.setting or setting)
+        add_history(args.history, args.input, lines, key, args.label)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+'''
+Continuous link and register health monitor.
+
+Sample a set of rogue variables from one or many WIBs at a fixed cadence
+over a persistent connection. Keep the recent samples in memory and append
+all samples to a compact binary time-series on disk. The current values
+are exposed on a local http endpoint in Prometheus text format.
+Lock flaps (`*.Locked` changes) and counter jumps are reported as they happen.
+
+Example:
+    wib_monitor.py -w 192.168.121.1 192.168.121.2 --femb 0 1 \
+        --counter SspGtDecoderReg0.ErrorCnt -o ~/monitor --http-port 9100
+
+    curl localhost:9100/metrics
+'''
+
+import os
+import sys
+import time
+import json
+import math
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from pyrogue.interfaces import SimpleClient
+from wib_cryo import get_addr_port
+
+PREFIX = 'cryoAsicGen1.WibFembCryo'
+
+def _to_float(val):
+    if isinstance(val, (bool, int, float)):
+        return float(val)
+    try:
+        return float(int(val, 0))
+    except (TypeError, ValueError):
+        return math.nan
+
+def load_timeseries(path):
+    """
+    Read a time-series written by the monitor.
+
+    Parameters
+    ----------
+    path: str
+        path of the .bin file (with the .json header next to it)
+
+    Returns
+    -------
+    t: (N, ) array
+        unix time of the samples
+    values: (N, M) array
+        values of the M variables
+    names: list of str
+        variable names
+    """
+
+    with open(path.replace('.bin', '.json')) as f:
+        header = json.load(f)
+    names = header['variables']
+    arr = np.fromfile(path, dtype='<f8')
+    arr = arr[:len(arr) // (len(names)+1) * (len(names)+1)]
+    arr = arr.reshape(-1, len(names)+1)
+    return arr[:,0], arr[:,1:], names
+
+class Monitor(threading.Thread):
+    """
+    Sample variables from one WIB.
+
+    Parameters
+    ----------
+    addr: str
+        WIB IP address
+    port: int
+        rogue port
+    variables: list of str
+        full rogue paths to sample
+    counters: list of str
+        subset of `variables` treated as counters
+    interval: float
+        sampling period in seconds
+    nkeep: int
+        number of samples kept in memory
+    outdir: str, optional
+        directory for the on-disk time-series
+    jump: float
+        report a counter increment larger than `jump` per sample
+    """
+
+    def __init__(self, addr, port, variables, counters=[], interval=1.,
+                 nkeep=3600, outdir=None, jump=0):
+        super().__init__(daemon=True)
+        self.addr = addr
+        self.port = port
+        self.wib = f'{addr}:{port}'
+        self.variables = variables
+        self.counters = counters
+        self.interval = interval
+        self.jump = jump
+
+        self.ring = deque(maxlen=nkeep)
+        self.flaps = dict.fromkeys(variables, 0)
+        self.jumps = dict.fromkeys(variables, 0)
+        self.errors = 0
+        self.connected = False
+        self._lock = threading.Lock()
+        self._halt = threading.Event()
+
+        self._file = None
+        if outdir is not None:
+            os.makedirs(outdir, exist_ok=True)
+            base = os.path.join(outdir, f'{addr}_{port}')
+            with open(f'{base}.json', 'w') as f:
+                json.dump(dict(wib=self.wib, variables=variables,
+                               interval=interval, start=time.time()), f)
+            self._file = open(f'{base}.bin', 'ab')
+
+    def _sample(self, client):
+        values = np.array([_to_float(client.get(v)) for v in self.variables])
+        return time.time(), values
+
+    def _check(self, t, values):
+        if len(self.ring) == 0:
+            return
+
+        prev = self.ring[-1][1]
+        stamp = time.strftime('%H:%M:%S', time.localtime(t))
+        for i, var in enumerate(self.variables):
+            if var.endswith('.Locked') and values[i] != prev[i]:
+                self.flaps[var] += 1
+                print(f'[{stamp}] [{self.wib}] lock flap {var}:'
+                      f' {int(prev[i]):#x} -> {int(values[i]):#x}', flush=True)
+            elif var in self.counters and values[i] - prev[i] > self.jump:
+                self.jumps[var] += 1
+                print(f'[{stamp}] [{self.wib}] counter jump {var}:'
+                      f' +{values[i] - prev[i]:g}', flush=True)
+
+    def run(self):
+        client = None
+        t_next = time.time()
+        while not self._halt.is_set():
+            try:
+                if client is None:
+                    client = SimpleClient(self.addr, self.port)
+                t, values = self._sample(client)
+                self.connected = True
+            except Exception as e:
+                self.errors += 1
+                self.connected = False
+                print(f'[{self.wib}] sample failed ({e}), reconnecting',
+                      file=sys.stderr, flush=True)
+                if client is not None:
+                    try:
+                        client.stop()
+                    except Exception:
+                        pass
+                client = None
+            else:
+                with self._lock:
+                    self._check(t, values)
+                    self.ring.append((t, values))
+                if self._file is not None:
+                    np.concatenate([[t], values]).astype('<f8').tofile(self._file)
+                    self._file.flush()
+
+            t_next += self.interval
+            self._halt.wait(max(t_next - time.time(), 0))
+
+        if self._file is not None:
+            self._file.close()
+
+    def stop(self):
+        self._halt.set()
+
+    def latest(self):
+        with self._lock:
+            return self.ring[-1] if self.ring else (None, None)
+
+def metrics(monitors):
+    """
+    Current values of all monitors in Prometheus text format.
+    """
+
+    lines = [
+        '# HELP wib_register Latest value of a WIB register',
+        '# TYPE wib_register gauge',
+    ]
+    for m in monitors:
+        t, values = m.latest()
+        if t is None: continue
+        for var, val in zip(m.variables, values):
+            lines.append(f'wib_register{{wib="{m.wib}",var="{var}"}} {val:g}')
+
+    lines += [
+        '# HELP wib_lock_flaps_total Number of lock state changes',
+        '# TYPE wib_lock_flaps_total counter',
+    ]
+    for m in monitors:
+        for var, n in m.flaps.items():
+            if var.endswith('.Locked'):
+                lines.append(f'wib_lock_flaps_total{{wib="{m.wib}",var="{var}"}} {n}')
+
+    lines += [
+        '# HELP wib_counter_jumps_total Number of counter jumps above threshold',
+        '# TYPE wib_counter_jumps_total counter',
+    ]
+    for m in monitors:
+        for var in m.counters:
+            lines.append(f'wib_counter_jumps_total{{wib="{m.wib}",var="{var}"}} {m.jumps[var]}')
+
+    lines += [
+        '# HELP wib_up Whether the WIB is sampled on time',
+        '# TYPE wib_up gauge',
+    ]
+    for m in monitors:
+        # a sample older than 3 periods means the connection is stuck
+        t, __ = m.latest()
+        up = m.connected and t is not None and time.time() - t < 3 * m.interval
+        lines.append(f'wib_up{{wib="{m.wib}"}} {int(up)}')
+
+    lines += [
+        '# HELP wib_sample_errors_total Number of failed samples',
+        '# TYPE wib_sample_errors_total counter',
+    ]
+    for m in monitors:
+        lines.append(f'wib_sample_errors_total{{wib="{m.wib}"}} {m.errors}')
+
+    lines += [
+        '# HELP wib_last_sample_timestamp_seconds Time of the last sample',
+        '# TYPE wib_last_sample_timestamp_seconds gauge',
+    ]
+    for m in monitors:
+        t, __ = m.latest()
+        if t is not None:
+            lines.append(f'wib_last_sample_timestamp_seconds{{wib="{m.wib}"}} {t:.3f}')
+
+    return '\n'.join(lines) + '\n'
+
+def serve_metrics(monitors, port, addr='127.0.0.1'):
+    """
+    Serve `/metrics` in a background thread.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ['/metrics', '']:
+                self.send_error(404)
+                return
+            body = metrics(monitors).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _full_path(path):
+    return path if path.startswith('cryoAsicGen1') else f'{PREFIX}.{path}'
+
+def main():
+    parser = argparse.ArgumentParser(description='WIB link and register monitor')
+    parser.add_argument('-w', dest='wib', metavar='ip:<port>', nargs='+', default=[None],
+                        help='wib ip address(es)')
+    parser.add_argument('--femb', type=int, choices=range(4), nargs='+',
+                        default=[0,1,2,3], help='FEMB(s) for SspGtDecoderReg*.Locked')
+    parser.add_argument('--var', nargs='+', default=[],
+                        help='extra variable(s), relative to cryoAsicGen1.WibFembCryo')
+    parser.add_argument('--counter', nargs='+', default=[],
+                        help='counter variable(s), relative to cryoAsicGen1.WibFembCryo')
+    parser.add_argument('--jump', type=float, default=0,
+                        help='report counter increments larger than JUMP, default=0')
+    parser.add_argument('-i', '--interval', type=float, default=1.,
+                        help='sampling period in seconds, default=1')
+    parser.add_argument('--nkeep', type=int, default=3600,
+                        help='samples kept in memory per WIB, default=3600')
+    parser.add_argument('-o', '--outdir', help='directory for the time-series')
+    parser.add_argument('--http-port', type=int, default=9100,
+                        help='port for /metrics, 0 to disable, default=9100')
+    args = parser.parse_args()
+
+    variables = [f'{PREFIX}.SspGtDecoderReg{i}.Locked' for i in args.femb]
+    variables += [_full_path(v) for v in args.var]
+    counters = [_full_path(v) for v in args.counter]
+    variables += [v for v in counters if v not in variables]
+
+    monitors = []
+    for wib in args.wib:
+        addr, port = get_addr_port(wib)
+        m = Monitor(addr, port, variables, counters, args.interval,
+                    args.nkeep, args.outdir, args.jump)
+        m.start()
+        monitors.append(m)
+        print(f'monitoring {m.wib}: {len(variables)} variables every {args.interval}s')
+
+    if args.http_port > 0:
+        serve_metrics(monitors, args.http_port)
+        print(f'metrics on http://127.0.0.1:{args.http_port}/metrics')
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    for m in monitors:
+        m.stop()
+        m.join()
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+'''
+Run plans: bring-up and data taking steps described in yml, executed as a
+dependency graph.
+
+Steps for different WIBs or FEMBs run concurrently. Steps touching registers
+shared by all FEMBs of a WIB (SampClkEn, SR0Polarity, reset, ...) hold a
+per-WIB lock. The state of each step is saved to a checkpoint file, a failed
+plan resumes from the failed step(s).
+
+Example plan:
+
+    defaults:
+      wib: 192.168.121.1
+      cold: true
+    steps:
+      - {id: init, op: init, femb: [0, 1]}
+      - {id: cfg0, op: config_asic, femb: 0, val: 0x390, after: [init]}
+      - {id: cfg1, op: disable_lane, femb: 1, lane: [0], val: 0x390, after: [init]}
+      - {id: mask, op: rx_mask, rx_mask: 0xff1f, after: [cfg0, cfg1]}
+      - {id: daq, op: daq, outdir: ~/data/SN03/Cold/T2/WIB_0x390, nevents: 10}
+
+Without `after`, a step depends on the previous step of the same WIB with
+overlapping FEMBs (a step without `femb` covers all FEMBs).
+
+    wib_plan.py run plan.yml
+    wib_plan.py show plan.yml
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import argparse
+import queue
+import threading
+import yaml
+
+import wib_cryo
+from wib_cryo import get_addr_port
+
+def rx_mask(addr, port, rx_mask, femb=[]):
+    from wib_rx_mask import set_rx_mask
+    if not set_rx_mask(addr, rx_mask, femb):
+        raise RuntimeError('SetRxMask failed')
+
+def daq(addr, port, outdir, nevents=10, buf=None):
+    from wib import WIB
+    from wib_daq import get_daq_kwargs, record
+    from glob import glob
+    outpath = os.path.expanduser(outdir)
+    os.makedirs(outpath, exist_ok=True)
+    # partial events of a failed attempt, the step reruns from scratch
+    for fpath in glob(os.path.join(outpath, 'event_*.npz')):
+        os.unlink(fpath)
+    print(f'[{addr}] acquring {nevents} events to {outpath}')
+    if not record(WIB(addr), outpath, nevents, **get_daq_kwargs(buf)):
+        raise RuntimeError('Fail to get data from spy buffer')
+
+def wait_for(addr, port, seconds):
+    wib_cryo._sleep(seconds)
+
+# op -> (function, shared registers of the WIB)
+OPS = {
+    'init': (wib_cryo.init, True),
+    'init_femb': (wib_cryo.init_femb, True),
+    'reset_asic': (wib_cryo.reset_asic, True),
+    'load_default_yml': (wib_cryo.load_default_yml, False),
+    'load_yml': (wib_cryo.load_yml, False),
+    'enable_clk': (wib_cryo.enable_clk, True),
+    'clk': (wib_cryo.clk, True),
+    'sr0': (wib_cryo.sr0, True),
+    'toggle_sr0': (wib_cryo.toggle_sr0, True),
+    'config_asic': (wib_cryo.config_asic, False),
+    'config_asic_ch': (wib_cryo.config_asic_ch, False),
+    'enable_ramp': (wib_cryo.enable_ramp, True),
+    'disable_ramp': (wib_cryo.disable_ramp, True),
+    'disable_lane': (wib_cryo.disable_lane, False),
+    'enable_trigger': (wib_cryo.enable_trigger, True),
+    'disable_trigger': (wib_cryo.disable_trigger, True),
+    'restore': (wib_cryo.restore, True),
+    'snapshot': (wib_cryo.snapshot, False),
+    'rx_mask': (rx_mask, True),
+    'daq': (daq, False),
+    'wait': (wait_for, False),
+}
+
+# defaults of the optional wib_cryo arguments (as in the command line)
+ARG_DEFAULTS = {
+    'femb': [],
+    'asic': [],
+    'cold': False,
+    'path': wib_cryo.SNAPSHOT_PATH,
+    'output': None,
+}
+
+class _WibLock:
+    """
+    Per-WIB lock: steps on shared registers run alone,
+    the other steps of the WIB run concurrently.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._nrunning = 0
+        self._exclusive = False
+
+    def acquire(self, exclusive):
+        with self._cond:
+            if exclusive:
+                self._cond.wait_for(lambda: self._nrunning == 0)
+                self._exclusive = True
+            else:
+                self._cond.wait_for(lambda: not self._exclusive)
+            self._nrunning += 1
+
+    def release(self):
+        with self._cond:
+            self._nrunning -= 1
+            self._exclusive = False if self._nrunning == 0 else self._exclusive
+            self._cond.notify_all()
+
+class Step:
+    """
+    One step of a plan.
+
+    Parameters
+    ----------
+    spec: dict
+        step from the yml file (merged with the defaults)
+    index: int
+        position in the plan
+    """
+
+    def __init__(self, spec, index):
+        self.spec = spec
+        self.id = str(spec.get('id', f'{index:03}_{spec["op"]}'))
+        self.op = spec['op']
+        self.addr, self.port = get_addr_port(spec.get('wib'))
+        self.wib = f'{self.addr}:{self.port}'
+        self.after = [str(x) for x in spec.get('after', [])]
+        self.explicit = 'after' in spec
+
+        if self.op not in OPS:
+            raise ValueError(f'step {self.id}: unknown op {self.op}')
+        self.func, self.shared = OPS[self.op]
+
+        # arguments of the function, from the step or the defaults
+        args = inspect.getfullargspec(self.func).args
+        self.kwargs = {k: v for k, v in spec.items() if k in args}
+        if isinstance(self.kwargs.get('femb'), int):
+            self.kwargs['femb'] = [self.kwargs['femb']]
+        for arg, default in ARG_DEFAULTS.items():
+            if arg in args and arg not in self.kwargs:
+                self.kwargs[arg] = default
+
+        self.fembs = set(self.kwargs.get('femb', [])) or set(range(4))
+
+    @property
+    def digest(self):
+        return hashlib.sha1(json.dumps(self.spec, sort_keys=True, default=str)
+                            .encode()).hexdigest()
+
+    def run(self):
+        self.func(addr=self.addr, port=self.port, **self.kwargs)
+
+def load_plan(path):
+    """
+    Read a plan and resolve the dependencies.
+
+    Returns
+    -------
+    steps: dict
+        {step id: Step} in plan order
+    """
+
+    with open(path) as f:
+        plan = yaml.safe_load(f)
+
+    defaults = plan.get('defaults', {})
+    steps = {}
+    for i, spec in enumerate(plan['steps']):
+        step = Step({**defaults, **spec}, i)
+        if step.id in steps:
+            raise ValueError(f'duplicated step id {step.id}')
+
+        if not step.explicit:
+            # previous step of the same WIB with overlapping FEMBs
+            for prev in reversed(list(steps.values())):
+                if prev.wib == step.wib and prev.fembs & step.fembs:
+                    step.after = [prev.id]
+                    break
+
+        for dep in step.after:
+            if dep not in steps:
+                raise ValueError(f'step {step.id}: unknown dependency {dep}'
+                                 ' (dependencies must be defined before)')
+        steps[step.id] = step
+    return steps
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_state(path, state):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+def run_plan(steps, state_file, workers=8, restart=False):
+    """
+    Execute the steps as a dependency graph.
+
+    Parameters
+    ----------
+    steps: dict
+        from `load_plan`
+    state_file: str
+        checkpoint file, steps done with unchanged spec are skipped
+    workers: int
+        max. concurrent steps
+    restart: bool
+        ignore the checkpoint
+
+    Returns
+    -------
+    success: bool
+    """
+
+    state = {} if restart else _load_state(state_file)
+    done = {sid for sid, s in state.items()
+            if s.get('status') == 'done' and sid in steps
+            and s.get('digest') == steps[sid].digest}
+    if done:
+        print(f'Resume: {len(done)} step(s) done, skipped')
+
+    locks = {wib: _WibLock() for wib in set(s.wib for s in steps.values())}
+    state_lock = threading.Lock()
+    failed = set()
+
+    results = queue.Queue()
+
+    def _run(step):
+        lock = locks[step.wib]
+        lock.acquire(step.shared)
+        t0 = time.time()
+        try:
+            print(f'[{step.id}] {step.op} {step.wib} {step.kwargs}', flush=True)
+            step.run()
+            results.put((step, time.time() - t0, None))
+        except BaseException as e:
+            # wib_cryo exits on failures
+            results.put((step, time.time() - t0, f'{type(e).__name__}: {e}'))
+        finally:
+            lock.release()
+
+    def _record(step, status, **kwargs):
+        with state_lock:
+            state[step.id] = dict(status=status, digest=step.digest,
+                                  time=time.strftime('%Y-%m-%d %H:%M:%S'), **kwargs)
+            _save_state(state_file, state)
+
+    # plain threads, not a ThreadPoolExecutor: wib_cryo forks processes
+    # (is_rx_locked) which fail to exit cleanly under an executor
+    pending = [sid for sid in steps if sid not in done]
+    nrunning = 0
+    t_start = time.time()
+    while pending or nrunning:
+        for sid in list(pending):
+            step = steps[sid]
+            if any(dep in failed for dep in step.after):
+                pending.remove(sid)
+                failed.add(sid)
+                _record(step, 'blocked')
+                print(f'[{sid}] blocked by a failed dependency')
+            elif nrunning < workers and all(dep in done for dep in step.after):
+                pending.remove(sid)
+                threading.Thread(target=_run, args=(step, ), daemon=True).start()
+                nrunning += 1
+
+        if nrunning == 0:
+            break
+
+        step, dt, error = results.get()
+        nrunning -= 1
+        if error is None:
+            done.add(step.id)
+            _record(step, 'done', elapsed=dt)
+            print(f'[{step.id}] done ({dt:.1f}s)', flush=True)
+        else:
+            failed.add(step.id)
+            _record(step, 'failed', error=error)
+            print(f'[{step.id}] FAILED: {error}', file=sys.stderr, flush=True)
+
+    print(f'Plan: {len(done)}/{len(steps)} step(s) done in {time.time()-t_start:.1f}s')
+    if failed:
+        print(f'Failed or blocked: {", ".join(sorted(failed))}')
+        print(f'Rerun to resume from the failed step(s), state in {state_file}')
+    return len(failed) == 0
+
+def show_plan(steps, state_file):
+    state = _load_state(state_file)
+    for step in steps.values():
+        s = state.get(step.id, {})
+        status = s.get('status', 'pending') if s.get('digest') == step.digest else 'pending'
+        lock = ' [shared]' if step.shared else ''
+        after = ', '.join(step.after) or '-'
+        print(f'{step.id:<16} {step.op:<16} {step.wib:<22} femb={sorted(step.fembs)}'
+              f' after={after}{lock} {status}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Execute a WIB run plan')
+    parser.add_argument('cmd', choices=['run', 'show'])
+    parser.add_argument('plan', help='plan yml file')
+    parser.add_argument('--state', help='checkpoint file, default: <plan>.state.json')
+    parser.add_argument('-j', '--workers', type=int, default=8,
+                        help='max. concurrent steps, default=8')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint and run all steps')
+    args = parser.parse_args()
+
+    steps = load_plan(args.plan)
+    state_file = args.state or f'{os.path.splitext(args.plan)[0]}.state.json'
+
+    if args.cmd == 'show':
+        show_plan(steps, state_file)
+        sys.exit(0)
+
+    success = run_plan(steps, state_file, args.workers, args.restart)
+    sys.exit(0 if success else 1)
+
+if __name__ == '__main__':
+    main()
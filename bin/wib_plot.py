@@ -3,6 +3,8 @@
 import os
 import sys
 import argparse
+import inspect
+import warnings
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
@@ -12,6 +14,9 @@ from glob import glob
 
 import seaborn as sns
 
+import wib_prof
+
+@wib_prof.timed()
 def mean_psd(adcs, fs, sub_ped=True, return_dB=True, algo=signal.periodogram, **kwargs):
     """
     Mean PSD for multiple waveforms captured in the same conditions
@@ -37,9 +42,12 @@ def mean_psd(adcs, fs, sub_ped=True, return_dB=True, algo=signal.periodogram, **
         Mean power specturm
     """
 
-    wfms = adcs - adcs.mean(axis=1, keepdims=True) if sub_ped else adcs
-    pxx = np.mean([algo(x, fs=fs, **kwargs)[1] for x in wfms], axis=0)
-    freq = np.linspace(0, fs/2., len(pxx))
+    # float32 working copy, pedestal subtracted in place
+    wfms = np.array(adcs, dtype=np.float32)
+    if sub_ped:
+        wfms -= wfms.mean(axis=-1, keepdims=True)
+    freq, pxx = algo(wfms, fs=fs, axis=-1, **kwargs)
+    pxx = pxx.mean(axis=0)
 
     if sub_ped:
         pxx = pxx[1:]
@@ -170,18 +178,115 @@ def annotate_heatmap(im, data=None, valfmt="{x:.2f}",
 
     return texts
 
-def plot_psd(adcs, fs=2e6, num=None):
+def channel_groups(cnr, nchs=128):
+    """
+    Channel grouping for coherent noise removal.
+
+    Parameters
+    ----------
+    cnr: str
+        'asic' (64 channels), 'lane' (32 channels, as in disable_lane) or
+        a text file with a group number for each of the `nchs` channels
+        (negative: channel not corrected)
+    nchs: int
+        number of channels
+
+    Returns
+    -------
+    groups: (nchs, ) int array
+    """
+
+    if cnr == 'asic':
+        return np.arange(nchs) // 64
+    if cnr == 'lane':
+        return np.arange(nchs) // 32
+
+    groups = np.loadtxt(cnr, dtype=int).ravel()
+    if len(groups) != nchs:
+        raise ValueError(f'{cnr}: expect {nchs} channels, got {len(groups)}')
+    return groups
+
+def remove_coherent(adcs, groups, method='median', mask_sigma=5.):
+    """
+    Coherent noise removal: subtract the common mode of each channel group,
+    sample by sample.
+
+    Samples deviating more than `mask_sigma` (robust sigma from MAD) from
+    the pedestal, e.g. pulses, are excluded from the common mode.
+
+    Parameters
+    ----------
+    adcs: (N, C, n) array
+        N events of C channels
+    groups: (C, ) int array
+        group of each channel, see `channel_groups`
+    method: str
+        'median' or 'mean' of the group
+    mask_sigma: float
+        threshold for the pulse exclusion, None to disable
+
+    Returns
+    -------
+    clean: (N, C, n) float32 array
+        pedestal and coherent noise subtracted waveforms
+    cm: (N, G, n) float32 array
+        common mode of each group (in the order of np.unique(groups))
+    """
+
+    x = np.array(adcs, dtype=np.float32)
+    x -= np.median(x, axis=-1, keepdims=True)
+
+    mask = None
+    if mask_sigma is not None:
+        mad = np.median(np.abs(x), axis=-1, keepdims=True)
+        mask = np.abs(x) > mask_sigma * 1.4826 * np.maximum(mad, 0.5)
+
+    labels = np.unique(groups[groups >= 0])
+    cm = np.zeros((x.shape[0], len(labels), x.shape[-1]), dtype=np.float32)
+    for g, label in enumerate(labels):
+        sel = groups == label
+        xs = x[:, sel]
+        excl = mask[:, sel] if mask is not None and mask[:, sel].any() else None
+
+        if method == 'median':
+            if excl is None:
+                cm[:, g] = np.median(xs, axis=1)
+            else:
+                with np.errstate(invalid='ignore'), warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    cm[:, g] = np.nan_to_num(np.nanmedian(np.where(excl, np.nan, xs), axis=1))
+        elif method == 'mean':
+            if excl is None:
+                cm[:, g] = xs.mean(axis=1)
+            else:
+                w = ~excl
+                cm[:, g] = np.where(w, xs, 0).sum(axis=1) / np.maximum(w.sum(axis=1), 1)
+        else:
+            raise ValueError(f'Unknown method {method}')
+
+        x[:, sel] -= cm[:, g][:, None]
+
+    return x, cm
+
+def plot_psd(adcs, fs=2e6, num=None, clean=None):
     fig, axes = plt.subplots(8, 8, figsize=(32, 16),
                             sharex=True, sharey=True,
                             num=num, clear=True)
 
     for ch, ax in zip(range(64), axes.flat):
         data = adcs[:,ch]
-        std = np.std(data - data.mean(axis=-1, keepdims=True))
-        
+        std = np.std(data - data.mean(axis=-1, keepdims=True, dtype=np.float32))
+
         freq, pxx = mean_psd(data, fs=fs)
         ax.plot(freq*1e-6, pxx, linewidth=1, alpha=0.8)
-        ax.text(0.99, 0.97, f'ch{ch:02} std:{std:.1f}', ha='right', va='top', 
+        label = f'ch{ch:02} std:{std:.1f}'
+
+        if clean is not None:
+            freq, pxx = mean_psd(clean[:,ch], fs=fs)
+            ax.plot(freq*1e-6, pxx, linewidth=1, alpha=0.8)
+            label += f' cnr:{clean[:,ch].std():.1f}'
+
+        ax.text(0.99, 0.97, label, ha='right', va='top',
                 transform=ax.transAxes)
 
     fig.text(0.5, 0, 'Frequency [MHz]', ha='center', va='bottom')
@@ -189,8 +294,15 @@ def plot_psd(adcs, fs=2e6, num=None):
     return fig
 
 def plot_mcorr(adcs, num=None):
-    adcs0 = adcs - adcs.mean(axis=-1, keepdims=True)
-    mcorr = np.corrcoef(np.swapaxes(adcs0, 0, 1).reshape(64, -1))
+    # correlation of pedestal subtracted waveforms, accumulated per event
+    # in float32 instead of a float64 copy of all events
+    cov = np.zeros((64, 64))
+    for wfms in adcs:
+        wfms = wfms.astype(np.float32)
+        wfms -= wfms.mean(axis=-1, keepdims=True)
+        cov += wfms @ wfms.T
+    norm = np.sqrt(np.diag(cov))
+    mcorr = cov / np.outer(norm, norm)
 
     fig, ax = plt.subplots(figsize=(32,32), num=num, clear=True)
     labels = [f'ch{ch:02}' for ch in range(64)]
@@ -217,41 +329,64 @@ def plot_wfm(adcs, num=None):
 def plot_pulse(adcs, num=None):
     return plot_wfm(adcs, num)
 
-def save_stats(adcs, output):
+def _std(adcs):
+    # per-event std of each channel in float32 (no float64 copy)
+    return adcs.std(axis=-1, dtype=np.float32).mean(axis=0, dtype=np.float64)
+
+def save_stats(adcs, output, clean=None):
     table = {
         'mean' : adcs.mean(axis=(0,2)),
-        'std' : adcs.std(axis=-1).mean(axis=0),
+        'std' : _std(adcs),
     }
+    if clean is not None:
+        # split intrinsic (after coherent noise removal) and coherent noise
+        table['std_cnr'] = _std(clean)
+        table['std_coherent'] = np.sqrt(np.maximum(table['std']**2 - table['std_cnr']**2, 0))
     df = pd.DataFrame(table)
     df.to_csv(
         f'{output}.csv', index_label='ch',
         float_format='%.3f',
     )
 
-def plot_std(adcs, num=None):
-    table = adcs.std(axis=-1).mean(axis=0)
-    fig, ax = plt.subplots(figsize=(8,6), 
+def plot_std(adcs, num=None, clean=None):
+    table = _std(adcs)
+    fig, ax = plt.subplots(figsize=(8,6),
                            num=num, clear=True)
-    ax.plot(table)
+    ax.plot(table, label='raw')
+    if clean is not None:
+        ax.plot(_std(clean), label='coherent noise removed')
+        ax.legend()
     ax.set_xlabel('Channel')
     ax.set_ylabel('std [ADC]')
     return fig
 
-def plot(adcs, femb, title, output, plot_func, **kwargs):
+@wib_prof.timed()
+def plot(adcs, femb, title, output, plot_func, cnr=None, cnr_method='median', **kwargs):
     fembs = [femb] if isinstance(femb, int) else femb
+    use_cnr = cnr is not None and 'clean' in inspect.signature(plot_func).parameters
 
     for i in fembs:
+        # coherent noise removal of the whole FEMB in one pass
+        clean = None
+        if use_cnr:
+            clean, __ = remove_coherent(adcs[:,i], channel_groups(cnr), cnr_method)
+
         for asic in [0,1]:
             out_prefix = output.format(i, asic)
             print(out_prefix)
-            data = adcs[:,i,:64] if asic == 0 else adcs[:,i,64:]
-            fig = plot_func(data, **kwargs)
+            chs = slice(0, 64) if asic == 0 else slice(64, 128)
+            data = adcs[:,i,chs]
+            kw = dict(kwargs, clean=clean[:,chs]) if use_cnr else kwargs
+            fig = plot_func(data, **kw)
             fig.suptitle(title.format(i, asic))
             fig.tight_layout(rect=(0,0,1,0.97))
-            fig.savefig(f'{out_prefix}.png')
+            with wib_prof.timer('savefig'):
+                fig.savefig(f'{out_prefix}.png')
 
             if plot_func.__name__ == 'plot_std':
-                save_stats(data, out_prefix.replace('std_', 'stats_'))
+                dirname, fname = os.path.split(out_prefix)
+                save_stats(data, os.path.join(dirname, fname.replace('std_', 'stats_', 1)),
+                           clean=kw.get('clean'))
 
 def _bind(parser, func, **kwargs):
     name = func.__name__
@@ -261,32 +396,202 @@ def _bind(parser, func, **kwargs):
     p.add_argument('-d', '--dataset', required=True)
     p.add_argument('--femb', type=int, choices=range(4), nargs='+')
     p.add_argument('--cold', action='store_true')
-    
+    p.add_argument('--no-align', action='store_true',
+                   help='do not align buffers using timestamps')
+    p.add_argument('--cnr', help='coherent noise removal per asic, lane'
+                   ' or a channel map file (psd and std only)')
+    p.add_argument('--cnr-method', choices=['median', 'mean'], default='median')
+
     if func.__name__ == 'plot_psd':
         p.add_argument('--fs', type=float, default=1e6/0.512)
+        p.add_argument('--lines', default=os.environ.get('WIB_LINES'),
+                       help='find noise lines and add them to the history csv LINES'
+                            ' (default: $WIB_LINES, see wib_lines.py)')
+
+    if func.__name__ == 'plot_std':
+        p.add_argument('--golden', default=os.environ.get('WIB_GOLDEN'),
+                       help='check noise against golden references in GOLDEN'
+                            ' (default: $WIB_GOLDEN)')
 
     p.set_defaults(func=func)
 
-def _read(path):
-    if os.path.isfile(path):
-        print(f'Reading {path}')
-        content = np.load(path)
-        return np.array([content['data']])
+def check_timestamps(t, step=None):
+    """
+    Integrity check of the timestamps from one spy buffer.
 
-    if os.path.isdir(path):
-        files = glob(os.path.join(path, '*.npz'))
+    Parameters
+    ----------
+    t: (n, ) array
+        timestamps
+    step: int, optional
+        expected timestamp delta between samples.
+        Use the most common delta if `None`.
 
-        print(f'Reading {len(files)} files from {path}')
-        data = [np.load(path)['data'] for path in files]
+    Returns
+    -------
+    report: dict
+        step, number of gaps and missing samples, duplicates,
+        non-unit deltas (not a multiple of step, or negative)
+    """
 
-        # slightly different sizes returned by spy buffer
-        sizes = [arr.shape[-1] for arr in data]
-        n = np.min(sizes)
-        data = np.array([arr[:,:,:n] for arr in data])
-        return data
+    t = np.asarray(t).astype(np.int64)
+    dt = np.diff(t)
+    if step is None:
+        values, counts = np.unique(dt, return_counts=True)
+        step = int(values[np.argmax(counts)]) if len(values) else 0
+
+    if step <= 0:
+        return dict(step=step, gaps=0, missing=0, duplicates=0, bad_deltas=len(dt))
+
+    gaps = dt > step
+    return dict(
+        step=step,
+        gaps=int(np.count_nonzero(gaps)),
+        missing=int(np.sum(dt[gaps] // step - 1)),
+        duplicates=int(np.count_nonzero(dt == 0)),
+        bad_deltas=int(np.count_nonzero((dt < 0) | (dt % step != 0))),
+    )
+
+def align(ts, data):
+    """
+    Align buf0 (FEMB0-1) and buf1 (FEMB2-3) in time using the timestamps.
+
+    Both buffers are resampled to the common time window on a regular grid.
+    Duplicated samples are dropped and missing samples (gaps) are padded
+    with the previous sample.
 
-    print(f"No input file in {path}", file=sys.stderr)
-    sys.exit(1)
+    Parameters
+    ----------
+    ts: (2, n) array
+        timestamps of buf0 and buf1
+    data: (4, 128, n) array
+        ADC samples
+
+    Returns
+    -------
+    output: (4, 128, m) array
+        time aligned ADC samples
+    report: list of dict
+        integrity report for each active buffer
+
+    Raises
+    ------
+    ValueError
+        the buffers have no common time window
+    """
+
+    ts = np.asarray(ts).astype(np.int64)
+    active = [b for b in range(2) if np.any(ts[b])]
+    reports = [dict(buf=b, **check_timestamps(ts[b])) for b in active]
+
+    aligned = len(active) > 0 and all(
+        r['step'] > 0 and r['bad_deltas'] == 0 for r in reports)
+    if not aligned:
+        for r in reports:
+            r.update(aligned=False, offset=0, padded=0, length=data.shape[-1])
+        return data, reports
+
+    step = reports[0]['step']
+    t_start = max(ts[b, 0] for b in active)
+    t_end = min(ts[b, -1] for b in active)
+    if t_end < t_start:
+        raise ValueError(f'no common time window of buf0 and buf1'
+                         f' ({t_start - t_end} ticks apart)')
+    m = (t_end - t_start) // step + 1
+    grid = t_start + step * np.arange(m)
+
+    output = np.zeros(data.shape[:2] + (m, ), dtype=data.dtype)
+    for b, r in zip(active, reports):
+        t = ts[b]
+        # last sample at or before each grid point
+        idx = np.searchsorted(t, grid, side='right') - 1
+        output[2*b:2*b+2] = data[2*b:2*b+2, :, idx]
+        r.update(
+            aligned=True,
+            offset=int(np.searchsorted(t, t_start)),
+            padded=int(np.count_nonzero(t[idx] != grid)),
+            length=int(m),
+        )
+    return output, reports
+
+@wib_prof.timed()
+def _read(path, do_align=True, return_report=False):
+    """
+    Read events recorded by wib_daq.py from a file or a directory.
+
+    Parameters
+    ----------
+    path: str
+        npz file or directory of npz files
+    do_align: bool
+        align buf0 and buf1 in time using timestamps
+    return_report: bool
+        also return the timestamp integrity report
+
+    Returns
+    -------
+    data: (N, 4, 128, n) uint16 array
+        events truncated to the shortest length
+    report: pandas.DataFrame
+        integrity report for each event and buffer (if `return_report`)
+    """
+
+    if os.path.isfile(path):
+        files = [path]
+        print(f'Reading {path}')
+    elif os.path.isdir(path):
+        files = sorted(glob(os.path.join(path, '*.npz')))
+        print(f'Reading {len(files)} files from {path}')
+    else:
+        files = []
+
+    if len(files) == 0:
+        print(f"No input file in {path}", file=sys.stderr)
+        sys.exit(1)
+
+    data = None
+    report = []
+    i = 0
+    for fpath in files:
+        content = np.load(fpath)
+        arr = content['data'].astype(np.uint16, copy=False)
+        if do_align and 'timestamps' in content:
+            try:
+                arr, rows = align(content['timestamps'], arr)
+            except ValueError as e:
+                print(f'Skip {fpath}: {e}', file=sys.stderr)
+                continue
+            for row in rows:
+                report.append(dict(file=os.path.basename(fpath), **row))
+
+        # preallocate uint16 output with the first event,
+        # slightly different sizes returned by spy buffer
+        if data is None:
+            data = np.empty((len(files), ) + arr.shape, dtype=np.uint16)
+            n = arr.shape[-1]
+        n = min(n, arr.shape[-1])
+        data[i, ..., :n] = arr[..., :n]
+        i += 1
+
+    if i == 0:
+        print(f'No event to read in {path}', file=sys.stderr)
+        sys.exit(1)
+    data = data[:i, ..., :n]
+
+    if return_report:
+        return data, pd.DataFrame(report)
+    return data
+
+def _print_report(report):
+    if len(report) == 0:
+        return
+
+    cols = ['gaps', 'missing', 'duplicates', 'bad_deltas', 'padded']
+    summary = report.groupby('buf')[cols].sum()
+    summary['events'] = report.groupby('buf').size()
+    summary['not_aligned'] = report.groupby('buf')['aligned'].apply(lambda x: (~x).sum())
+    print('Timestamp integrity:')
+    print(summary.to_string())
 
 def _parse_tp(path):
     i = path.find('0x39')
@@ -306,11 +611,109 @@ def _parse_tp(path):
     return _map.get(status)
 
 
+def plots_for(path):
+    """
+    Default plots for a dataset, based on the ASIC setting in its name
+    (same as wib_plot2).
+
+    Returns
+    -------
+    plot_funcs: list
+        [plot_psd, plot_mcorr, plot_std] for 0x39[048c],
+        [plot_pulse] for 0x39[159d], empty list for unknown setting
+    """
+
+    i = path.find('0x39')
+    if i == -1: return []
+
+    status = int(path[i:i+5], 0)
+    if status & 0x1:
+        return [plot_pulse]
+    return [plot_psd, plot_mcorr, plot_std]
+
+def process(input, dataset, plot_funcs, femb=None, cold=False,
+            do_align=True, outdir='', golden=None, cnr=None,
+            cnr_method='median', lines=None, **kwargs):
+    """
+    Read a dataset once and make the given plots.
+
+    Parameters
+    ----------
+    input: str
+        npz file or directory of npz files
+    dataset: str
+        dataset name used in titles and output file names
+    plot_funcs: list
+        plot functions, e.g. [plot_psd, plot_std]
+    femb: list of int, optional
+        FEMBs to plot, default: all active FEMBs
+    cold: bool
+        cold condition (only for naming)
+    do_align: bool
+        align buffers using timestamps
+    outdir: str
+        output directory, default: current directory
+    golden: str, optional
+        directory of golden references, run the noise check (see wib_check.py)
+        together with plot_std
+    cnr: str, optional
+        coherent noise removal per 'asic', 'lane' or channel map file,
+        raw and cleaned PSD/std are reported (see `remove_coherent`)
+    cnr_method: str
+        'median' or 'mean' common mode
+    lines: str, optional
+        history csv, find the noise lines (see wib_lines.py) together
+        with plot_psd
+    kwargs: dict
+        extra arguments for the plot functions (e.g. fs for plot_psd),
+        only passed to the functions accepting them
+    """
+
+    tp = _parse_tp(input)
+    cond = 'Cold' if cold else 'Room'
+    title = f'{dataset}_FEMB{{}}_ASIC{{}}_{tp}_{cond}'
+
+    data, report = _read(input, do_align=do_align, return_report=True)
+    _print_report(report)
+    if len(report) > 0:
+        fname = f'integrity_{dataset}_{tp}_{cond}.csv'
+        report.to_csv(os.path.join(outdir, fname), index=False)
+
+    if femb is None:
+        is_active = np.any(data, axis=(0,2,3))
+        femb = np.where(is_active)[0]
+
+    for func in plot_funcs:
+        plot_type = func.__name__.replace('plot_', '')
+        output = os.path.join(outdir, f'{plot_type}_{title}')
+        pars = inspect.signature(func).parameters
+        kw = {k: v for k, v in kwargs.items() if k in pars}
+        plot(data, femb, title, output, func, cnr=cnr, cnr_method=cnr_method, **kw)
+        plt.close('all')
+
+    if golden is not None and plot_std in plot_funcs:
+        from wib_check import check, _parse_key
+        sn, __, setting = _parse_key(input)
+        fname = f'check_{dataset}_{tp}_{cond}.csv'
+        check(input, golden, data=data, output=os.path.join(outdir, fname),
+              key=(sn, cond, setting), fs=kwargs.get('fs', 1e6/0.512))
+
+    if lines is not None and plot_psd in plot_funcs:
+        from wib_lines import find_lines, add_history
+        from wib_check import _parse_key
+        sn, __, setting = _parse_key(input)
+        found, __ = find_lines(data, fs=kwargs.get('fs', 1e6/0.512))
+        fname = f'lines_{dataset}_{tp}_{cond}.csv'
+        found.to_csv(os.path.join(outdir, fname), index=False, float_format='%.3f')
+        add_history(lines, input, found, key=(sn, cond, setting))
+
 def main():
     sns.set_context('talk')
     sns.set_style('white')
 
     parser = argparse.ArgumentParser(description='WIB Cryo Plot')
+    parser.add_argument('--profile', action='store_true',
+                        help='write profile and timers (see wib_prof.py)')
     subparsers = parser.add_subparsers()
     _bind(subparsers, plot_psd)
     _bind(subparsers, plot_mcorr)
@@ -319,26 +722,18 @@ def main():
     _bind(subparsers, plot_std)
 
     args = parser.parse_args()
+    wib_prof.start('wib_plot', args.profile)
     kwargs = vars(args).copy()
+    kwargs.pop('profile')
     kwargs.pop('input')
     kwargs.pop('dataset')
     kwargs.pop('femb')
     kwargs.pop('cold')
+    kwargs.pop('no_align')
     kwargs.pop('func')
 
-    plot_type = args.func.__name__.replace('plot_', '')
-    tp = _parse_tp(args.input)
-    cond = 'Cold' if args.cold else 'Room'
-    title = f'{args.dataset}_FEMB{{}}_ASIC{{}}_{tp}_{cond}'
-    output = f'{plot_type}_{args.dataset}_FEMB{{}}_ASIC{{}}_{tp}_{cond}'
-
-    data = _read(args.input)
-
-    if args.femb is None:
-        is_active = np.any(data, axis=(0,2,3))
-        args.femb = np.where(is_active)[0]
-
-    plot(data, args.femb, title, output, args.func, **kwargs)
+    process(args.input, args.dataset, [args.func], femb=args.femb,
+            cold=args.cold, do_align=not args.no_align, **kwargs)
 
 if __name__ == '__main__':
     main()
@@ -13,14 +13,19 @@ from glob import glob
 
 import seaborn as sns
 
+import wib_prof
+
 def main():
     sns.set_context('talk')
     sns.set_style('ticks')
 
     parser = argparse.ArgumentParser(description='WIB Cryo Summary Plot')
     parser.add_argument('indir', metavar='DIRECTORY', help='input directory')
+    parser.add_argument('--profile', action='store_true',
+                        help='write profile and timers (see wib_prof.py)')
 
     args = parser.parse_args()
+    wib_prof.start('wib_plot_summary', args.profile)
     files = glob(os.path.join(args.indir, 'stats_*.csv'))
 
     prefixes = set()
@@ -54,7 +59,8 @@ def main():
         outpath = os.path.join(args.indir, f'summary_{prefix}_{suffix}.png')
         fig.suptitle(prefix)
         fig.tight_layout(rect=(0,0,1,0.97))
-        fig.savefig(outpath)
+        with wib_prof.timer('savefig'):
+            fig.savefig(outpath)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+'''
+Opt-in profiling for the wib scripts.
+
+Enabled by `--profile` or WIB_PROFILE=1 (inherited by sub-processes, e.g.
+the wib_plot2 workers). Each invocation writes to $WIB_PROFILE_DIR
+(default: current directory)
+
+    <prog>_<YYYYmmdd_HHMMSS>_<pid>.prof     cProfile stats (pstats, snakeviz)
+    <prog>_<YYYYmmdd_HHMMSS>_<pid>.folded   sampled stacks of all threads
+                                            (flamegraph.pl, speedscope)
+    <prog>_<YYYYmmdd_HHMMSS>_<pid>.txt      named timers and top functions
+
+Named timers around the hot spots cost one flag check when disabled:
+
+    @wib_prof.timed()
+    def _read(...): ...
+
+    with wib_prof.timer('savefig'):
+        fig.savefig(...)
+
+Show a profile:
+    wib_prof.py wib_plot_20261018_101500_1234.prof [-n 30]
+'''
+
+import os
+import sys
+import time
+import atexit
+import pstats
+import cProfile
+import argparse
+import threading
+import functools
+import contextlib
+from collections import Counter
+
+_enabled = os.environ.get('WIB_PROFILE', '').lower() not in ['', '0', 'false', 'no']
+_lock = threading.Lock()
+_timers = {}    # name -> [calls, total, max]
+_noop = contextlib.nullcontext()
+
+def enabled():
+    return _enabled
+
+class _Timer:
+    __slots__ = ['name', 't0']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        with _lock:
+            stat = _timers.setdefault(self.name, [0, 0., 0.])
+            stat[0] += 1
+            stat[1] += dt
+            stat[2] = max(stat[2], dt)
+
+def timer(name):
+    """
+    Named timer (context manager), no-op if profiling is disabled.
+    """
+
+    return _Timer(name) if _enabled else _noop
+
+def timed(name=None):
+    """
+    Decorator version of `timer`, named after the function by default.
+    """
+
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Sampler(threading.Thread):
+    """
+    Sample the stacks of all threads (folded format, one line per stack).
+
+    Parameters
+    ----------
+    interval: float
+        seconds between samples
+    """
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._halt = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self._halt.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}'
+                                 f':{code.co_firstlineno})')
+                    frame = frame.f_back
+                if tid not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack.append(names.get(tid, str(tid)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+class Profile:
+    """
+    cProfile of the calling thread, stacks of all threads and the named timers.
+
+    Parameters
+    ----------
+    prog: str
+        name of the output files
+    outdir: str, optional
+        default: $WIB_PROFILE_DIR or the current directory
+    """
+
+    def __init__(self, prog, outdir=None):
+        outdir = outdir or os.environ.get('WIB_PROFILE_DIR', '.')
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        self.prefix = os.path.join(outdir, f'{prog}_{stamp}_{os.getpid()}')
+        self._prof = cProfile.Profile()
+        self._sampler = Sampler()
+        self._stats = None
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.prefix) or '.', exist_ok=True)
+        with _lock:
+            _timers.clear()
+        self._t0 = time.time()
+        self._sampler.start()
+        self._prof.enable()
+        return self
+
+    def add(self, prof):
+        """Merge the stats of another cProfile.Profile (e.g. another thread)."""
+        with _lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(prof)
+            else:
+                self._stats.add(prof)
+
+    def stop(self):
+        self._prof.disable()
+        self._sampler.stop()
+        self.add(self._prof)
+
+        self._stats.dump_stats(f'{self.prefix}.prof')
+        with open(f'{self.prefix}.folded', 'w') as f:
+            for stack, n in sorted(self._sampler.stacks.items()):
+                f.write(f'{stack} {n}\n')
+
+        with open(f'{self.prefix}.txt', 'w') as f:
+            f.write(f'{" ".join(sys.argv)}\n')
+            f.write(f'wall time {time.time()-self._t0:.3f}s\n\n')
+            f.write(format_timers())
+            f.write('\n')
+            self._stats.stream = f
+            self._stats.sort_stats('cumulative').print_stats(30)
+        print(f'Profile written to {self.prefix}.{{prof,folded,txt}}', file=sys.stderr)
+
+def format_timers():
+    with _lock:
+        items = sorted(_timers.items(), key=lambda x: -x[1][1])
+    lines = [f'{"timer":<24} {"calls":>8} {"total [s]":>10} {"mean [ms]":>10} {"max [ms]":>10}']
+    for name, (n, total, tmax) in items:
+        lines.append(f'{name:<24} {n:>8} {total:>10.3f} {total/n*1e3:>10.2f} {tmax*1e3:>10.2f}')
+    return '\n'.join(lines) + '\n'
+
+_profile = None
+
+def start(prog, force=False):
+    """
+    Profile this process until exit if `force` (--profile) or $WIB_PROFILE.
+
+    Returns
+    -------
+    enabled: bool
+    """
+
+    global _enabled, _profile
+    if not (force or _enabled) or _profile is not None:
+        return _profile is not None
+
+    # sub-processes profile themselves
+    os.environ['WIB_PROFILE'] = '1'
+    _enabled = True
+    _profile = Profile(prog).start()
+    atexit.register(_profile.stop)
+    return True
+
+@contextlib.contextmanager
+def profile(prog):
+    """
+    Profile a block (e.g. one task of a worker process) if enabled.
+    """
+
+    if not _enabled:
+        yield
+        return
+
+    prof = Profile(prog).start()
+    try:
+        yield
+    finally:
+        prof.stop()
+
+def profiled(func):
+    """
+    Decorator for functions called from other threads (e.g. dash callbacks):
+    each call is profiled and merged into the process profile.
+    """
+
+    label = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profile is None:
+            return func(*args, **kwargs)
+
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # one profiler at a time (python >= 3.12), timer only
+            prof = None
+        try:
+            with _Timer(label):
+                return func(*args, **kwargs)
+        finally:
+            if prof is not None:
+                prof.disable()
+                _profile.add(prof)
+    return wrapper
+
+def main():
+    parser = argparse.ArgumentParser(description='Show a profile written by wib_prof')
+    parser.add_argument('input', help='.prof file')
+    parser.add_argument('-n', type=int, default=30, help='number of functions, default=30')
+    parser.add_argument('-s', '--sort', default='cumulative',
+                        help='pstats sort key, default=cumulative')
+    args = parser.parse_args()
+
+    txt = args.input.replace('.prof', '.txt')
+    if os.path.isfile(txt):
+        with open(txt) as f:
+            print(f.read().split('\n\n', 2)[1])
+    pstats.Stats(args.input).sort_stats(args.sort).print_stats(args.n)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+'''
+Pulse-synchronous averaging of pulser runs (used by `wib_daq.py --trigger`).
+
+The pulser runs at a fixed period (in samples) locked to the timing clock,
+so the phase of each sample is its timestamp modulo the period. Samples of
+all events are folded on that phase and accumulated per channel
+(sum, sum of squares, counts), no raw event is kept. The result is an
+averaged pulse shape per channel with its spread and standard error.
+
+Example:
+    wib_daq.py -w 192.168.121.1 --trigger --pulse-period 1000 -n 2000 -o run1
+    wib_pulse.py plot run1_pulse_avg.npz
+'''
+
+import os
+import argparse
+import numpy as np
+
+TS_STEP = 32    # timestamp ticks (62.5 MHz) per sample
+
+def estimate_period(data, min_period=16):
+    """
+    Pulser period in samples from the autocorrelation of one event
+    (channel average of each active FEMB).
+
+    Parameters
+    ----------
+    data: (4, 128, n) array
+        ADC samples
+    min_period: int
+        shortest period to consider
+
+    Returns
+    -------
+    period: int or None
+        `None` without a clear periodic signal
+    """
+
+    x = np.asarray(data, dtype=np.float32).mean(axis=1)
+    x = x[np.any(x, axis=-1)]
+    if len(x) == 0:
+        return None
+
+    n = x.shape[-1]
+    x = x - x.mean(axis=-1, keepdims=True)
+    spec = np.fft.rfft(x, 2*n, axis=-1)
+    ac = np.fft.irfft(np.abs(spec)**2, axis=-1)[:, :n].sum(axis=0)
+    ac /= n - np.arange(n)   # unbiased, few periods per event
+    if ac[0] <= 0:
+        return None
+    ac /= ac[0]
+
+    # max. of the autocorrelation beyond the pulse width
+    lags = np.arange(min_period, n // 2)
+    if len(lags) == 0:
+        return None
+    lag = lags[np.argmax(ac[lags])]
+    return int(lag) if ac[lag] > 0.5 else None
+
+class PulseAverager:
+    """
+    Streaming pulse average folded on the pulser phase.
+
+    Parameters
+    ----------
+    period: int, optional
+        pulser period in samples, estimated from the first event if `None`
+    offset: int
+        phase offset in samples (phase = timestamp / TS_STEP + offset)
+    """
+
+    def __init__(self, period=None, offset=0):
+        self.period = None
+        self.offset = int(offset)
+        self.nevents = 0
+        if period is not None:
+            self._alloc(int(period))
+
+    def _alloc(self, period):
+        self.period = period
+        self._sum = np.zeros((4, 128, period))
+        self._sum2 = np.zeros((4, 128, period))
+        self._count = np.zeros((4, period))
+
+    def add(self, ts, data):
+        """
+        Fold one event.
+
+        Parameters
+        ----------
+        ts: (2, n) array
+            timestamps of buf0 (FEMB0-1) and buf1 (FEMB2-3)
+        data: (4, 128, n) array
+            ADC samples
+
+        Returns
+        -------
+        added: bool
+            `False` if the period cannot be estimated (no pulse)
+        """
+
+        if self.period is None:
+            period = estimate_period(data)
+            if period is None:
+                return False
+            print(f'[pulse] estimated period {period} samples')
+            self._alloc(period)
+
+        ts = np.asarray(ts).astype(np.int64)
+        p = self.period
+        for b in range(2):
+            if not np.any(ts[b]):
+                continue
+            phase = (ts[b] // TS_STEP + self.offset) % p
+            count = np.bincount(phase, minlength=p)
+            idx = (np.arange(128)[:, None] * p + phase).ravel()
+            for femb in [2*b, 2*b+1]:
+                x = np.asarray(data[femb], dtype=np.float64).ravel()
+                if not x.any():
+                    continue
+                self._sum[femb] += np.bincount(idx, weights=x, minlength=128*p).reshape(128, p)
+                self._sum2[femb] += np.bincount(idx, weights=x*x, minlength=128*p).reshape(128, p)
+                self._count[femb] += count
+        self.nevents += 1
+        return True
+
+    @property
+    def npulses(self):
+        """Min. number of samples per phase (pulses averaged) of the active FEMBs."""
+        if self.period is None:
+            return 0
+        active = self._count.any(axis=-1)
+        return int(self._count[active].min()) if active.any() else 0
+
+    def result(self):
+        """
+        Returns
+        -------
+        output: dict
+            mean, std, sem (4, 128, period) arrays, count (4, period),
+            with the pulse peak moved to 1/4 of the period
+        """
+
+        count = np.maximum(self._count, 1)[:, None, :]
+        mean = self._sum / count
+        var = np.maximum(self._sum2 / count - mean**2, 0)
+        std = np.sqrt(var)
+
+        # move the peak (largest excursion of the FEMB average) to period/4
+        active = self._count.any(axis=-1)
+        shift = 0
+        if active.any():
+            avg = mean[active].mean(axis=(0, 1))
+            peak = np.argmax(np.abs(avg - np.median(avg)))
+            shift = self.period // 4 - peak
+
+        roll = lambda x: np.roll(x, shift, axis=-1)
+        return dict(
+            mean=roll(mean).astype(np.float32),
+            std=roll(std).astype(np.float32),
+            sem=roll(std / np.sqrt(count)).astype(np.float32),
+            count=roll(self._count).astype(np.int64),
+            period=self.period,
+            offset=self.offset - shift,
+            nevents=self.nevents,
+        )
+
+    def save(self, path):
+        if self.period is None:
+            print('[pulse] no pulse found, nothing to save')
+            return False
+        np.savez_compressed(path, **self.result())
+        return True
+
+def plot_average(path, outdir=None, fembs=None):
+    """
+    Averaged pulse shapes of each ASIC with the standard error band.
+
+    Parameters
+    ----------
+    path: str
+        output of `PulseAverager.save`
+    outdir: str, optional
+        default: next to `path`
+    fembs: list of int, optional
+        default: all active FEMBs
+    """
+
+    import matplotlib.pyplot as plt
+
+    avg = np.load(path)
+    mean, sem, count = avg['mean'], avg['sem'], avg['count']
+    outdir = outdir or os.path.dirname(path) or '.'
+    if fembs is None:
+        fembs = np.flatnonzero(count.any(axis=-1))
+
+    x = np.arange(mean.shape[-1])
+    for femb in fembs:
+        for asic in [0, 1]:
+            fig, ax = plt.subplots(figsize=(8,6))
+            for ch in range(64*asic, 64*asic+64):
+                m, e = mean[femb, ch], sem[femb, ch]
+                ax.plot(x, m, lw=0.8)
+                ax.fill_between(x, m-e, m+e, alpha=0.3)
+            ax.set_xlabel('Sample (pulser phase)')
+            ax.set_ylabel('ADC')
+            ax.set_title(f'FEMB{femb} ASIC{asic}, {int(avg["nevents"])} events,'
+                         f' {int(count[femb].min())} pulses')
+            fig.tight_layout()
+            output = os.path.join(outdir, f'pulse_avg_FEMB{femb}_ASIC{asic}.png')
+            fig.savefig(output)
+            plt.close(fig)
+            print(output)
+
+def main():
+    parser = argparse.ArgumentParser(description='Pulse-synchronous averages')
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+    p = subparsers.add_parser('plot', help='plot averaged pulses')
+    p.add_argument('input', help='<run>_pulse_avg.npz')
+    p.add_argument('-o', '--outdir', help='default: next to the input')
+    p.add_argument('--femb', type=int, nargs='+', choices=range(4),
+                   help='default: all active FEMBs')
+    p = subparsers.add_parser('period', help='estimate the pulser period of recorded events')
+    p.add_argument('input', nargs='+', help='npz file(s) recorded by wib_daq.py')
+    args = parser.parse_args()
+
+    if args.cmd == 'plot':
+        plot_average(args.input, args.outdir, args.femb)
+    elif args.cmd == 'period':
+        for fpath in args.input:
+            print(f'{fpath}: {estimate_period(np.load(fpath)["data"])}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+'''
+Ramp mode verification and bit error counting.
+
+In ramp mode (`wib_cryo.py enable_ramp`) every channel sends a 12-bit
+counter. The expected ramp of each channel is predicted from the first
+samples of a capture (step and phase, the most common values, indexed by
+the timestamps so dropped samples are not errors), then the whole
+(4, 128, n) capture is compared with it in one pass:
+
+    bit errors    per lane (32 channels) and bit position
+    stuck bits    a bit which does not toggle while the ramp does
+    misordered    bits carrying another bit of the ramp (e.g. LaneBitOrder)
+    unlocked      channels without a ramp (prediction failed)
+
+Bit errors are accumulated over the captures into a BER estimate per lane
+(95% upper limit 3/bits without error). Stuck, misordered and unlocked
+channels are reported separately and not counted in the BER.
+
+Example:
+    wib_ramp.py -w 192.168.121.1 --femb 0 1 --set-ramp -n 1000
+    wib_ramp.py --fake --ber 1e-7 -n 100
+'''
+
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+import wib_prof
+from wib_sim import bit_reverse
+
+NBITS = 12
+MASK = (1 << NBITS) - 1
+LANE = 32           # channels per lane
+
+def _mode(values, weights=None, nvalues=1 << NBITS):
+    """
+    Most common value of each row and its fraction, all rows at once.
+
+    Parameters
+    ----------
+    values: (C, m) int array
+        values in [0, nvalues)
+    weights: (C, m) array, optional
+
+    Returns
+    -------
+    mode: (C, ) int array
+    frac: (C, ) float array
+    """
+
+    nrows, m = values.shape
+    idx = (values + nvalues * np.arange(nrows)[:, None]).ravel()
+    w = None if weights is None else weights.ravel()
+    counts = np.bincount(idx, w, minlength=nrows*nvalues).reshape(nrows, nvalues)
+    mode = counts.argmax(axis=-1)
+    total = m if weights is None else np.maximum(weights.sum(axis=-1), 1)
+    return mode, counts[np.arange(nrows), mode] / total
+
+def sample_index(ts, n):
+    """
+    Sample number of each sample w.r.t. the first one from the timestamps
+    (consecutive samples if there are no timestamps).
+
+    Returns
+    -------
+    k: (2, n) int array
+        buf0 (FEMB0-1) and buf1 (FEMB2-3)
+    """
+
+    ts = np.asarray(ts).astype(np.int64)
+    k = np.tile(np.arange(n), (2, 1))
+    for b in range(2):
+        if not np.any(ts[b]) or n < 2:
+            continue
+        step = int(np.median(np.diff(ts[b])))
+        if step > 0:
+            k[b] = (ts[b] - ts[b, 0]) // step
+    return k
+
+def predict(data, k, nfit=64, min_frac=0.5, step=None):
+    """
+    Expected ramp of each channel from the first `nfit` samples.
+
+    Parameters
+    ----------
+    data: (C, n) uint16 array
+    k: (C, n) int array
+        sample number of each sample
+    nfit: int
+        number of samples for the prediction
+    min_frac: float
+        min. fraction of the samples agreeing with the prediction
+    step: int, optional
+        ramp increment per sample, estimated if `None`
+
+    Returns
+    -------
+    expected: (C, n) uint16 array
+    locked: (C, ) bool array
+        the prediction agrees with `min_frac` of the samples
+    """
+
+    x = data[:, :nfit].astype(np.int64)
+    kf = k[:, :nfit]
+
+    # step of the consecutive samples
+    if step is None:
+        d = np.diff(x, axis=-1) & MASK
+        step, __ = _mode(d, (np.diff(kf, axis=-1) == 1).astype(float))
+    else:
+        step = np.full(len(x), step)
+
+    # phase of the ramp
+    phase, frac = _mode((x - step[:, None] * kf) & MASK)
+    expected = ((phase[:, None] + step[:, None] * k) & MASK).astype(np.uint16)
+    return expected, (frac >= min_frac) & (step > 0)
+
+def _bits(x):
+    """(C, n) 12-bit values to (C, n, 12) 0/1 bits."""
+    return ((x[..., None] >> np.arange(NBITS, dtype=x.dtype)) & 1)
+
+class RampChecker:
+    """
+    Bit errors of ramp captures, accumulated per lane.
+
+    Parameters
+    ----------
+    nfit: int
+        samples used to predict the ramp of each channel
+    min_frac: float
+        min. fraction of samples agreeing with the prediction (locked)
+    bad_frac: float
+        error rate of a channel (per sample) above which its bits are
+        checked for stuck or misordered bits
+    """
+
+    def __init__(self, nfit=64, min_frac=0.5, bad_frac=0.05):
+        self.nfit = nfit
+        self.min_frac = min_frac
+        self.bad_frac = bad_frac
+
+        self.ncaptures = 0
+        self.bits = np.zeros((4, 128 // LANE))              # bits compared
+        self.errors = np.zeros((4, 128 // LANE, NBITS))     # bit errors per position
+        self.stuck = np.zeros((4, 128), dtype=int)          # captures with a stuck bit
+        self.misordered = np.zeros((4, 128), dtype=int)
+        self.unlocked = np.zeros((4, 128), dtype=int)
+
+    def check(self, ts, data):
+        """
+        Check one capture and add it to the totals.
+
+        Parameters
+        ----------
+        ts: (2, n) array
+            timestamps of buf0 and buf1
+        data: (4, 128, n) array
+            ADC samples
+
+        Returns
+        -------
+        result: dict
+            bit errors (4, 4, 12) of the capture, and the channels (femb, ch)
+            with stuck bits {(femb, ch): [(bit, value), ...]},
+            misordered {(femb, ch): [observed bit -> ramp bit, ...]}
+            and unlocked
+        """
+
+        data = np.asarray(data, dtype=np.uint16)
+        nfembs, nchs, n = data.shape
+        active = np.any(data, axis=(1, 2))
+
+        k = np.repeat(sample_index(ts, n), 2 * nchs, axis=0)
+        x = data.reshape(nfembs * nchs, n)
+        expected, locked = predict(x, k, self.nfit, self.min_frac)
+        locked &= np.repeat(active, nchs)
+
+        # no ramp: try the nominal step (a stuck low bit breaks its estimate,
+        # and halves the samples agreeing with the prediction)
+        rows = np.flatnonzero(~locked & np.repeat(active, nchs))
+        if len(rows):
+            exp1, lock1 = predict(x[rows], k[rows], self.nfit, self.min_frac / 2, step=1)
+            expected[rows[lock1]] = exp1[lock1]
+            locked[rows[lock1]] = True
+
+        err = (x ^ expected) & MASK
+        nerr = np.count_nonzero(err, axis=-1)
+        good = locked.copy()
+
+        result = dict(errors=np.zeros((nfembs, nchs // LANE, NBITS), dtype=int),
+                      stuck={}, misordered={}, unlocked=[])
+
+        # still no ramp: try the reversed bit order
+        rows = np.flatnonzero(~locked & np.repeat(active, nchs))
+        if len(rows):
+            __, rlocked = predict(bit_reverse(x[rows]), k[rows], self.nfit, self.min_frac)
+            for c, rev in zip(rows, rlocked):
+                key = divmod(int(c), nchs)
+                if rev:
+                    result['misordered'][key] = [(b, NBITS-1-b) for b in range(NBITS)
+                                                 if b != NBITS-1-b]
+                else:
+                    result['unlocked'].append(key)
+
+        # systematic errors, bit by bit
+        for c in np.flatnonzero(locked & (nerr > self.bad_frac * n)):
+            obs, exp = _bits(x[c]), _bits(expected[c])
+            key = divmod(int(c), nchs)
+
+            # bit i of the data carries bit j of the ramp
+            p = exp.mean(axis=0)
+            balanced = np.flatnonzero((p > 0.1) & (p < 0.9))
+            match = (2. * obs[:, balanced] - 1).T @ (2. * exp[:, balanced] - 1) / n
+            src = balanced[match.argmax(axis=-1)]
+            moved = [(int(i), int(j)) for i, j, m in zip(balanced, src, match.max(axis=-1))
+                     if i != j and m > 0.9]
+            if moved:
+                result['misordered'][key] = moved
+                good[c] = False
+                continue
+
+            # (almost) constant while the ramp bit toggles, tolerating bit errors
+            q = obs.mean(axis=0)
+            stuck = (p > 0.1) & (p < 0.9) & ((q < self.bad_frac) | (q > 1 - self.bad_frac))
+            if stuck.any():
+                result['stuck'][key] = [(int(b), int(q[b] > 0.5)) for b in np.flatnonzero(stuck)]
+                good[c] = False
+
+        # random bit errors of the good channels
+        counts = np.zeros((nfembs * nchs, NBITS), dtype=int)
+        rows = np.flatnonzero(good & (nerr > 0))
+        if len(rows):
+            counts[rows] = _bits(err[rows]).sum(axis=1)
+        result['errors'] = counts.reshape(nfembs, nchs // LANE, LANE, NBITS).sum(axis=2)
+
+        self.ncaptures += 1
+        self.errors += result['errors']
+        self.bits += good.reshape(nfembs, nchs // LANE, LANE).sum(axis=-1) * n * NBITS
+        for key in result['stuck']:
+            self.stuck[key] += 1
+        for key in result['misordered']:
+            self.misordered[key] += 1
+        for key in result['unlocked']:
+            self.unlocked[key] += 1
+        return result
+
+    def summary(self, fembs=None):
+        """
+        Returns
+        -------
+        lanes: pandas.DataFrame
+            bits, bit errors, BER (or its 95% upper limit without error),
+            the bit position with most errors and the number of stuck,
+            misordered and unlocked channel-captures of each lane
+        """
+
+        rows = []
+        fembs = range(4) if fembs is None else fembs
+        for femb in fembs:
+            for lane in range(128 // LANE):
+                chs = slice(LANE * lane, LANE * lane + LANE)
+                bits = self.bits[femb, lane]
+                nerr = self.errors[femb, lane].sum()
+                rows.append(dict(
+                    femb=femb, lane=lane, captures=self.ncaptures,
+                    bits=int(bits), errors=int(nerr),
+                    ber=nerr / bits if bits else np.nan,
+                    ber_limit=(nerr if nerr else 3.) / bits if bits else np.nan,
+                    worst_bit=int(self.errors[femb, lane].argmax()) if nerr else -1,
+                    stuck=int(self.stuck[femb, chs].sum()),
+                    misordered=int(self.misordered[femb, chs].sum()),
+                    unlocked=int(self.unlocked[femb, chs].sum()),
+                ))
+        return pd.DataFrame(rows)
+
+def _print_result(i, result):
+    for kind in ['stuck', 'misordered']:
+        items = result[kind]
+        if items:
+            chs = ' '.join(f'{f}:{c}' for f, c in list(items)[:8])
+            more = f' (+{len(items)-8})' if len(items) > 8 else ''
+            first = next(iter(items.values()))
+            print(f'[ramp] capture {i}: {len(items)} channel(s) with {kind} bits'
+                  f' {first} ... {chs}{more}')
+    if result['unlocked']:
+        print(f'[ramp] capture {i}: {len(result["unlocked"])} channel(s) without ramp')
+
+def run(wib, checker, ncaptures=0, interval=5., fembs=None, **daq_kwargs):
+    """
+    Check captures until `ncaptures` (0: until interrupted).
+
+    Returns
+    -------
+    lanes: pandas.DataFrame
+        from `RampChecker.summary`
+    """
+
+    i = 0
+    t_print = time.time()
+    try:
+        while ncaptures == 0 or i < ncaptures:
+            with wib_prof.timer('acquire_data'):
+                ts, data = wib.acquire_data(**daq_kwargs)
+            with wib_prof.timer('ramp_check'):
+                result = checker.check(ts, data)
+            _print_result(i, result)
+            i += 1
+
+            if time.time() - t_print > interval:
+                total = checker.errors.sum()
+                bits = checker.bits.sum()
+                print(f'[ramp] {checker.ncaptures} captures, {int(total)} bit errors'
+                      f' in {bits:.3g} bits', flush=True)
+                t_print = time.time()
+    except KeyboardInterrupt:
+        print()
+
+    return checker.summary(fembs)
+
+def main():
+    parser = argparse.ArgumentParser(description='WIB ramp mode verification and BER')
+    parser.add_argument('-w', dest='wib', metavar='ip', help='wib ip address')
+    parser.add_argument('-n', '--ncaptures', type=int, default=100,
+                        help='number of captures, 0 to run until Ctrl-C. default=100')
+    parser.add_argument('--femb', type=int, nargs='+', choices=range(4),
+                        help='FEMBs in the summary, default: active FEMBs')
+    parser.add_argument('--buf', type=int, choices=[0,1],
+                        help='read only 1 buffer. default=0,1')
+    parser.add_argument('--set-ramp', action='store_true',
+                        help='enable ramp mode of FEMBS before and disable it after'
+                             ' (wib_cryo.py enable_ramp/disable_ramp)')
+    parser.add_argument('--nfit', type=int, default=64,
+                        help='samples to predict the ramp, default=64')
+    parser.add_argument('-o', '--output', help='csv file for the per-lane summary')
+    parser.add_argument('--fake', action='store_true',
+                        help='simulated ramp instead of a WIB')
+    parser.add_argument('--ber', type=float, default=0.,
+                        help='bit error probability for --fake')
+    parser.add_argument('--rate', type=float, help='target rate in Hz for --fake')
+    parser.add_argument('--profile', action='store_true',
+                        help='write profile and timers (see wib_prof.py)')
+    args = parser.parse_args()
+    wib_prof.start('wib_ramp', args.profile)
+
+    from wib_daq import get_daq_kwargs
+    daq_kwargs = get_daq_kwargs(args.buf)
+
+    if args.fake:
+        from wib_sim import FakeWIB
+        wib = FakeWIB(ramp=True, ber=args.ber, rate=args.rate)
+    else:
+        from wib_cryo import get_addr_port
+        from wib import WIB
+        addr, port = get_addr_port(args.wib)
+        wib = WIB(addr)
+
+    if args.set_ramp and not args.fake:
+        if args.femb is None:
+            print('--set-ramp needs --femb', file=sys.stderr)
+            sys.exit(1)
+        from wib_cryo import enable_ramp
+        enable_ramp(addr, port, args.femb)
+
+    checker = RampChecker(nfit=args.nfit)
+    try:
+        # active FEMBs from the first capture if not given
+        fembs = args.femb
+        if fembs is None:
+            ts, data = wib.acquire_data(**daq_kwargs)
+            fembs = np.flatnonzero(np.any(data, axis=(1, 2))).tolist()
+        lanes = run(wib, checker, args.ncaptures, fembs=fembs, **daq_kwargs)
+    finally:
+        if args.set_ramp and not args.fake:
+            from wib_cryo import disable_ramp
+            disable_ramp(addr, port, args.femb)
+
+    print(lanes.to_string(index=False, formatters={'ber': '{:.2e}'.format, 'ber_limit': '{:.2e}'.format}))
+    if args.output:
+        lanes.to_csv(args.output, index=False)
+
+    failed = (lanes['errors'] + lanes['stuck'] + lanes['misordered'] + lanes['unlocked']) > 0
+    sys.exit(1 if failed.any() else 0)
+
+if __name__ == '__main__':
+    main()
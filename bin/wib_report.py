@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+'''
+Self-contained interactive HTML report of a round (e.g. SN03/Cold/T2).
+
+All datasets (WIB_0x39?) of the round are reduced to small, decimated
+arrays (PSD, std, correlation matrix, pulse waveforms) which are embedded
+in a single html file and plotted in the browser with plotly.js.
+plotly.js is inlined when the python plotly package is installed,
+otherwise it is loaded from the CDN.
+
+Example:
+    wib_report.py /home/wib/data/SN03/Cold/T2 -o report.html
+'''
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from wib_plot import _read, _parse_tp, plots_for, plot_pulse
+
+FS = 1e6/0.512
+
+PLOTLY_CDN = 'https://cdn.plot.ly/plotly-2.18.2.min.js'
+
+def _encode(arr, dtype):
+    """
+    Compact array for embedding: base64 of the raw little-endian bytes.
+    """
+
+    arr = np.ascontiguousarray(arr, dtype=np.dtype(dtype).newbyteorder('<'))
+    return dict(dtype=np.dtype(dtype).name, shape=arr.shape,
+                data=base64.b64encode(arr.tobytes()).decode())
+
+def decimate_psd(freq, pxx, nbins=256):
+    """
+    Average the power in `nbins` log-spaced frequency bins.
+
+    Parameters
+    ----------
+    freq: (M, ) array
+    pxx: (..., M) array
+        power (linear)
+
+    Returns
+    -------
+    freq: (nbins', ) array
+        mean frequency of each non-empty bin
+    pxx: (..., nbins') array
+    """
+
+    edges = np.geomspace(freq[0], freq[-1] * (1 + 1e-9), nbins + 1)
+    idx = np.searchsorted(edges, freq, side='right') - 1
+    used, idx = np.unique(idx, return_inverse=True)
+    counts = np.bincount(idx)
+    out = np.zeros(pxx.shape[:-1] + (len(used), ))
+    np.add.at(out, (..., idx), pxx)
+    return np.bincount(idx, weights=freq) / counts, out / counts
+
+def decimate_minmax(wfm, npoints=1024):
+    """
+    Min/max envelope decimation of waveforms along the last axis,
+    pulses are kept at full height.
+    """
+
+    n = wfm.shape[-1]
+    step = max(n // (npoints // 2), 1)
+    m = n // step * step
+    blocks = wfm[..., :m].reshape(wfm.shape[:-1] + (-1, step))
+    out = np.empty(blocks.shape[:-1] + (2, ), dtype=wfm.dtype)
+    out[..., 0] = blocks.min(axis=-1)
+    out[..., 1] = blocks.max(axis=-1)
+    x = np.repeat(np.arange(blocks.shape[-2]) * step, 2)
+    return x, out.reshape(wfm.shape[:-1] + (-1, ))
+
+def summarize(path, fs=FS, golden=None, do_align=True):
+    """
+    Reduce one dataset to the arrays shown in the report.
+
+    Returns
+    -------
+    summary: dict
+        json serializable
+    """
+
+    name = os.path.basename(path)
+    data = _read(path, do_align)
+    nevents, nfembs, nchs, n = data.shape
+    fembs = [int(i) for i in np.where(np.any(data, axis=(0,2,3)))[0]]
+
+    # one event at a time, only the uint16 data is kept in memory
+    pulse = plot_pulse in plots_for(name)
+    mean = np.zeros((nfembs*nchs, 1))
+    std = np.zeros(nfembs*nchs)
+    power = 0.
+    cov = 0.
+    for event in data:
+        wfm = event.reshape(nfembs*nchs, n).astype(np.float32)
+        m = wfm.mean(axis=-1, keepdims=True)
+        wfm -= m
+        mean += m
+        std += wfm.std(axis=-1)
+        if pulse:
+            continue
+        power += np.abs(np.fft.rfft(wfm, axis=-1))**2
+        x = wfm.reshape(nfembs*2, 64, n)
+        cov += np.einsum('aij,akj->aik', x, x, dtype=np.float32)
+    mean /= nevents
+    std /= nevents
+
+    summary = dict(
+        name=name,
+        path=path,
+        tp=_parse_tp(name),
+        pulse=pulse,
+        nevents=nevents,
+        nsamples=n,
+        fembs=fembs,
+        mean=_encode(mean.ravel(), 'float32'),
+        std=_encode(std, 'float32'),
+    )
+
+    if summary['pulse']:
+        x, env = decimate_minmax(data[0].reshape(nfembs*nchs, n))
+        summary['wfm_x'] = _encode(x, 'int32')
+        summary['wfm'] = _encode(env, 'uint16')
+        return summary
+
+    # PSD of all channels (one-sided periodogram, mean of events)
+    power = power / nevents * (2. / (fs * n))
+    freq = np.fft.rfftfreq(n, 1./fs)
+    freq, power = decimate_psd(freq[1:], power[:, 1:])
+    with np.errstate(divide='ignore'):
+        psd = np.clip(10 * np.log10(power), -300, 300)
+    summary['freq'] = _encode(freq * 1e-3, 'float32')
+    summary['psd'] = _encode(np.rint(psd * 100), 'int16')
+
+    # correlation of each ASIC
+    norm = np.sqrt(np.einsum('aii->ai', cov))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mcorr = np.nan_to_num(cov / (norm[:, :, None] * norm[:, None, :]))
+    summary['mcorr'] = _encode(np.rint(mcorr * 100), 'int8')
+
+    summary['check'] = _check(path, data, std, fembs, fs, golden)
+    # reference FEMBs without data are listed as failed
+    summary['fembs'] = sorted(set(fembs) | set(summary['check']))
+    return summary
+
+def _check(path, data, std, fembs, fs, golden):
+    """
+    Pass/fail per FEMB: golden reference check (wib_check.py) if available,
+    otherwise flag dead (std < 1) and noisy (> 2x the FEMB median) channels.
+    """
+
+    if golden is not None:
+        from wib_check import (channel_stats, compare, golden_path, _parse_key,
+                               reference_fembs)
+        key = _parse_key(path)
+        if None not in key and os.path.exists(golden_path(golden, *key)):
+            import pandas as pd
+            ref = pd.read_csv(golden_path(golden, *key))
+            # FEMBs of the reference, one without data fails
+            channels, lanes = compare(channel_stats(data, fs), ref)
+            flagged = channels[channels['flagged']]
+            return {
+                int(femb): dict(
+                    result='FAIL' if np.any(flagged['femb'] == femb) else 'PASS',
+                    flagged=[int(ch) for ch in flagged[flagged['femb'] == femb]['ch']],
+                    method='golden')
+                for femb in sorted(set(fembs) | set(reference_fembs(ref).tolist()))}
+
+    output = {}
+    for femb in fembs:
+        s = std[femb*128:(femb+1)*128]
+        bad = np.where((s < 1) | (s > 2 * np.median(s)))[0]
+        output[femb] = dict(result='FAIL' if len(bad) else 'PASS',
+                            flagged=[int(ch) for ch in bad], method='basic')
+    return output
+
+def _plotly_js():
+    try:
+        from plotly.offline import get_plotlyjs
+        return f'<script type="text/javascript">{get_plotlyjs()}</script>'
+    except ImportError:
+        return f'<script src="{PLOTLY_CDN}"></script>'
+
+def write_report(summaries, title, output):
+    payload = json.dumps(dict(title=title, datasets=summaries,
+                              time=time.strftime('%Y-%m-%d %H:%M:%S')))
+    html = TEMPLATE.replace('{{title}}', title) \
+                   .replace('{{plotly}}', _plotly_js()) \
+                   .replace('{{payload}}', payload)
+    with open(output, 'w') as f:
+        f.write(html)
+    print(f'Report saved to {output} ({os.path.getsize(output)/1e6:.1f}MB)')
+
+def make_report(round_dir, output, title=None, workers=None, fs=FS,
+                golden=None, do_align=True):
+    """
+    Report of all datasets in a round folder.
+
+    Parameters
+    ----------
+    round_dir: str
+        folder of datasets (e.g. SN03/Cold/T2)
+    output: str
+        html file
+    title: str, optional
+        default: from the folder structure as wib_plot2
+    workers: int, optional
+        number of processes
+    fs: float
+        sampling frequency
+    golden: str, optional
+        directory of golden references for the pass/fail summary
+
+    Returns
+    -------
+    passed: bool
+    """
+
+    from wib_batch import round_title
+    title = title or round_title(round_dir)
+
+    paths = sorted(p for p in glob(os.path.join(round_dir, '*'))
+                   if os.path.isdir(p) and len(plots_for(os.path.basename(p))) > 0)
+    if len(paths) == 0:
+        print(f'No dataset in {round_dir}', file=sys.stderr)
+        return False
+
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(summarize, p, fs, golden, do_align) for p in paths]
+        summaries = [f.result() for f in futures]
+
+    write_report(summaries, title, output)
+    return all(c['result'] == 'PASS' for s in summaries
+               for c in s.get('check', {}).values())
+
+TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{{title}}</title>
+{{plotly}}
+<style>
+  body { font-family: sans-serif; margin: 1em 2em; }
+  table { border-collapse: collapse; font-size: 0.9em; }
+  td, th { border: 1px solid #ccc; padding: 2px 8px; text-align: right; }
+  tr.sel { background: #ffeeb0; }
+  .PASS { color: green; font-weight: bold; }
+  .FAIL { color: red; font-weight: bold; }
+  .row { display: flex; flex-wrap: wrap; }
+  .plot { width: 48%; min-width: 500px; height: 480px; }
+  #stats { max-height: 480px; overflow-y: scroll; display: inline-block; }
+  select { margin-right: 1em; }
+</style>
+</head>
+<body>
+<h2>{{title}}</h2>
+<div id="info"></div>
+<h3>Summary</h3>
+<table id="summary"></table>
+<h3>Details</h3>
+<div>
+  dataset <select id="ds"></select>
+  FEMB <select id="femb"></select>
+  ASIC <select id="asic"><option>0</option><option>1</option></select>
+  channel <select id="ch"></select>
+</div>
+<div class="row">
+  <div id="main" class="plot"></div>
+  <div id="std" class="plot"></div>
+  <div id="mcorr" class="plot"></div>
+  <div id="stats"></div>
+</div>
+<script>
+const REPORT = {{payload}};
+const TYPES = {int8: Int8Array, int16: Int16Array, int32: Int32Array,
+               uint16: Uint16Array, float32: Float32Array};
+
+function decode(a) {
+  if (a._cache) return a._cache;
+  const bin = atob(a.data);
+  const buf = new Uint8Array(bin.length);
+  for (let i = 0; i < bin.length; i++) buf[i] = bin.charCodeAt(i);
+  a._cache = new TYPES[a.dtype](buf.buffer);
+  return a._cache;
+}
+
+function row(a, i) {
+  const n = a.shape[a.shape.length - 1];
+  return Array.from(decode(a).subarray(i * n, (i + 1) * n));
+}
+
+const $ = (id) => document.getElementById(id);
+const sel = {ds: 0, femb: 0, asic: 0, ch: 'all'};
+
+function fill(id, values, labels) {
+  $(id).innerHTML = values.map((v, i) =>
+    `<option value="${v}">${labels ? labels[i] : v}</option>`).join('');
+}
+
+function summary() {
+  let html = '<tr><th>dataset</th><th>tp</th><th>FEMB</th>' +
+             '<th>mean std</th><th>flagged channels</th><th>result</th></tr>';
+  REPORT.datasets.forEach((d, i) => {
+    const std = decode(d.std);
+    d.fembs.forEach((femb) => {
+      const s = std.subarray(femb * 128, (femb + 1) * 128);
+      const avg = s.reduce((a, b) => a + b, 0) / s.length;
+      const c = (d.check || {})[femb];
+      const cls = (i == sel.ds && femb == sel.femb) ? 'sel' : '';
+      html += `<tr class="${cls}" onclick="select(${i}, ${femb})">` +
+        `<td>${d.name}</td><td>${d.tp || ''}</td><td>${femb}</td>` +
+        `<td>${avg.toFixed(2)}</td>` +
+        `<td>${c ? c.flagged.join(' ') : ''}</td>` +
+        `<td class="${c ? c.result : ''}">${c ? c.result : 'pulse'}</td></tr>`;
+    });
+  });
+  $('summary').innerHTML = html;
+}
+
+function select(ds, femb) {
+  sel.ds = ds; sel.femb = femb;
+  $('ds').value = ds;
+  update();
+}
+
+function update() {
+  const d = REPORT.datasets[sel.ds];
+  if (!d.fembs.includes(sel.femb)) sel.femb = d.fembs[0];
+  fill('femb', d.fembs);
+  $('femb').value = sel.femb;
+  summary();
+
+  const ch0 = sel.femb * 128 + sel.asic * 64;
+  const chs = sel.ch == 'all' ? [...Array(64).keys()] : [Number(sel.ch)];
+  const title = `${d.name} FEMB${sel.femb} ASIC${sel.asic}`;
+
+  if (d.pulse) {
+    const x = Array.from(decode(d.wfm_x));
+    Plotly.react('main', chs.map((c) => ({
+      x: x, y: row(d.wfm, ch0 + c), name: `ch${c}`, mode: 'lines', line: {width: 1}
+    })), {title: `${title} waveform (event 0)`, xaxis: {title: 'Sample'},
+          yaxis: {title: 'ADC'}});
+    Plotly.purge('mcorr');
+  } else {
+    const f = Array.from(decode(d.freq));
+    Plotly.react('main', chs.map((c) => ({
+      x: f, y: row(d.psd, ch0 + c).map((v) => v / 100), name: `ch${c}`,
+      mode: 'lines', line: {width: 1}
+    })), {title: `${title} PSD`, xaxis: {title: 'Frequency [kHz]', type: 'log'},
+          yaxis: {title: 'Power Spectrum [dB]'}});
+
+    const m = decode(d.mcorr);
+    const a = sel.femb * 2 + sel.asic;
+    const z = [];
+    for (let i = 0; i < 64; i++)
+      z.push(Array.from(m.subarray(a * 4096 + i * 64, a * 4096 + (i + 1) * 64))
+             .map((v) => v / 100));
+    Plotly.react('mcorr', [{z: z, type: 'heatmap', colorscale: 'RdBu',
+                            zmin: -1, zmax: 1}],
+                 {title: `${title} correlation`, yaxis: {autorange: 'reversed'}});
+  }
+
+  const std = Array.from(decode(d.std).subarray(ch0, ch0 + 64));
+  const mean = Array.from(decode(d.mean).subarray(ch0, ch0 + 64));
+  Plotly.react('std', [{y: std, mode: 'lines+markers'}],
+               {title: `${title} std`, xaxis: {title: 'Channel'},
+                yaxis: {title: 'std [ADC]'}});
+
+  const flagged = ((d.check || {})[sel.femb] || {flagged: []}).flagged;
+  let html = '<table><tr><th>ch</th><th>mean</th><th>std</th></tr>';
+  for (let c = 0; c < 64; c++) {
+    const cls = flagged.includes(sel.asic * 64 + c) ? 'FAIL' : '';
+    html += `<tr class="${cls}"><td>${c}</td><td>${mean[c].toFixed(1)}</td>` +
+            `<td>${std[c].toFixed(2)}</td></tr>`;
+  }
+  $('stats').innerHTML = html + '</table>';
+}
+
+fill('ds', REPORT.datasets.map((d, i) => i), REPORT.datasets.map((d) => d.name));
+fill('ch', ['all', ...Array(64).keys()]);
+$('ds').onchange = (e) => { sel.ds = Number(e.target.value); update(); };
+$('femb').onchange = (e) => { sel.femb = Number(e.target.value); update(); };
+$('asic').onchange = (e) => { sel.asic = Number(e.target.value); update(); };
+$('ch').onchange = (e) => { sel.ch = e.target.value; update(); };
+$('info').innerText = `${REPORT.datasets.length} dataset(s), created ${REPORT.time}`;
+update();
+</script>
+</body>
+</html>
+'''
+
+def main():
+    parser = argparse.ArgumentParser(description='HTML report of a round')
+    parser.add_argument('input', help='round folder, e.g. SN03/Cold/T2')
+    parser.add_argument('-o', '--output', help='html file, default: <title>.html')
+    parser.add_argument('-t', '--title', help='default: from the folder structure')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='number of worker processes, default: number of cpus')
+    parser.add_argument('--fs', type=float, default=FS)
+    parser.add_argument('--golden', default=os.environ.get('WIB_GOLDEN'),
+                        help='golden references for pass/fail (default: $WIB_GOLDEN)')
+    parser.add_argument('--no-align', action='store_true',
+                        help='do not align buffers using timestamps')
+    args = parser.parse_args()
+
+    from wib_batch import round_title
+    round_dir = os.path.realpath(args.input)
+    title = args.title or round_title(round_dir)
+    output = args.output or f'{title}.html'
+
+    passed = make_report(round_dir, output, title, args.workers, args.fs,
+                         args.golden, not args.no_align)
+    sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+    main()
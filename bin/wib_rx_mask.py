@@ -19,21 +19,33 @@ parser.add_argument(
     default=0, nargs='?',
 )
 
-if __name__ == "__main__":
-    args = parser.parse_args()
-    addr, __ = get_addr_port(args.wib)
+def set_rx_mask(addr, rx_mask, femb=[]):
+    """
+    Set rx_mask of the data links (1: masked), FEMBs not in `femb` are
+    masked if `femb` is given.
+
+    Returns
+    -------
+    success: bool
+    """
 
-    if len(args.femb) > 0:
+    if len(femb) > 0:
         for i in range(4):
-            if i in args.femb: continue
-            args.rx_mask |= (0xf << (i*4))
+            if i in femb: continue
+            rx_mask |= (0xf << (i*4))
 
-    print(f'setting rx_mask = {hex(args.rx_mask)}')
+    print(f'setting rx_mask = {hex(rx_mask)}')
 
     wib = WIB(addr)
     req = wibpb.SetRxMask()
     rep = wibpb.Status()
 
-    req.value = args.rx_mask
+    req.value = rx_mask
     wib.send_command(req, rep)
     print(f'Successful: {rep.success}')
+    return rep.success
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    addr, __ = get_addr_port(args.wib)
+    set_rx_mask(addr, args.rx_mask, args.femb)
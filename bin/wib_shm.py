@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+'''
+Shared-memory ring of the most recent events, written by wib_daq.py and
+read by wib_dash.py ("Live" source) without touching the WIB.
+
+The ring is a file in /dev/shm mapped by both processes:
+
+    header   magic, version, nslots, nsamples, head (events published)
+    slot[i]  seq, time, n, quality, timestamps (2, nsamples) uint64,
+             data (4, 128, nsamples) uint16
+
+The writer clears `seq` of a slot while it is being filled. Readers copy
+the slot and read its header again (seqlock): a slot overwritten during
+the copy is dropped, so a returned event is never a mix of two events.
+
+Example:
+    wib_daq.py -w 192.168.121.1 -n 1000 -o run1 --shm wib_live
+    wib_shm.py wib_live
+'''
+
+import os
+import sys
+import mmap
+import time
+import struct
+import tempfile
+import argparse
+import numpy as np
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+DEFAULT_NAME = 'wib_live'
+
+MAGIC = b'WIBRING1'
+HEADER = struct.Struct('<8sIIIIQ')      # magic, version, nslots, nsamples, -, head
+HEADER_SIZE = 64
+HEAD_OFFSET = 24
+SLOT_HEADER = struct.Struct('<QdII')    # seq, time, n, quality
+SLOT_HEADER_SIZE = 64
+
+def shm_path(name=None):
+    """
+    Path of the ring file, `name` is a path or a name in /dev/shm.
+    """
+
+    name = name or DEFAULT_NAME
+    if os.sep in name:
+        return name
+    return os.path.join(SHM_DIR, name)
+
+def _slot_size(nsamples):
+    return SLOT_HEADER_SIZE + 2 * nsamples * 8 + 4 * 128 * nsamples * 2
+
+def _views(buf, nslots, nsamples):
+    ts, data = [], []
+    for i in range(nslots):
+        offset = HEADER_SIZE + i * _slot_size(nsamples) + SLOT_HEADER_SIZE
+        ts.append(np.ndarray((2, nsamples), np.uint64, buf, offset))
+        offset += 2 * nsamples * 8
+        data.append(np.ndarray((4, 128, nsamples), np.uint16, buf, offset))
+    return ts, data
+
+class ShmWriter:
+    """
+    Publish events to the ring (one writer per ring).
+
+    Parameters
+    ----------
+    name: str
+        ring name in /dev/shm or a path
+    nslots: int
+        number of events kept
+    nsamples: int
+        max. samples per event, longer events are truncated
+    """
+
+    def __init__(self, name=None, nslots=16, nsamples=4096):
+        self.path = shm_path(name)
+        self.nslots = nslots
+        self.nsamples = nsamples
+        size = HEADER_SIZE + nslots * _slot_size(nsamples)
+
+        # create aside and rename, readers never see a partial ring
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.truncate(size)
+            f.write(HEADER.pack(MAGIC, 1, nslots, nsamples, 0, 0))
+        os.replace(tmp, self.path)
+
+        with open(self.path, 'r+b') as f:
+            self._buf = mmap.mmap(f.fileno(), size)
+        self._ts, self._data = _views(self._buf, nslots, nsamples)
+        self.head = 0
+
+    def publish(self, ts, data, quality=0):
+        """
+        Copy one event into the next slot.
+
+        Parameters
+        ----------
+        ts: (2, n) array
+            timestamps of buf0 and buf1
+        data: (4, 128, n) array
+            ADC samples
+        quality: int
+            quality flags (see wib_daq.QualityGate)
+        """
+
+        i = self.head % self.nslots
+        offset = HEADER_SIZE + i * _slot_size(self.nsamples)
+        n = min(np.shape(data)[-1], self.nsamples)
+
+        SLOT_HEADER.pack_into(self._buf, offset, 0, 0., 0, 0)
+        self._ts[i][:, :n] = np.asarray(ts)[:, :n]
+        self._data[i][..., :n] = np.asarray(data)[..., :n]
+
+        self.head += 1
+        SLOT_HEADER.pack_into(self._buf, offset, self.head, time.time(), n, int(quality))
+        struct.pack_into('<Q', self._buf, HEAD_OFFSET, self.head)
+
+    def close(self, unlink=False):
+        self._ts = self._data = None
+        self._buf.close()
+        if unlink:
+            os.unlink(self.path)
+
+class ShmReader:
+    """
+    Read the latest events from the ring.
+
+    Parameters
+    ----------
+    name: str
+        ring name in /dev/shm or a path
+    """
+
+    def __init__(self, name=None):
+        self.path = shm_path(name)
+        self._buf = None
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, nslots, nsamples, __, __ = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not a wib_shm ring')
+
+        self._buf = buf
+        self.nslots = nslots
+        self.nsamples = nsamples
+        self._ts, self._data = _views(buf, nslots, nsamples)
+
+    def _reopen(self):
+        # the writer restarted with a new ring
+        try:
+            if os.stat(self.path).st_ino != self._inode:
+                self._open()
+        except FileNotFoundError:
+            pass
+
+    @property
+    def head(self):
+        return struct.unpack_from('<Q', self._buf, HEAD_OFFSET)[0]
+
+    def latest(self):
+        """
+        Returns
+        -------
+        (seq, time, quality, ts, data) of the latest event, or `None`.
+        `ts` and `data` are copies, checked not to be overwritten while
+        being copied.
+        """
+
+        head = self.head
+        for seq in range(head, max(head - self.nslots, 0), -1):
+            i = (seq - 1) % self.nslots
+            offset = HEADER_SIZE + i * _slot_size(self.nsamples)
+            slot_seq, t, n, quality = SLOT_HEADER.unpack_from(self._buf, offset)
+            if slot_seq != seq:
+                continue
+            ts = self._ts[i][:, :n].copy()
+            data = self._data[i][..., :n].copy()
+            # the writer took the slot during the copy, drop it
+            if SLOT_HEADER.unpack_from(self._buf, offset)[0] != seq:
+                continue
+            return seq, t, quality, ts, data
+        return None
+
+class ShmWIB:
+    """
+    WIB-like source reading the ring (for wib_dash.AcqWorker).
+
+    Parameters
+    ----------
+    name: str
+        ring name in /dev/shm or a path
+    timeout: float
+        max. seconds to wait for a new event
+    """
+
+    def __init__(self, name=None, timeout=10.):
+        self.timeout = timeout
+        self._reader = ShmReader(name)
+        self._last = 0
+
+    def acquire_data(self, buf0=True, buf1=True, **kwargs):
+        t_end = time.time() + self.timeout
+        while True:
+            event = self._reader.latest()
+            if event is not None and event[0] != self._last:
+                break
+            if time.time() > t_end:
+                self._reader._reopen()
+                raise TimeoutError('no new event in the ring')
+            time.sleep(0.01)
+
+        seq, t, quality, ts, data = event
+        self._last = seq
+        if not (buf0 and buf1):
+            from wib_sim import _select_bufs
+            ts, data = _select_bufs(ts, data, buf0, buf1)
+        return ts, data
+
+def main():
+    parser = argparse.ArgumentParser(description='Status of a wib_daq.py live ring')
+    parser.add_argument('name', nargs='?', default=DEFAULT_NAME,
+                        help=f'ring name in {SHM_DIR} or a path, default={DEFAULT_NAME}')
+    args = parser.parse_args()
+
+    try:
+        reader = ShmReader(args.name)
+    except (OSError, ValueError) as e:
+        print(f'Cannot open ring: {e}', file=sys.stderr)
+        sys.exit(1)
+
+    print(f'{reader.path}: {reader.nslots} slots, max. {reader.nsamples} samples')
+    event = reader.latest()
+    if event is None:
+        print('no event')
+        sys.exit(0)
+
+    seq, t, quality, ts, data = event
+    print(f'event #{seq} at {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))}'
+          f' ({time.time()-t:.1f}s ago), {data.shape[-1]} samples, quality={quality:#x}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+'''
+Simulated WIB data sources.
+
+`FakeWIB` and `ReplayWIB` have the same `acquire_data` interface as
+`wib.WIB` and can be used in place of a real WIB in wib_daq.py,
+wib_dash.py or any offline test.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from glob import glob
+
+FS = 1e6 / 0.512    # sampling frequency [Hz]
+TS_STEP = 32        # timestamp ticks (62.5 MHz) per sample
+
+# peaking time [us] from the ASIC setting, see wib_plot._parse_tp
+PEAKING_TIME = [0.6, 1.2, 2.4, 3.6]
+
+def _default_spectrum(freq, corner=20e3):
+    """
+    Relative noise amplitude: white noise with a 1/f component
+    below `corner` Hz.
+    """
+
+    f = np.maximum(freq, freq[1])
+    return np.sqrt(1 + corner / f)
+
+def _pulse_shape(n, tp):
+    """
+    Unit-amplitude CR-RC pulse peaking at `tp` samples.
+    """
+
+    t = np.arange(n) / tp
+    return t * np.exp(1 - t)
+
+def bit_reverse(x, nbits=12):
+    """
+    Reverse the bit order of `nbits`-bit values (wrong LaneBitOrder).
+    """
+
+    x = np.asarray(x)
+    out = np.zeros_like(x)
+    for b in range(nbits):
+        out |= ((x >> b) & 1) << (nbits - 1 - b)
+    return out
+
+def _select_bufs(ts, data, buf0, buf1):
+    if not buf0:
+        ts[0] = 0
+        data[:2] = 0
+    if not buf1:
+        ts[1] = 0
+        data[2:] = 0
+    return ts, data
+
+class FakeWIB:
+    """
+    Simulated WIB spy buffer.
+
+    Parameters
+    ----------
+    nsamples: int
+        nominal spy buffer length
+    jitter: int
+        spy buffer length varies by +/- `jitter` samples
+    pedestal: float
+        mean pedestal
+    ped_spread: float
+        channel-to-channel pedestal spread
+    noise: float
+        incoherent noise [ADC]
+    coherent: float
+        common mode noise per ASIC (64 channels) [ADC]
+    spectrum: callable, optional
+        `spectrum(freq)` returns the relative noise amplitude for an
+        array of frequencies in Hz. Default: white + 1/f.
+    lines: list of (freq, amplitude), optional
+        coherent noise lines (in Hz, ADC) shared by all channels of a FEMB
+    setting: int, optional
+        ASIC setting (e.g. 0x391), inject pulses if bit 0 is set,
+        peaking time from bit 2-3.
+    pulse_amp: float
+        pulse amplitude [ADC]
+    pulse_period: int
+        pulser period in samples, in phase with the timestamps
+        (like the pulser driven by the timing clock)
+    ts_offset: int
+        max. start offset of buf1 w.r.t buf0 in samples
+    glitch: float
+        probability of a dropped sample (timestamp gap) per buffer and event
+    rate: float, optional
+        target acquisition rate in Hz. Unthrottled if `None`.
+    ramp: bool
+        internal ramp mode (wib_cryo.py enable_ramp): 12-bit counter
+        incremented every sample, the same for all channels
+    ber: float
+        bit error probability in ramp mode
+    stuck_bits: list of (femb, lane, bit, value), optional
+        bits stuck at `value` for the 32 channels of a lane in ramp mode
+    reversed_lanes: list of (femb, lane), optional
+        lanes with reversed bit order in ramp mode
+    seed: int, optional
+        random seed
+    """
+
+    def __init__(self, nsamples=2162, jitter=4,
+                 pedestal=2048, ped_spread=20, noise=5, coherent=1,
+                 spectrum=_default_spectrum, lines=[],
+                 setting=None, pulse_amp=1000, pulse_period=1000,
+                 ts_offset=2, glitch=0, rate=None, ramp=False, ber=0.,
+                 stuck_bits=[], reversed_lanes=[], seed=None):
+        self.nsamples = nsamples
+        self.jitter = jitter
+        self.noise = noise
+        self.coherent = coherent
+        self.spectrum = spectrum
+        self.lines = lines
+        self.setting = setting
+        self.pulse_amp = pulse_amp
+        self.pulse_period = pulse_period
+        self.ts_offset = ts_offset
+        self.glitch = glitch
+        self.rate = rate
+        self.ramp = ramp
+        self.ber = ber
+        self.stuck_bits = stuck_bits
+        self.reversed_lanes = reversed_lanes
+
+        self._rng = np.random.default_rng(seed)
+        self._ped = self._rng.normal(pedestal, ped_spread, size=(4,128,1))
+        self._ts = int(time.time() * 62.5e6)
+        self._t_last = None
+
+    def _noise(self, n):
+        rng = self._rng
+        if self.spectrum is None:
+            adcs = self.noise * rng.normal(size=(4,128,n))
+        else:
+            # shape white noise directly in frequency domain
+            freq = np.fft.rfftfreq(n, 1/FS)
+            amp = self.spectrum(freq)
+            amp *= self.noise * np.sqrt(n / 2 / np.mean(amp**2))
+            spec = rng.normal(size=(4,128,len(freq))) \
+                + 1j * rng.normal(size=(4,128,len(freq)))
+            adcs = np.fft.irfft(spec * amp, n=n)
+
+        if self.coherent > 0:
+            cm = rng.normal(scale=self.coherent, size=(8,1,n))
+            adcs += np.repeat(cm, 64, axis=1).reshape(4,128,n)
+
+        t = np.arange(n) / FS
+        for freq, amp in self.lines:
+            phase = rng.uniform(0, 2*np.pi, size=(4,1,1))
+            adcs += amp * np.sin(2*np.pi*freq*t + phase)
+        return adcs
+
+    def _pulses(self, n):
+        period = self.pulse_period
+        tp = PEAKING_TIME[(self.setting >> 2) & 0x3] * 1e-6 * FS
+        shape = _pulse_shape(period, tp)
+
+        phase = self._ts // TS_STEP
+        idx = (np.arange(n) + phase) % period
+        return self.pulse_amp * shape[idx]
+
+    def _ramp(self, n):
+        rng = self._rng
+        count = (self._ts // TS_STEP + np.arange(n)) & 0xfff
+        data = np.broadcast_to(count, (4,128,n)).astype(np.uint16)
+
+        for femb, lane in self.reversed_lanes:
+            data[femb, 32*lane:32*lane+32] = bit_reverse(data[femb, 32*lane:32*lane+32])
+        for femb, lane, bit, value in self.stuck_bits:
+            chs = slice(32*lane, 32*lane+32)
+            if value:
+                data[femb, chs] |= 1 << bit
+            else:
+                data[femb, chs] &= ~np.uint16(1 << bit)
+
+        if self.ber > 0:
+            nerr = rng.binomial(data.size * 12, self.ber)
+            idx = rng.integers(data.size, size=nerr)
+            bits = rng.integers(12, size=nerr).astype(np.uint16)
+            idx = np.unravel_index(idx, data.shape)
+            np.bitwise_xor.at(data, idx, np.left_shift(1, bits, dtype=np.uint16))
+        return data
+
+    def _throttle(self):
+        if self.rate is None:
+            return
+
+        if self._t_last is not None:
+            dt = self._t_last + 1. / self.rate - time.time()
+            if dt > 0: time.sleep(dt)
+        self._t_last = time.time()
+
+    def acquire_data(self, buf0=True, buf1=True, **kwargs):
+        self._throttle()
+        rng = self._rng
+
+        n = self.nsamples + rng.integers(-self.jitter, self.jitter+1)
+        offset = rng.integers(0, self.ts_offset+1)
+        ntot = n + offset + 1
+
+        if self.ramp:
+            data = self._ramp(ntot)
+        else:
+            adcs = self._noise(ntot) + self._ped
+            if self.setting is not None and self.setting & 0x1:
+                adcs += self._pulses(ntot)
+            data = np.clip(np.rint(adcs), 0, 4095).astype(np.uint16)
+
+        # buf0 (FEMB0-1) and buf1 (FEMB2-3) start at different time
+        t = self._ts + TS_STEP * np.arange(ntot)
+        starts = [0, offset]
+        ts = np.zeros((2,n), dtype=np.uint64)
+        output = np.zeros((4,128,n), dtype=data.dtype)
+        for i, start in enumerate(starts):
+            idx = start + np.arange(n)
+            if rng.uniform() < self.glitch:
+                # dropped sample
+                drop = rng.integers(1, n)
+                idx[drop:] += 1
+            ts[i] = t[idx]
+            output[2*i:2*i+2] = data[2*i:2*i+2, :, idx]
+
+        self._ts = int(t[-1]) + TS_STEP * rng.integers(10000, 100000)
+        return _select_bufs(ts, output, buf0, buf1)
+
+class ReplayWIB:
+    """
+    Replay recorded events (`event_*.npz` written by wib_daq.py).
+
+    Parameters
+    ----------
+    path: str
+        directory of recorded events
+    loop: bool
+        restart from the first event at the end
+    cadence: bool
+        replay at the original cadence (from file modification times)
+    rate: float, optional
+        replay at a fixed rate in Hz instead, overrides `cadence`
+    """
+
+    def __init__(self, path, loop=True, cadence=True, rate=None):
+        files = sorted(glob(os.path.join(os.path.expanduser(path), 'event_*.npz')))
+        if len(files) == 0:
+            raise FileNotFoundError(f'No event_*.npz in {path}')
+
+        self.files = files
+        self.loop = loop
+        self.rate = rate
+
+        mtimes = np.array([os.path.getmtime(f) for f in files])
+        self._dt = np.diff(mtimes, prepend=mtimes[0]) if cadence else np.zeros(len(files))
+        self._i = 0
+        self._t_last = None
+
+    def _throttle(self, dt):
+        if self._t_last is not None and dt > 0:
+            wait = self._t_last + dt - time.time()
+            if wait > 0: time.sleep(wait)
+        self._t_last = time.time()
+
+    def acquire_data(self, buf0=True, buf1=True, **kwargs):
+        if self._i >= len(self.files):
+            if not self.loop:
+                raise EOFError('End of recorded events')
+            self._i = 0
+
+        i = self._i
+        self._i += 1
+
+        dt = 1. / self.rate if self.rate else self._dt[i]
+        self._throttle(dt)
+
+        content = np.load(self.files[i])
+        ts, data = content['timestamps'], content['data'].astype(np.uint16)
+        return _select_bufs(ts.copy(), data, buf0, buf1)
+
+def make_wib(src, **kwargs):
+    """
+    Create a WIB-like data source.
+
+    Parameters
+    ----------
+    src: str
+        'fake' for `FakeWIB`, a directory of recorded events for `ReplayWIB`,
+        otherwise a WIB address
+    kwargs: dict
+        extra arguments for `FakeWIB`/`ReplayWIB`
+    """
+
+    if src == 'fake':
+        return FakeWIB(**kwargs)
+
+    if os.path.isdir(os.path.expanduser(src)):
+        return ReplayWIB(src, **kwargs)
+
+    from wib import WIB
+    return WIB(src)
+
+def main():
+    parser = argparse.ArgumentParser(description='WIB simulated data source')
+    parser.add_argument('src', nargs='?', default='fake',
+                        help='"fake" or directory of recorded events')
+    parser.add_argument('-n', '--nevents', type=int, default=100)
+    parser.add_argument('--rate', type=float,
+                        help='target rate in Hz, default: unthrottled')
+    parser.add_argument('--setting', type=lambda x: int(x,0))
+    args = parser.parse_args()
+
+    kwargs = dict(rate=args.rate)
+    if args.src == 'fake':
+        kwargs['setting'] = args.setting
+    else:
+        kwargs['cadence'] = args.rate is None
+    wib = make_wib(args.src, **kwargs)
+
+    nbytes = 0
+    t0 = time.time()
+    for i in range(args.nevents):
+        ts, data = wib.acquire_data()
+        nbytes += data.nbytes
+    dt = time.time() - t0
+    print(f'{args.nevents} events in {dt:.2f}s, '
+          f'{args.nevents/dt:.1f} events/s, {nbytes/dt/1e6:.1f} MB/s')
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
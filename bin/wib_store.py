@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+'''
+Shared on-disk store of the wib_dash.py bundles, for several server
+processes (e.g. gunicorn workers).
+
+Each entry is one file: a json header followed by the raw arrays
+(no pickle), written aside and renamed. Readers map the file and get
+read-only views, re-mapped only when the entry is replaced. The store is
+kept under a size limit by removing the oldest entries, entries not
+updated for `max_age` seconds are removed too.
+
+    <root>/<wib id>/key.json        WIB source (type, address, buffer)
+    <root>/<wib id>/owner.lock      held by the process acquiring from the WIB
+    <root>/<wib id>/control.json    requests from any process (acquire, live, ...)
+    <root>/<wib id>/status.json     last event, rate, errors
+    <root>/<wib id>/latest.bin      bundle of the latest event
+    <root>/<wib id>/avg.bin         running averages
+    <root>/sessions/<session>.json  WIB watched by a browser session
+
+Show the content of a store:
+    wib_store.py [/dev/shm/wib_dash]
+'''
+
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import argparse
+import numpy as np
+
+from wib_shm import SHM_DIR
+
+DEFAULT_ROOT = os.path.join(SHM_DIR, 'wib_dash')
+MAGIC = b'WIBBNDL1'
+PREFIX = struct.Struct('<8sI')  # magic, header length
+ALIGN = 64
+
+def wib_id(key):
+    """
+    Directory name of a WIB source, `key` is a json-serializable tuple.
+    """
+
+    return hashlib.sha1(json.dumps(list(key)).encode()).hexdigest()[:12]
+
+def read_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json(path, obj):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def encode(bundle):
+    """
+    Bundle (dict of arrays and tuples of arrays) to header and arrays.
+    """
+
+    arrays = []
+    entries = []
+    offset = 0
+    for name, value in bundle.items():
+        items = value if isinstance(value, tuple) else (value,)
+        for i, x in enumerate(items):
+            x = np.asarray(x)
+            if not x.flags.c_contiguous:
+                x = np.ascontiguousarray(x)
+            entries.append([name, i if isinstance(value, tuple) else -1,
+                            x.dtype.str, list(x.shape), offset])
+            arrays.append(x)
+            offset += -(-x.nbytes // ALIGN) * ALIGN
+    header = json.dumps(entries).encode()
+    return header, arrays
+
+def decode(buf):
+    """
+    Read-only views of a bundle in `buf` (output of `encode`).
+    """
+
+    magic, size = PREFIX.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError('not a wib_store bundle')
+    start = -(-(PREFIX.size + size) // ALIGN) * ALIGN
+    entries = json.loads(bytes(buf[PREFIX.size:PREFIX.size+size]))
+
+    bundle = {}
+    for name, i, dtype, shape, offset in entries:
+        x = np.ndarray(shape, np.dtype(dtype), buf, start + offset)
+        if i < 0:
+            bundle[name] = x
+        else:
+            bundle[name] = bundle.get(name, ()) + (x,)
+    return bundle
+
+class BundleStore:
+    """
+    Bundles shared by the server processes.
+
+    Parameters
+    ----------
+    root: str
+        store directory, default $WIB_DASH_STORE or /dev/shm/wib_dash
+    max_bytes: int
+        max. total size of the entries
+    max_age: float
+        seconds before an entry which is not updated is removed
+    """
+
+    def __init__(self, root=None, max_bytes=1024**3, max_age=600.):
+        self.root = root or os.environ.get('WIB_DASH_STORE', DEFAULT_ROOT)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._maps = {}     # path -> (inode, mtime, bundle)
+        os.makedirs(os.path.join(self.root, 'sessions'), exist_ok=True)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def put(self, name, bundle):
+        """
+        Write a bundle, `name` is '<wib id>/<entry>'.
+        """
+
+        header, arrays = encode(bundle)
+        path = self.path(f'{name}.bin')
+        tmp = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(PREFIX.pack(MAGIC, len(header)))
+            f.write(header)
+            f.seek(-(-(PREFIX.size + len(header)) // ALIGN) * ALIGN)
+            for x in arrays:
+                pos = f.tell()
+                f.write(x.data if x.ndim else x.tobytes())
+                f.seek(pos + -(-x.nbytes // ALIGN) * ALIGN)
+            f.truncate()
+        os.replace(tmp, path)
+
+    def get(self, name):
+        """
+        Returns
+        -------
+        bundle: dict or None
+            read-only views, valid until the entry is replaced or removed
+            (the mapping is kept alive by the arrays)
+        """
+
+        path = self.path(f'{name}.bin')
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._maps.pop(path, None)
+            return None
+
+        cached = self._maps.get(path)
+        if cached is not None and cached[:2] == (st.st_ino, st.st_mtime_ns):
+            return cached[2]
+
+        try:
+            with open(path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        bundle = decode(buf)
+        self._maps[path] = (st.st_ino, st.st_mtime_ns, bundle)
+        return bundle
+
+    def entries(self):
+        """
+        Returns
+        -------
+        entries: list of (path, size, mtime), oldest first
+        """
+
+        output = []
+        for d in os.listdir(self.root):
+            if d == 'sessions' or not os.path.isdir(self.path(d)):
+                continue
+            for fname in os.listdir(self.path(d)):
+                if not fname.endswith('.bin'):
+                    continue
+                try:
+                    st = os.stat(self.path(d, fname))
+                except FileNotFoundError:
+                    continue
+                output.append((self.path(d, fname), st.st_size, st.st_mtime))
+        return sorted(output, key=lambda x: x[2])
+
+    def evict(self):
+        """
+        Remove entries older than `max_age`, then the oldest ones above
+        `max_bytes`, and the expired sessions.
+
+        Returns
+        -------
+        removed: list of str
+        """
+
+        now = time.time()
+        entries = self.entries()
+        total = sum(size for __, size, __ in entries)
+        removed = []
+        for path, size, mtime in entries:
+            if now - mtime < self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                removed.append(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        for fname in os.listdir(self.path('sessions')):
+            path = self.path('sessions', fname)
+            try:
+                if now - os.stat(path).st_mtime > self.max_age:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def sessions(self, max_age):
+        """
+        Returns
+        -------
+        sessions: dict
+            {session: lease} updated within `max_age` seconds
+        """
+
+        now = time.time()
+        output = {}
+        for fname in os.listdir(self.path('sessions')):
+            lease = read_json(self.path('sessions', fname))
+            if lease and now - lease.get('time', 0) < max_age:
+                output[fname[:-len('.json')]] = lease
+        return output
+
+    def touch_session(self, session, wib, **kwargs):
+        """
+        Record the WIB watched by a session (at most once per second).
+        """
+
+        path = self.path('sessions', f'{os.path.basename(session)}.json')
+        lease = dict(wib=wib, **kwargs)
+        old = read_json(path, {})
+        if old.get('time', 0) > time.time() - 1 \
+                and {k: v for k, v in old.items() if k != 'time'} == lease:
+            return
+        write_json(path, dict(lease, time=time.time()))
+
+class OwnerLock:
+    """
+    Exclusive per-WIB lock (flock), released when the process exits.
+
+    Parameters
+    ----------
+    path: str
+        lock file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self):
+        """Non-blocking, returns `True` if held by this process."""
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f'{os.getpid()}\n'.encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+def update_json(path, **kwargs):
+    """
+    Read-modify-write of a json file under a lock (e.g. control requests
+    from several processes).
+
+    Returns
+    -------
+    obj: dict
+        updated content
+    """
+
+    with open(f'{path}.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        obj = read_json(path, {})
+        obj.update(kwargs)
+        write_json(path, obj)
+    return obj
+
+def main():
+    parser = argparse.ArgumentParser(description='Content of a wib_dash.py store')
+    parser.add_argument('root', nargs='?', default=None,
+                        help=f'store directory, default=$WIB_DASH_STORE or {DEFAULT_ROOT}')
+    args = parser.parse_args()
+
+    store = BundleStore(args.root)
+    now = time.time()
+    for d in sorted(os.listdir(store.root)):
+        key = read_json(store.path(d, 'key.json'))
+        if key is None:
+            continue
+        status = read_json(store.path(d, 'status.json'), {})
+        print(f'{d}: {" ".join(str(x) for x in key)}, owner pid={status.get("pid")},'
+              f' events={status.get("seq", 0)}, error={status.get("error")}')
+
+    entries = store.entries()
+    total = sum(size for __, size, __ in entries)
+    print(f'{len(entries)} entries, {total/1024**2:.1f} MB')
+    for path, size, mtime in entries:
+        print(f'  {os.path.relpath(path, store.root)} {size/1024**2:.1f} MB,'
+              f' {now-mtime:.0f}s ago')
+    for session, lease in store.sessions(store.max_age).items():
+        print(f'session {session}: {lease["wib"]}, {now-lease["time"]:.0f}s ago')
+
+if __name__ == '__main__':
+    main()
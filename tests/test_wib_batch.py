@@ -0,0 +1,8 @@
+from wib_batch import round_title
+
+def test_round_title():
+    assert round_title('/home/wib/data/SN03/Cold/T2') == 'WIB_FEMB_SN03_T2_Cold'
+
+def test_round_title_shallow_folder():
+    assert round_title('/data') == 'data'
+    assert round_title('/data/T2') == 'T2'
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from wib_check import channel_stats, compare, make_golden, reference_fembs
+from wib_sim import FakeWIB
+
+def _events(seed, nevents=3):
+    wib = FakeWIB(nsamples=600, seed=seed)
+    return np.array([wib.acquire_data()[1][..., :512] for _ in range(nevents)])
+
+def test_zeroed_femb_fails(tmp_path, monkeypatch):
+    golden = _events(seed=1)
+    monkeypatch.setattr('wib_check._read', lambda path, do_align=True: golden)
+    ref = make_golden(['run'], str(tmp_path / '0x390.csv'))
+    assert list(reference_fembs(ref)) == [0, 1, 2, 3]
+
+    data = _events(seed=1)
+    __, lanes = compare(channel_stats(data), ref)
+    assert np.all(lanes['result'] == 'PASS')
+
+    data[:, 2] = 0
+    __, lanes = compare(channel_stats(data), ref)
+    failed = lanes[lanes['result'] == 'FAIL']
+    assert set(failed['femb']) == {2}
+    assert len(failed) == 4
+
+def test_reference_fembs():
+    ref = pd.DataFrame(dict(femb=np.arange(512) // 128,
+                            std=np.repeat([5., 0., 5., 0.], 128)))
+    assert list(reference_fembs(ref)) == [0, 2]
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from wib_daq import QualityGate, record
+from wib_sim import FakeWIB
+
+def _saturated():
+    # all channels at 4095: every event is bad
+    return FakeWIB(nsamples=256, pedestal=4095, ped_spread=0, seed=1)
+
+def test_drop_mode_stops_on_bad_events(tmp_path):
+    success = record(_saturated(), str(tmp_path), 5, gate=QualityGate(),
+                     mode='drop', stop_after=3)
+    assert not success
+    assert os.listdir(tmp_path) == []
+
+def test_drop_mode_needs_a_limit(tmp_path):
+    with pytest.raises(ValueError):
+        record(_saturated(), str(tmp_path), 5, gate=QualityGate(), mode='drop', stop_after=0)
+
+def test_tag_mode_saves_bad_events(tmp_path):
+    success = record(_saturated(), str(tmp_path), 3, gate=QualityGate(), mode='tag')
+    assert success
+    assert len(os.listdir(tmp_path)) == 3
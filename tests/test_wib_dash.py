@@ -0,0 +1,36 @@
+import numpy as np
+
+from wib_dash import Accumulator, _process
+from wib_sim import FakeWIB
+
+def _bundles(n):
+    wib = FakeWIB(nsamples=1024, jitter=0, seed=0)
+    return [_process(*wib.acquire_data()) for __ in range(n)]
+
+def _average(bundles, nmax=0):
+    acc = Accumulator(nmax=nmax, nfft=512)
+    for bundle in bundles:
+        acc.add(bundle)
+    return acc, acc.bundle()
+
+def test_window_is_the_last_n_events():
+    bundles = _bundles(6)
+    acc, window = _average(bundles, nmax=3)
+    __, last = _average(bundles[-3:])
+
+    assert acc.count == 6
+    assert acc.nevents == 3
+    for key in ('mean', 'std', 'psd'):
+        np.testing.assert_allclose(window[key], last[key], rtol=1e-4, atol=1e-4)
+    for key in ('hist_adcs', 'hist_delta'):
+        np.testing.assert_array_equal(window[key][1], last[key][1])
+
+def test_changing_the_window_restarts():
+    bundles = _bundles(3)
+    acc, __ = _average(bundles)
+    assert acc.nevents == 3
+
+    acc.nmax = 2
+    assert acc.count == 0 and acc.bundle() is None
+    acc.nmax = 2 * Accumulator.MAX_WINDOW
+    assert acc.nmax == Accumulator.MAX_WINDOW
@@ -0,0 +1,27 @@
+import numpy as np
+
+from wib_lines import find_lines, noise_threshold
+from wib_sim import FakeWIB
+
+def _events(nevents, lines=[], seed=0):
+    wib = FakeWIB(lines=lines, seed=seed)
+    return np.array([wib.acquire_data()[1][..., :2100] for _ in range(nevents)])
+
+def test_pure_noise_gives_no_lines():
+    for nevents in [1, 5]:
+        for seed in range(3):
+            lines, __ = find_lines(_events(nevents, seed=seed))
+            assert len(lines) == 0, (nevents, seed, lines)
+
+def test_coherent_line_is_found():
+    lines, __ = find_lines(_events(5, lines=[(200e3, 3.)]))
+    assert len(lines) == 1
+    line = lines.iloc[0]
+    assert abs(line['freq_khz'] - 200) < 1
+    assert line['nchannels'] == 512
+    assert line['coherent']
+
+def test_noise_threshold_decreases_with_events():
+    thresholds = [noise_threshold(n, 512*1000) for n in [1, 5, 50]]
+    assert thresholds[0] > 6 > thresholds[2]
+    assert np.all(np.diff(thresholds) < 0)
@@ -0,0 +1,33 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from wib_shm import ShmReader, ShmWriter
+
+def _publish(path, nevents):
+    ring = ShmWriter(path, nslots=2, nsamples=2048)
+    ts = np.zeros((2, 2048), dtype=np.uint64)
+    data = np.empty((4, 128, 2048), dtype=np.uint16)
+    for seq in range(1, nevents + 1):
+        data[:] = seq & 0xfff
+        ring.publish(ts, data)
+    ring.close()
+
+def test_latest_is_never_a_mix_of_events(tmp_path):
+    path = str(tmp_path / 'ring')
+    ShmWriter(path, nslots=2, nsamples=2048).close()
+    reader = ShmReader(path)
+
+    writer = mp.Process(target=_publish, args=(path, 2000))
+    writer.start()
+    nread = 0
+    while writer.is_alive() or nread == 0:
+        # the writer creates a new ring
+        reader._reopen()
+        event = reader.latest()
+        if event is None:
+            continue
+        seq, __, __, __, data = event
+        assert np.all(data == (seq & 0xfff))
+        nread += 1
+    writer.join()